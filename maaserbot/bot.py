@@ -1,39 +1,47 @@
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, ConversationHandler, filters, CallbackContext
-import os
-from dotenv import load_dotenv
-from maaserbot.models import SessionLocal
-from maaserbot.utils.db import get_or_create_user, add_income, add_payment, get_user_balance, get_user_history, update_user_settings, delete_all_user_data, delete_income, edit_income, delete_payment, edit_payment, approve_user, remove_user_approval, get_all_users, get_pending_access_requests, create_access_request, approve_access_request, reject_access_request
-from maaserbot.models.models import CalculationType, Income, Payment, AccessRequest
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, InlineQueryResultsButton
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, ConversationHandler, TypeHandler, InlineQueryHandler, ChosenInlineResultHandler, filters, CallbackContext
+from maaserbot.config import get_settings
+from maaserbot.models import check_schema, dispose_engine
+from maaserbot.models.routing import set_current_user
+from maaserbot.utils.db import get_or_create_user, get_user_permissions, add_income, add_payment, get_cached_balance, get_user_history, update_user_settings, delete_all_user_data, delete_income, edit_income, delete_payment, restore_deleted, UNDO_WINDOW, edit_payment, approve_user, remove_user_approval, get_all_users, get_pending_access_requests, create_access_request, approve_access_request, reject_access_request, create_broadcast, cancel_broadcast, set_reminder_threshold, get_daily_totals, search_incomes, add_recurring_entry, get_recurring_entries, delete_recurring_entry
+from maaserbot.models.models import CalculationType, Income, Payment, AccessRequest, calculation_rate, obligation_for
+from maaserbot.utils.send_queue import SendQueue, SendQueueRateLimiter, SEND_QUEUE_KEY, notify
+from maaserbot.utils.broadcast import start_broadcast, resume_broadcasts, stop_broadcasts
+from maaserbot.utils.reminders import send_balance_reminders, REMINDER_THRESHOLDS
+from maaserbot.utils.reports import get_years_report, get_months_report, get_month_report
+from maaserbot.utils.charts import render_chart, shutdown_executor
+from maaserbot.utils.compaction import compact_deleted_rows
+from maaserbot.utils.archival import maintain_history_storage
+from maaserbot.utils.recurring import add_recurring_entries
+from maaserbot.utils.cache import cache
+from maaserbot.utils.idempotency import IdempotencyGuard, IDEMPOTENCY_KEY, drop_duplicate_updates
+from maaserbot.utils.flood import FloodGuard, FLOOD_GUARD_KEY, throttle_floods
+from maaserbot.utils.querycount import enable_raiseload
+from maaserbot.utils.slowquery import set_query_origin, stats as query_stats, fingerprint
+from maaserbot.utils.profiling import profiler
+from maaserbot.utils.logging_utils import setup_logging, shutdown_logging
+from maaserbot.utils.unit_of_work import BotContext, update_session, read_session, discard_update_changes
+from maaserbot.utils import metrics
+from maaserbot.lifecycle import ALLOWED_UPDATES, DrainingUpdateProcessor, run_application
 from telegram.error import Conflict
 import asyncio
-import aiohttp
+import re
 from datetime import datetime, timezone, timedelta
 
-# Load environment variables
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # Default to 0 if not set
-
-# Enable logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+ADMIN_ID = get_settings().admin_id
+
 logger = logging.getLogger(__name__)
 
 # Conversation states
-CHOOSING, TYPING_INCOME, TYPING_INCOME_DESCRIPTION, TYPING_PAYMENT, SETTINGS, AWAITING_DELETE_CONFIRMATION, EDIT_CHOOSING, EDIT_INCOME, EDIT_PAYMENT, EDIT_INCOME_DESCRIPTION, SELECTING_INCOME_ID, SELECTING_PAYMENT_ID, APPROVING_USER = range(13)
+CHOOSING, TYPING_INCOME, TYPING_INCOME_DESCRIPTION, TYPING_PAYMENT, SETTINGS, AWAITING_DELETE_CONFIRMATION, EDIT_CHOOSING, EDIT_INCOME, EDIT_PAYMENT, EDIT_INCOME_DESCRIPTION, SELECTING_INCOME_ID, SELECTING_PAYMENT_ID, APPROVING_USER, TYPING_CUSTOM_RATE = range(14)
 
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a message to the user."""
     logger.error("Exception while handling an update:", exc_info=context.error)
+    # Nothing the failed handler left uncommitted is kept
+    discard_update_changes()
     
     if isinstance(context.error, Conflict):
         logger.warning("Conflict error - multiple bot instances running")
@@ -53,20 +61,68 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         else:
             await update.effective_message.reply_text(error_message)
 
+def format_calc_type(user) -> str:
+    """Calculation type label, with the percentage for a custom rate."""
+    if user.default_calc_type == CalculationType.CUSTOM.value and user.custom_rate is not None:
+        return f"{user.default_calc_type} ({user.custom_rate * 100:g}%)"
+    return user.default_calc_type
+
+def parse_income_amount(text: str) -> tuple[float, float]:
+    """
+    Parse income input: an amount, optionally minus deductible expenses ("5000 - 1200").
+
+    Returns:
+        tuple: (amount, deductible)
+
+    Raises:
+        ValueError: If the input is not a positive amount or the expenses exceed it
+    """
+    amount_text, _, deductible_text = text.replace(',', '').partition('-')
+    amount = float(amount_text.strip())
+    deductible = float(deductible_text.strip()) if deductible_text.strip() else 0.0
+    if amount <= 0 or deductible < 0 or deductible > amount:
+        raise ValueError("Amount must be positive and larger than the expenses")
+    return amount, deductible
+
+# Deletion times travel in callback data as undo tokens
+UNDO_TOKEN_FORMAT = '%Y%m%d%H%M%S%f'
+
+def undo_button(deleted_at: datetime) -> InlineKeyboardButton:
+    """Button that restores the entries deleted at the given time."""
+    return InlineKeyboardButton("↩️ ביטול המחיקה", callback_data=f'undo_{deleted_at.strftime(UNDO_TOKEN_FORMAT)}')
+
+def describe_update(update: Update) -> str:
+    """Short label of what an update asks for, without ids or amounts (e.g. 'button:history_page_#')."""
+    if update.callback_query:
+        return 'button:' + re.sub(r'\d[\d.]*', '#', update.callback_query.data or '')
+    if update.inline_query:
+        return 'inline_query'
+    if update.chosen_inline_result:
+        return 'inline_result:' + update.chosen_inline_result.result_id
+    text = update.message.text if update.message and update.message.text else ''
+    if text.startswith('/'):
+        return 'command:' + text.split()[0]
+    return 'message'
+
+async def remember_current_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set the user of the update for read replica routing, and the origin of its queries for the slow-query log."""
+    set_current_user(update.effective_user.id if update.effective_user else None)
+    set_query_origin(describe_update(update))
+
 async def check_user_permission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Check if user is approved to use the bot."""
-    with SessionLocal() as db:
-        user = get_or_create_user(db, update.effective_user.id)
-        if not user.is_approved:
-            logger.warning(f"Unauthorized access attempt by user {update.effective_user.id}")
-            return False
-        return True
+    with update_session() as db:
+        permissions = get_user_permissions(db, update.effective_user.id)
+    if not permissions['is_approved']:
+        logger.warning("Unauthorized access attempt by user %s", update.effective_user.id)
+        return False
+    return True
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
-    logger.info(f"User {update.effective_user.id} started the bot")
-    with SessionLocal() as db:
-        user = get_or_create_user(db, update.effective_user.id)
+    logger.info("User %s started the bot", update.effective_user.id)
+    with update_session() as db:
+        user = context.db_user
         
         if not user.is_approved:
             # Check if user already has a pending request
@@ -120,6 +176,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("📊 מצב נוכחי", callback_data='status'),
             InlineKeyboardButton("📖 היסטוריה", callback_data='history')
         ],
+        [InlineKeyboardButton("📅 דוחות חודשיים ושנתיים", callback_data='reports')],
         [
             InlineKeyboardButton("⚙️ הגדרות", callback_data='settings'),
             InlineKeyboardButton("❓ עזרה", callback_data='help')
@@ -139,14 +196,8 @@ async def manage_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    with SessionLocal() as db:
-        user = get_or_create_user(
-            db, 
-            query.from_user.id,
-            query.from_user.username,
-            query.from_user.first_name,
-            query.from_user.last_name
-        )
+    user = context.db_user
+    with read_session() as db:
         if not user.is_admin:
             await query.edit_message_text("❌ אין לך הרשאת מנהל")
             return CHOOSING
@@ -177,7 +228,7 @@ async def show_approved_users(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    with SessionLocal() as db:
+    with read_session() as db:
         users = get_all_users(db, query.from_user.id)
         
         message = "*👤 משתמשים מאושרים*\n\n"
@@ -218,7 +269,7 @@ async def show_pending_requests(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     
-    with SessionLocal() as db:
+    with read_session() as db:
         pending_requests = db.query(AccessRequest).filter(AccessRequest.status == 'pending').all()
         
         if not pending_requests:
@@ -265,7 +316,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     try:
-        with SessionLocal() as db:
+        with update_session() as db:
             # Check if user already has a pending request
             existing_requests = get_pending_access_requests(db)
             user_has_request = any(req.telegram_id == query.from_user.id for req in existing_requests)
@@ -298,7 +349,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "אנא נסה שוב מאוחר יותר."
                 )
     except Exception as e:
-        logger.error(f"Error in request_access: {str(e)}")
+        logger.error("Error in request_access: %s", e)
         await query.edit_message_text(
             "❌ אירעה שגיאה בשליחת בקשת הגישה.\n"
             "אנא נסה שוב מאוחר יותר."
@@ -318,21 +369,19 @@ async def approve_request_command(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("❌ מזהה בקשה לא תקין")
         return
         
-    with SessionLocal() as db:
+    with update_session() as db:
         success = approve_access_request(db, update.effective_user.id, request_id)
         if success:
             # Get the request to get the user's telegram_id
             request = db.query(AccessRequest).filter(AccessRequest.id == request_id).first()
             if request:
-                # Send message to the approved user
-                try:
-                    await context.bot.send_message(
-                        chat_id=request.telegram_id,
-                        text="✅ בקשת הגישה שלך לבוט אושרה!\n"
-                             "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send approval message to user {request.telegram_id}: {str(e)}")
+                # Queue the message to the approved user so a burst of approvals respects flood limits
+                notify(
+                    context,
+                    request.telegram_id,
+                    "✅ בקשת הגישה שלך לבוט אושרה!\n"
+                    "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
+                )
             
             await update.message.reply_text(f"✅ בקשת גישה {request_id} אושרה בהצלחה")
         else:
@@ -350,13 +399,337 @@ async def reject_request_command(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("❌ מזהה בקשה לא תקין")
         return
         
-    with SessionLocal() as db:
+    with update_session() as db:
         success = reject_access_request(db, update.effective_user.id, request_id)
         if success:
             await update.message.reply_text(f"✅ בקשת גישה {request_id} נדחתה בהצלחה")
         else:
             await update.message.reply_text("❌ שגיאה בדחיית הבקשה")
 
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /broadcast command - send a message to all approved users."""
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("❌ נא לכתוב את תוכן ההודעה אחרי הפקודה\n/broadcast <הודעה>")
+        return
+        
+    with update_session() as db:
+        broadcast = create_broadcast(db, update.effective_user.id, text)
+        if not broadcast:
+            await update.message.reply_text("❌ אין לך הרשאת מנהל")
+            return
+        broadcast_id = broadcast.id
+        
+    start_broadcast(context.application, broadcast_id)
+    await update.message.reply_text(
+        f"📣 שידור #{broadcast_id} התחיל.\n"
+        f"תקבל דוח בסיום. לביטול: /cancel_broadcast {broadcast_id}"
+    )
+
+async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /cancel_broadcast command."""
+    if not context.args:
+        await update.message.reply_text("❌ נא לציין מזהה שידור")
+        return
+        
+    try:
+        broadcast_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ מזהה שידור לא תקין")
+        return
+        
+    with update_session() as db:
+        success = cancel_broadcast(db, update.effective_user.id, broadcast_id)
+        if success:
+            await update.message.reply_text(f"✅ שידור {broadcast_id} בוטל")
+        else:
+            await update.message.reply_text("❌ שגיאה בביטול השידור")
+
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /slow_queries command - show the statements taking the most database time."""
+    with update_session() as db:
+        if not get_user_permissions(db, update.effective_user.id)['is_admin']:
+            await update.message.reply_text("❌ אין לך הרשאת מנהל")
+            return
+            
+    top = query_stats.top(10)
+    if not top:
+        await update.message.reply_text("אין עדיין נתונים על שאילתות.")
+        return
+        
+    message = (
+        "🐢 שאילתות לפי זמן כולל (מאז ההפעלה)\n"
+        f"מטמון הידור: {query_stats.cache_hit_ratio:.0%} פגיעות "
+        f"({query_stats.cache_hits}/{query_stats.cache_hits + query_stats.cache_misses})\n\n"
+    )
+    for normalized, statement in top:
+        message += (
+            f"{fingerprint(normalized)}: {statement.count}× | סה\"כ {statement.total * 1000:.0f} ms | "
+            f"p95 {statement.p95 * 1000:.1f} ms\n{normalized[:300]}\n\n"
+        )
+    await update.message.reply_text(message[:4096])
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /profile command - switch update profiling and show or dump the slowest updates.
+
+    /profile | /profile every N | /profile user ID | /profile off | /profile dump | /profile clear
+    """
+    with update_session() as db:
+        if not get_user_permissions(db, update.effective_user.id)['is_admin']:
+            await update.message.reply_text("❌ אין לך הרשאת מנהל")
+            return
+            
+    args = context.args
+    try:
+        if args and args[0] == 'every' and len(args) == 2:
+            profiler.configure(every=int(args[1]), user_id=profiler.user_id)
+        elif args and args[0] == 'user' and len(args) == 2:
+            profiler.configure(every=profiler.every, user_id=int(args[1]))
+        elif args and args[0] == 'off':
+            profiler.configure()
+        elif args and args[0] == 'clear':
+            profiler.clear()
+        elif args and args[0] == 'dump':
+            paths = await asyncio.to_thread(profiler.dump, get_settings().profile_dir)
+            await update.message.reply_text("\n".join(paths) if paths else "אין עדיין פרופילים.")
+            return
+        elif args:
+            raise ValueError(args[0])
+    except ValueError:
+        await update.message.reply_text("❌ שימוש: /profile [every N | user ID | off | dump | clear]")
+        return
+        
+    message = f"🔬 פרופיילינג: כל {profiler.every or '-'} עדכונים, משתמש {profiler.user_id or '-'}\n\n"
+    for profile in profiler.slowest():
+        message += f"{profile.duration * 1000:.0f} ms | {profile.origin} | {profile.callback_data or ''} | עדכון {profile.update_id}\n"
+    await update.message.reply_text(message[:4096])
+
+# Inline result id -> calculation type of the income it adds
+INLINE_INCOME_TYPES = {
+    'income_maaser': CalculationType.MAASER,
+    'income_chomesh': CalculationType.CHOMESH,
+    'income_custom': CalculationType.CUSTOM,
+}
+
+def parse_inline_entry(text: str) -> tuple[float, float, str]:
+    """
+    Parse an inline query: an amount, optionally minus expenses ("5000-1200"), then an optional description.
+
+    Returns:
+        tuple: (amount, deductible, description or None)
+
+    Raises:
+        ValueError: If the query doesn't start with a valid amount
+    """
+    amount_text, _, description = text.strip().partition(' ')
+    amount, deductible = parse_income_amount(amount_text)
+    return amount, deductible, description.strip() or None
+
+def format_balance(balance: dict) -> str:
+    """One-line balance for inline results."""
+    return f"📌 יתרה לתשלום: {balance['remaining']:.2f} ₪ (הכנסות {balance['total_income']:.2f} ₪, שולם {balance['total_paid']:.2f} ₪)"
+
+def inline_results(user, balance: dict, text: str) -> list:
+    """
+    The inline result cards for a query: the entry as an income of each type and as a payment, then the balance.
+
+    Args:
+        user: The user asking
+        balance: The user's balance
+        text: The inline query
+    """
+    results = []
+    try:
+        amount, deductible, description = parse_inline_entry(text)
+    except ValueError:
+        amount = None
+    # Sending a card with a keyboard makes Telegram report its message, so it can be updated once recorded
+    pending = InlineKeyboardMarkup([[InlineKeyboardButton("⏳ נרשם...", callback_data='main_menu')]])
+
+    if amount:
+        suffix = f" | {description}" if description else ""
+        # The user's default type first
+        income_types = sorted(INLINE_INCOME_TYPES.items(), key=lambda item: item[1].value != user.default_calc_type)
+        for result_id, calc_type in income_types:
+            if calc_type == CalculationType.CUSTOM and user.custom_rate is None:
+                continue
+            rate = calculation_rate(calc_type.value, user.custom_rate)
+            obligation = obligation_for(amount, rate, deductible)
+            message = f"📥 הכנסה: {amount:.2f} ₪"
+            if deductible:
+                message += f" (הוצאות מוכרות {deductible:.2f} ₪)"
+            message += f"\n{calc_type.value} ({rate * 100:g}%): {obligation:.2f} ₪{suffix}"
+            results.append(InlineQueryResultArticle(
+                id=result_id,
+                title=f"📥 הוספת הכנסה ({calc_type.value}): {amount:.2f} ₪",
+                description=f"{calc_type.value} {rate * 100:g}%: {obligation:.2f} ₪{suffix}",
+                input_message_content=InputTextMessageContent(message),
+                reply_markup=pending
+            ))
+        if not deductible and amount <= balance['remaining']:
+            results.append(InlineQueryResultArticle(
+                id='payment',
+                title=f"💸 רישום תשלום: {amount:.2f} ₪",
+                description=f"יתרה אחרי התשלום: {balance['remaining'] - amount:.2f} ₪",
+                input_message_content=InputTextMessageContent(f"💸 תשלום: {amount:.2f} ₪"),
+                reply_markup=pending
+            ))
+
+    results.append(InlineQueryResultArticle(
+        id='balance',
+        title=f"📌 יתרה לתשלום: {balance['remaining']:.2f} ₪",
+        description="הקלד סכום ותיאור כדי להוסיף הכנסה או תשלום, למשל: 1500 משכורת",
+        input_message_content=InputTextMessageContent(format_balance(balance))
+    ))
+    return results
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline queries (@bot 1500 משכורת) - offer the entry as ready result cards, plus the balance.
+
+    The entry is recorded when the user sends a card (see inline_result_chosen),
+    so adding an income or a payment takes a single round-trip.
+    """
+    query = update.inline_query
+    cache_time = get_settings().inline_cache_seconds
+    if not await check_user_permission(update, context):
+        await query.answer([], cache_time=cache_time, is_personal=True,
+                           button=InlineQueryResultsButton("⚠️ יש לבקש גישה לבוט", start_parameter='start'))
+        return
+
+    with update_session() as db:
+        user = context.db_user
+        # Cached by data version, and computed again right after every inline entry
+        balance = get_cached_balance(db, user)
+        results = inline_results(user, balance, query.query)
+
+    await query.answer(results, cache_time=cache_time, is_personal=True)
+
+async def inline_result_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record the income or payment of an inline result the user sent.
+
+    Needs inline feedback switched on with @BotFather (/setinlinefeedback).
+    """
+    chosen = update.chosen_inline_result
+    if chosen.result_id == 'balance' or not await check_user_permission(update, context):
+        return
+    try:
+        amount, deductible, description = parse_inline_entry(chosen.query)
+    except ValueError:
+        logger.warning("Inline result %s chosen with an invalid query", chosen.result_id)
+        return
+
+    with update_session() as db:
+        user = context.db_user
+        if chosen.result_id == 'payment':
+            # The balance may have changed since the results were shown
+            if amount > get_cached_balance(db, user)['remaining']:
+                text = f"❌ התשלום של {amount:.2f} ₪ לא נרשם - הוא גבוה מהיתרה לתשלום."
+            else:
+                add_payment(db, user.id, amount)
+                text = f"✅ נרשם תשלום של {amount:.2f} ₪"
+        elif chosen.result_id in INLINE_INCOME_TYPES:
+            calc_type = INLINE_INCOME_TYPES[chosen.result_id]
+            add_income(db, user.id, amount, calc_type, description, deductible)
+            text = f"✅ נרשמה הכנסה של {amount:.2f} ₪ ({calc_type.value})"
+            if description:
+                text += f" - {description}"
+        else:
+            return
+        # Computing it now also caches it for the user's next inline query
+        balance = get_cached_balance(db, user)
+
+    if chosen.inline_message_id:
+        await context.bot.edit_message_text(f"{text}\n{format_balance(balance)}", inline_message_id=chosen.inline_message_id)
+
+RECURRING_USAGE = (
+    "🔁 שימוש:\n"
+    "/recurring - רשימת ההכנסות והתשלומים הקבועים\n"
+    "/recurring income סכום יום [תיאור] - הכנסה חודשית (למשל: /recurring income 12000 10 משכורת)\n"
+    "/recurring payment סכום יום [תיאור] - תשלום חודשי (הוראת קבע)\n"
+    "/recurring delete מספר - הפסקת הוראה קבועה\n"
+    "היום בחודש הוא בין 1 ל-28."
+)
+
+async def recurring_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /recurring command - list, add and stop monthly incomes and payments.
+
+    /recurring | /recurring income AMOUNT DAY [description] | /recurring payment AMOUNT DAY [description] | /recurring delete ID
+    """
+    if not await check_user_permission(update, context):
+        await update.message.reply_text("⚠️ אין לך הרשאה להשתמש בבוט.")
+        return
+        
+    args = context.args
+    with update_session() as db:
+        user = context.db_user
+        try:
+            if args and args[0] in ('income', 'payment') and len(args) >= 3:
+                # An income may deduct expenses like a regular one ("5000-1200")
+                amount, deductible = parse_income_amount(args[1]) if args[0] == 'income' else (float(args[1].replace(',', '')), 0.0)
+                entry = add_recurring_entry(db, user.id, args[0], amount, int(args[2]), ' '.join(args[3:]) or None,
+                                            deductible=deductible)
+                await update.message.reply_text(
+                    f"✅ {'הכנסה' if entry.kind == 'income' else 'תשלום'} של {entry.amount:.2f} ₪ יתווסף ב-{entry.day_of_month} בכל חודש.\n"
+                    f"הפעם הבאה: {entry.next_run_at.strftime('%d/%m/%Y')}"
+                )
+                return
+            elif args and args[0] == 'delete' and len(args) == 2:
+                stopped = delete_recurring_entry(db, int(args[1]), user.id)
+                await update.message.reply_text("✅ ההוראה הקבועה הופסקה." if stopped else "❌ לא נמצאה ההוראה הקבועה המבוקשת")
+                return
+            elif args:
+                raise ValueError(args[0])
+        except ValueError:
+            await update.message.reply_text(RECURRING_USAGE)
+            return
+            
+        entries = get_recurring_entries(db, user.id)
+        
+    if not entries:
+        await update.message.reply_text("אין הכנסות או תשלומים קבועים.\n\n" + RECURRING_USAGE)
+        return
+    message = "🔁 הכנסות ותשלומים קבועים\n══════════════════\n\n"
+    for entry in entries:
+        label = f"📥 הכנסה ({entry.calc_type})" if entry.kind == 'income' else "💸 תשלום"
+        message += f"{entry.id}. {label}: {entry.amount:.2f} ₪ ב-{entry.day_of_month} בחודש"
+        if entry.description:
+            message += f" | {entry.description}"
+        message += f"\n   הפעם הבאה: {entry.next_run_at.strftime('%d/%m/%Y')}\n"
+    await update.message.reply_text(message[:4096])
+
+async def send_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a chart of cumulative income, obligation and payments."""
+    message = update.effective_message
+    
+    user = context.db_user
+    with read_session() as db:
+        # Charts are cached by data version, so any change to the user's data renders a new one
+        cache_key = ('chart', user.id, user.data_version)
+        photo = cache.get(cache_key)
+        series = get_daily_totals(db, user.id) if photo is None else None
+        
+    if photo is None:
+        if not series:
+            await message.reply_text("לא נמצאו נתונים עדיין.\nהתחל על ידי הוספת הכנסה! 💪")
+            return
+        try:
+            photo = await render_chart(series)
+        except ImportError:
+            logger.error("matplotlib is not installed - charts are disabled")
+            await message.reply_text("❌ גרפים אינם זמינים כרגע.")
+            return
+            
+    sent = await message.reply_photo(photo=photo, caption="📈 הכנסות, חובת מעשר ותשלומים מצטברים")
+    # Re-sending by file_id skips both rendering and the upload
+    cache.set(cache_key, sent.photo[-1].file_id)
+
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /chart command."""
+    if not await check_user_permission(update, context):
+        await update.message.reply_text("⚠️ אין לך הרשאה להשתמש בבוט.")
+        return
+    await send_chart(update, context)
+
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button presses."""
     query = update.callback_query
@@ -379,22 +752,20 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         action, id_str = query.data.split('_')
         try:
             item_id = int(id_str)
-            with SessionLocal() as db:
+            with update_session() as db:
                 if action == 'approve':
                     success = approve_access_request(db, query.from_user.id, item_id)
                     if success:
                         # Get the request to get the user's telegram_id
                         request = db.query(AccessRequest).filter(AccessRequest.id == item_id).first()
                         if request:
-                            # Send message to the approved user
-                            try:
-                                await context.bot.send_message(
-                                    chat_id=request.telegram_id,
-                                    text="✅ בקשת הגישה שלך לבוט אושרה!\n"
-                                         "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
-                                )
-                            except Exception as e:
-                                logger.error(f"Failed to send approval message to user {request.telegram_id}: {str(e)}")
+                            # Queue the message to the approved user
+                            notify(
+                                context,
+                                request.telegram_id,
+                                "✅ בקשת הגישה שלך לבוט אושרה!\n"
+                                "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
+                            )
                         
                         await query.answer("✅ הבקשה אושרה בהצלחה")
                     else:
@@ -424,14 +795,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check user permission for all actions except manage_users
     if query.data != 'manage_users':
-        with SessionLocal() as db:
-            user = get_or_create_user(
-                db,
-                query.from_user.id,
-                query.from_user.username,
-                query.from_user.first_name,
-                query.from_user.last_name
-            )
+        with update_session() as db:
+            user = context.db_user
             if not user.is_approved:
                 keyboard = [
                     [InlineKeyboardButton("🔑 בקש גישה לבוט", callback_data='request_access')]
@@ -446,8 +811,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if query.data == 'manage_users':
         # Check if user is the main admin
-        with SessionLocal() as db:
-            user = get_or_create_user(db, query.from_user.id)
+        with update_session() as db:
+            user = context.db_user
             if user.telegram_id != ADMIN_ID:
                 await query.edit_message_text("❌ אין לך הרשאת מנהל")
                 return CHOOSING
@@ -464,15 +829,16 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await query.edit_message_text(
             "💰 הוספת הכנסה\n\n"
-            "בבקשה הזן את סכום ההכנסה:",
+            "בבקשה הזן את סכום ההכנסה:\n"
+            "(להפחתת הוצאות מוכרות: סכום - הוצאות, למשל 5000 - 1200)",
             reply_markup=reply_markup
         )
         return TYPING_INCOME
     
     elif query.data == 'add_payment':
-        with SessionLocal() as db:
-            user = get_or_create_user(db, query.from_user.id)
-            balance = get_user_balance(db, user.id)
+        with update_session() as db:
+            user = context.db_user
+            balance = get_cached_balance(db, user)
             
         if balance and balance['remaining'] > 0:
             keyboard = [
@@ -502,10 +868,10 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data.startswith('pay_full_'):
         try:
             amount = float(query.data.split('_')[2])
-            with SessionLocal() as db:
-                user = get_or_create_user(db, query.from_user.id)
+            with update_session() as db:
+                user = context.db_user
                 payment = add_payment(db, user.id, amount)
-                balance = get_user_balance(db, user.id)
+                balance = get_cached_balance(db, user)
                 
                 keyboard = [
                     [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
@@ -539,12 +905,13 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return TYPING_PAYMENT
     
     elif query.data == 'status':
-        with SessionLocal() as db:
-            user = get_or_create_user(db, query.from_user.id)
-            balance = get_user_balance(db, user.id)
+        user = context.db_user
+        with read_session() as db:
+            balance = get_cached_balance(db, user)
         
         if balance:
             keyboard = [
+                [InlineKeyboardButton("📈 גרף מגמה", callback_data='chart')],
                 [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -552,7 +919,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(
                 f"📊 מצב נוכחי\n\n"
                 f"💵 סך כל ההכנסות: {balance['total_income']:.2f} ₪\n"
-                f"✨ סך הכל {user.default_calc_type}: {balance['total_maaser']:.2f} ₪\n"
+                f"✨ סך הכל {format_calc_type(user)}: {balance['total_maaser']:.2f} ₪\n"
                 f"💸 סך הכל שולם: {balance['total_paid']:.2f} ₪\n"
                 f"📌 יתרה לתשלום: {balance['remaining']:.2f} ₪",
                 reply_markup=reply_markup
@@ -575,21 +942,35 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         page = int(query.data.split('_')[2])
         await show_history(update, context, page)
     
+    elif query.data.startswith('search_page_'):
+        page = int(query.data.split('_')[2])
+        await show_search_results(update, context, page)
+    
+    elif query.data == 'chart':
+        await send_chart(update, context)
+    
+    elif query.data.startswith('undo_'):
+        await handle_undo_delete(update, context)
+    
+    elif query.data == 'reports' or query.data.startswith('report_'):
+        await show_report(update, context)
+    
     elif query.data == 'settings':
         keyboard = [
             [
                 InlineKeyboardButton("🔄 שינוי סוג חישוב", callback_data='change_calc_type')
             ],
+            [InlineKeyboardButton("🔔 תזכורות תשלום", callback_data='reminders')],
             [InlineKeyboardButton("🗑️ מחיקת כל המידע", callback_data='delete_all_data')],
             [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        with SessionLocal() as db:
-            user = get_or_create_user(db, query.from_user.id)
+        with update_session() as db:
+            user = context.db_user
             await query.edit_message_text(
                 f"⚙️ הגדרות\n\n"
-                f"🔄 סוג חישוב נוכחי: {user.default_calc_type}",
+                f"🔄 סוג חישוב נוכחי: {format_calc_type(user)}",
                 reply_markup=reply_markup
             )
             
@@ -599,6 +980,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("מעשר - 10% מההכנסות", callback_data='set_maaser'),
                 InlineKeyboardButton("חומש - 20% מההכנסות", callback_data='set_chomesh')
             ],
+            [InlineKeyboardButton("אחוז אחר", callback_data='set_custom')],
             [InlineKeyboardButton("חזרה להגדרות", callback_data='settings')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -608,9 +990,52 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
     
+    elif query.data == 'reminders' or query.data.startswith('reminder_'):
+        with update_session() as db:
+            user = context.db_user
+            
+            if query.data == 'reminder_off':
+                user = set_reminder_threshold(db, user.id, None)
+            elif query.data.startswith('reminder_'):
+                user = set_reminder_threshold(db, user.id, float(query.data.split('_')[1]))
+            
+            if user.reminder_threshold is None:
+                current = "כבויות"
+            else:
+                current = f"כשהיתרה עולה על {user.reminder_threshold:.0f} ₪"
+            
+        keyboard = [
+            [
+                InlineKeyboardButton(f"{threshold} ₪", callback_data=f'reminder_{threshold}')
+                for threshold in REMINDER_THRESHOLDS
+            ],
+            [InlineKeyboardButton("🔕 ללא תזכורות", callback_data='reminder_off')],
+            [InlineKeyboardButton("חזרה להגדרות", callback_data='settings')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(
+            "🔔 תזכורות תשלום\n\n"
+            f"מצב נוכחי: {current}\n\n"
+            "בחר מעל איזו יתרה לקבל תזכורת:",
+            reply_markup=reply_markup
+        )
+    
+    elif query.data == 'set_custom':
+        context.user_data['original_message'] = query.message
+        keyboard = [
+            [InlineKeyboardButton("ביטול", callback_data='settings')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(
+            "🔄 אחוז אישי\n\n"
+            "הזן את האחוז מההכנסות (למשל 15):",
+            reply_markup=reply_markup
+        )
+        return TYPING_CUSTOM_RATE
+    
     elif query.data.startswith('set_'):
-        with SessionLocal() as db:
-            user = get_or_create_user(db, query.from_user.id)
+        with update_session() as db:
+            user = context.db_user
             
             if query.data == 'set_maaser':
                 user = update_user_settings(db, user.id, default_calc_type=CalculationType.MAASER)
@@ -637,9 +1062,10 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "פעולה זו תמחק את כל ההיסטוריה שלך, כולל:\n"
             "• כל ההכנסות\n"
             "• כל התשלומים\n"
-            "• כל ההגדרות האישיות\n\n"
+            "• כל ההגדרות האישיות\n"
+            "• ההכנסות והתשלומים הקבועים (לא יחזרו גם אם המחיקה תבוטל)\n\n"
             "האם אתה בטוח שברצונך למחוק את כל המידע?\n"
-            "פעולה זו אינה ניתנת לביטול!",
+            f"ניתן לבטל את המחיקה רק ב-{UNDO_WINDOW.seconds // 60} הדקות שאחריה!",
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
@@ -666,7 +1092,8 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text = (
             "*❓ עזרה ומידע*\n\n"
             "*📥 הוספת הכנסה*\n"
-            "הוסף הכנסה חדשה למעקב. תוכל להזין את הסכום ולהוסיף תיאור אופציונלי.\n\n"
+            "הוסף הכנסה חדשה למעקב. תוכל להזין את הסכום ולהוסיף תיאור אופציונלי.\n"
+            "להפחתת הוצאות מוכרות הזן סכום - הוצאות (למשל 5000 - 1200).\n\n"
             "*💰 תשלום מעשרות*\n"
             "סמן תשלומי מעשרות שביצעת. תוכל לשלם את כל היתרה או סכום חלקי.\n\n"
             "*📊 מצב נוכחי*\n"
@@ -674,7 +1101,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "*📖 היסטוריה*\n"
             "צפה בהיסטוריית ההכנסות והתשלומים שלך.\n\n"
             "*⚙️ הגדרות*\n"
-            "• שנה את סוג החישוב (מעשר 10% או חומש 20%)\n"
+            "• שנה את סוג החישוב (מעשר 10%, חומש 20% או אחוז אישי)\n"
             "• בחר את המטבע המועדף (₪, $, €)\n"
             "• מחק את כל המידע שלך מהמערכת\n\n"
             "לחזרה לתפריט הראשי, לחץ על הכפתור למטה."
@@ -696,18 +1123,17 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_income(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle income amount input."""
     try:
-        amount = float(update.message.text.strip())
-        if amount <= 0:
-            raise ValueError("Amount must be positive")
+        amount, deductible = parse_income_amount(update.message.text.strip())
             
-        logger.info(f"User {update.effective_user.id} adding income: {amount}")
+        logger.info("User %s adding income: %s", update.effective_user.id, amount)
         context.user_data['income_amount'] = amount
+        context.user_data['income_deductible'] = deductible
         
         # Delete user's message
         await update.message.delete()
         
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
+        with update_session() as db:
+            user = context.db_user
             
             keyboard = [
                 [
@@ -717,10 +1143,13 @@ async def handle_income(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
+            expenses = f"הוצאות מוכרות: {deductible:.2f} ₪\n" if deductible else ""
+            
             # Update the original message instead of sending a new one
             await context.user_data['original_message'].edit_text(
                 f"💰 הוספת הכנסה\n\n"
-                f"סכום: {amount:.2f} ₪\n\n"
+                f"סכום: {amount:.2f} ₪\n"
+                f"{expenses}\n"
                 "💭 אפשר להוסיף תיאור להכנסה (למשל: 'משכורת', 'בונוס' וכו')\n"
                 "או ללחוץ על 'דלג' כדי להמשיך:",
                 reply_markup=reply_markup
@@ -738,9 +1167,10 @@ async def handle_income(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Update the original message
         await context.user_data['original_message'].edit_text(
-            "❌ אנא הזן מספר חיובי בלבד.\n\n"
+            "❌ אנא הזן מספר חיובי בלבד (הוצאות לא יכולות לעלות על הסכום).\n\n"
             "💰 הוספת הכנסה\n\n"
-            "בבקשה הזן את סכום ההכנסה:",
+            "בבקשה הזן את סכום ההכנסה:\n"
+            "(להפחתת הוצאות מוכרות: סכום - הוצאות, למשל 5000 - 1200)",
             reply_markup=reply_markup
         )
         return TYPING_INCOME
@@ -756,8 +1186,8 @@ async def handle_income_description(update: Update, context: ContextTypes.DEFAUL
         # Delete user's message
         await update.message.delete()
         
-    with SessionLocal() as db:
-        user = get_or_create_user(db, update.effective_user.id if update.effective_user else query.from_user.id)
+    with update_session() as db:
+        user = context.db_user
         amount = context.user_data.get('income_amount')
         
         if not amount:
@@ -769,11 +1199,14 @@ async def handle_income_description(update: Update, context: ContextTypes.DEFAUL
             return CHOOSING
         
         # Add the income with description
-        income = add_income(db, user.id, amount, description=description)
+        income = add_income(db, user.id, amount, description=description,
+                            deductible=context.user_data.pop('income_deductible', 0.0))
         
         message = "✅ ההכנסה נוספה בהצלחה!\n\n"
         message += f"💰 סכום: {amount:.2f} ₪\n"
-        message += f"✨ {user.default_calc_type}: {amount * (0.1 if user.default_calc_type == CalculationType.MAASER.value else 0.2):.2f} ₪"
+        if income.deductible:
+            message += f"🧾 הוצאות מוכרות: {income.deductible:.2f} ₪\n"
+        message += f"✨ {format_calc_type(user)}: {income.obligation_amount:.2f} ₪"
         if description:
             message += f"\n💭 תיאור: {description}"
         
@@ -789,6 +1222,39 @@ async def handle_income_description(update: Update, context: ContextTypes.DEFAUL
         
     return CHOOSING
 
+async def handle_custom_rate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle custom percentage input."""
+    text = update.message.text.strip().rstrip('%')
+    await update.message.delete()
+    
+    keyboard = [
+        [InlineKeyboardButton("חזרה להגדרות", callback_data='settings')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    try:
+        percent = float(text)
+        if not 0 < percent <= 100:
+            raise ValueError("Percentage must be between 0 and 100")
+    except ValueError:
+        await context.user_data['original_message'].edit_text(
+            "❌ אנא הזן מספר בין 0 ל-100.\n\n"
+            "🔄 אחוז אישי\n\n"
+            "הזן את האחוז מההכנסות (למשל 15):",
+            reply_markup=reply_markup
+        )
+        return TYPING_CUSTOM_RATE
+    
+    with update_session() as db:
+        user = context.db_user
+        update_user_settings(db, user.id, default_calc_type=CalculationType.CUSTOM, custom_rate=percent / 100)
+    
+    await context.user_data['original_message'].edit_text(
+        f"✅ סוג החישוב שונה לאחוז אישי ({percent:g}%)",
+        reply_markup=reply_markup
+    )
+    return CHOOSING
+
 async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle payment amount input."""
     try:
@@ -796,13 +1262,13 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if amount <= 0:
             raise ValueError("Amount must be positive")
             
-        logger.info(f"User {update.effective_user.id} adding payment: {amount}")
+        logger.info("User %s adding payment: %s", update.effective_user.id, amount)
         # Delete user's message
         await update.message.delete()
             
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
-            balance = get_user_balance(db, user.id)
+        with update_session() as db:
+            user = context.db_user
+            balance = get_cached_balance(db, user)
             
             if amount > balance['remaining']:
                 keyboard = [
@@ -820,7 +1286,7 @@ async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return TYPING_PAYMENT
             
             payment = add_payment(db, user.id, amount)
-            balance = get_user_balance(db, user.id)
+            balance = get_cached_balance(db, user)
             
             keyboard = [
                 [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
@@ -860,8 +1326,8 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    with SessionLocal() as db:
-        user = get_or_create_user(db, query.from_user.id)
+    with update_session() as db:
+        user = context.db_user
         
         if not user.is_approved:
             # Check if user already has a pending request
@@ -896,6 +1362,7 @@ async def handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("📊 מצב נוכחי", callback_data='status'),
                 InlineKeyboardButton("📖 היסטוריה", callback_data='history')
             ],
+            [InlineKeyboardButton("📅 דוחות חודשיים ושנתיים", callback_data='reports')],
             [
                 InlineKeyboardButton("⚙️ הגדרות", callback_data='settings'),
                 InlineKeyboardButton("❓ עזרה", callback_data='help')
@@ -917,23 +1384,27 @@ async def handle_delete_confirmation(update: Update, context: ContextTypes.DEFAU
         return CHOOSING
         
     if update.message.text.strip() == "מחק את כל המידע שלי":
-        logger.warning(f"User {update.effective_user.id} deleting all their data")
+        logger.warning("User %s deleting all their data", update.effective_user.id)
         # Delete user's confirmation message
         await update.message.delete()
         
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
+        with update_session() as db:
+            user = context.db_user
             try:
-                delete_all_user_data(db, user.id)
+                deleted_at = delete_all_user_data(db, user.id)
+                if not deleted_at:
+                    raise RuntimeError("delete_all_user_data failed")
                 
                 keyboard = [
+                    [undo_button(deleted_at)],
                     [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
                 # Update the original message
                 await context.user_data['delete_message'].edit_text(
-                    "✅ כל המידע שלך נמחק בהצלחה.",
+                    "✅ כל המידע שלך נמחק בהצלחה.\n"
+                    f"ניתן לבטל את המחיקה במשך {UNDO_WINDOW.seconds // 60} דקות.",
                     reply_markup=reply_markup
                 )
             except Exception as e:
@@ -974,6 +1445,31 @@ async def handle_delete_confirmation(update: Update, context: ContextTypes.DEFAU
         
     return CHOOSING
 
+async def handle_undo_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Restore entries deleted by the user, while the undo window is open."""
+    query = update.callback_query
+    try:
+        deleted_at = datetime.strptime(query.data.split('_', 1)[1], UNDO_TOKEN_FORMAT)
+    except ValueError:
+        logger.warning("Invalid undo token %r", query.data)
+        return
+    
+    with update_session() as db:
+        user = context.db_user
+        restored = restore_deleted(db, user.id, deleted_at)
+    
+    if restored:
+        message = "↩️ המחיקה בוטלה, המידע שוחזר."
+    else:
+        message = "❌ לא ניתן לבטל את המחיקה - עבר הזמן או שהמידע כבר שוחזר."
+    
+    keyboard = [
+        [InlineKeyboardButton("📖 היסטוריה", callback_data='history')],
+        [InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
 async def handle_edit_delete_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle edit and delete callbacks for incomes and payments."""
     query = update.callback_query
@@ -984,18 +1480,20 @@ async def handle_edit_delete_callbacks(update: Update, context: ContextTypes.DEF
     item_type = data[1]  # income/payment
     item_id = int(data[2])
     
-    with SessionLocal() as db:
-        user = get_or_create_user(db, query.from_user.id)
+    with update_session() as db:
+        user = context.db_user
         
         if action == 'delete':
             if item_type == 'income':
-                success = delete_income(db, item_id, user.id)
-                message = "✅ ההכנסה נמחקה בהצלחה!" if success else "❌ לא נמצאה ההכנסה המבוקשת"
+                deleted_at = delete_income(db, item_id, user.id)
+                message = "✅ ההכנסה נמחקה בהצלחה!" if deleted_at else "❌ לא נמצאה ההכנסה המבוקשת"
             else:  # payment
-                success = delete_payment(db, item_id, user.id)
-                message = "✅ התשלום נמחק בהצלחה!" if success else "❌ לא נמצא התשלום המבוקש"
+                deleted_at = delete_payment(db, item_id, user.id)
+                message = "✅ התשלום נמחק בהצלחה!" if deleted_at else "❌ לא נמצא התשלום המבוקש"
                 
             keyboard = [[InlineKeyboardButton("חזרה להיסטוריה", callback_data='history')]]
+            if deleted_at:
+                keyboard.insert(0, [undo_button(deleted_at)])
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(message, reply_markup=reply_markup)
             
@@ -1027,7 +1525,7 @@ async def handle_edit_delete_callbacks(update: Update, context: ContextTypes.DEF
                 return EDIT_CHOOSING
             else:  # payment
                 # Check if the new amount would exceed the remaining balance
-                balance = get_user_balance(db, user.id)
+                balance = get_cached_balance(db, user)
                 payment = db.query(Payment).filter(Payment.id == item_id, Payment.user_id == user.id).first()
                 
                 if payment:
@@ -1079,8 +1577,8 @@ async def handle_edit_payment(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return EDIT_PAYMENT
             
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
+        with update_session() as db:
+            user = context.db_user
             payment = edit_payment(db, editing_item['id'], user.id, amount)
             
             if payment:
@@ -1113,95 +1611,238 @@ async def handle_edit_payment(update: Update, context: ContextTypes.DEFAULT_TYPE
         
     return CHOOSING
 
+def render_history_page(db, user, page: int) -> tuple[str, list]:
+    """
+    Render one page of the history screen.
+
+    Returns:
+        tuple: The message text and the keyboard rows as (label, callback data) pairs
+    """
+    # Get all operations sorted by date
+    incomes = db.query(Income).filter(Income.user_id == user.id).order_by(Income.created_at.desc()).all()
+    payments = db.query(Payment).filter(Payment.user_id == user.id).order_by(Payment.created_at.desc()).all()
+    
+    # Combine and sort operations by date
+    operations = []
+    for income in incomes:
+        operations.append(('income', income))
+    for payment in payments:
+        operations.append(('payment', payment))
+    
+    operations.sort(key=lambda x: x[1].created_at, reverse=True)
+    
+    if not operations:
+        return (
+            "📖 היסטוריית פעולות\n"
+            "══════════════════\n\n"
+            "לא נמצאו נתונים בהיסטוריה עדיין.\n"
+            "התחל על ידי הוספת הכנסה! 💪",
+            [[("חזרה לתפריט הראשי", 'main_menu')]]
+        )
+    
+    # Calculate total pages and validate current page
+    total_pages = len(operations)
+    page = min(max(1, page), total_pages)
+    
+    # Get current operation
+    op_type, operation = operations[page - 1]
+    
+    # Build message for current operation
+    message = f"📖 היסטוריית פעולות (פעולה {page} מתוך {total_pages})\n"
+    message += "══════════════════\n\n"
+    
+    if op_type == 'income':
+        message += "*📥 הכנסה*\n"
+        message += "──────────────────\n"
+        message += f"• מאריך: {operation.created_at.strftime('%d/%m/%Y')}\n"
+        message += f"• סכום: {operation.amount:.2f} ₪\n"
+        if operation.deductible:
+            message += f"• הוצאות מוכרות: {operation.deductible:.2f} ₪\n"
+        message += f"• {operation.calc_type} ({operation.rate * 100:g}%): {operation.obligation_amount:.2f} ₪"
+        if operation.description:
+            message += f"\n• תיאור: {operation.description}"
+    else:  # payment
+        message += "*💸 תשלום*\n"
+        message += "──────────────────\n"
+        message += f"• מאריך: {operation.created_at.strftime('%d/%m/%Y')}\n"
+        message += f"• סכום: {operation.amount:.2f} ₪"
+    
+    # Build keyboard with navigation and action buttons
+    keyboard = []
+    
+    # Add edit/delete buttons
+    if op_type == 'income':
+        edit_buttons = [("✏️ עריכת סכום", f'edit_income_amount_{operation.id}')]
+        if operation.description:
+            edit_buttons.append(("✏️ עריכת תיאור", f'edit_income_desc_{operation.id}'))
+        else:
+            edit_buttons.append(("➕ הוספת תיאור", f'edit_income_desc_{operation.id}'))
+        keyboard.append(edit_buttons)
+        keyboard.append([("🗑️ מחיקת הכנסה", f'delete_income_{operation.id}')])
+    else:  # payment
+        keyboard.append([("✏️ עריכת סכום", f'edit_payment_{operation.id}')])
+        keyboard.append([("🗑️ מחיקת תשלום", f'delete_payment_{operation.id}')])
+    
+    # Add navigation buttons
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(("◀️ הקודם", f'history_page_{page-1}'))
+    if page < total_pages:
+        nav_buttons.append(("הבא ▶️", f'history_page_{page+1}'))
+    
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+        
+    keyboard.append([("חזרה לתפריט הראשי", 'main_menu')])
+    
+    return message, keyboard
+
 async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
     """Show history with pagination - one operation at a time."""
     query = update.callback_query
     await query.answer()
     
-    with SessionLocal() as db:
-        user = get_or_create_user(db, query.from_user.id)
-        
-        # Get all operations sorted by date
-        incomes = db.query(Income).filter(Income.user_id == user.id).order_by(Income.created_at.desc()).all()
-        payments = db.query(Payment).filter(Payment.user_id == user.id).order_by(Payment.created_at.desc()).all()
-        
-        # Combine and sort operations by date
-        operations = []
-        for income in incomes:
-            operations.append(('income', income))
-        for payment in payments:
-            operations.append(('payment', payment))
-        
-        operations.sort(key=lambda x: x[1].created_at, reverse=True)
-        
-        if not operations:
-            keyboard = [[InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                "📖 היסטוריית פעולות\n"
-                "══════════════════\n\n"
-                "לא נמצאו נתונים בהיסטוריה עדיין.\n"
-                "התחל על ידי הוספת הכנסה! 💪",
-                reply_markup=reply_markup
-            )
+    user = context.db_user
+    with read_session() as db:
+        # Rendered pages are cached by data version, so any change to the user's data renders them again
+        cache_key = ('history', user.id, user.data_version, page)
+        screen = cache.get(cache_key)
+        if screen is None:
+            screen = render_history_page(db, user, page)
+            cache.set(cache_key, screen)
+    
+    message, rows = screen
+    keyboard = [[InlineKeyboardButton(label, callback_data=data) for label, data in row] for row in rows]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+
+SEARCH_PAGE_SIZE = 5
+
+def render_search_page(db, user, text: str, page: int) -> tuple[str, list]:
+    """
+    Render one page of search results.
+
+    Returns:
+        tuple: The message text and the keyboard rows as (label, callback data) pairs
+    """
+    results = search_incomes(db, user.id, text, page, SEARCH_PAGE_SIZE)
+    if not results['total']:
+        return (
+            f"🔍 לא נמצאו הכנסות שהתיאור שלהן מתאים ל\"{text}\".",
+            [[("חזרה לתפריט הראשי", 'main_menu')]]
+        )
+    
+    page = results['current_page']
+    message = f"🔍 תוצאות עבור \"{text}\" ({results['total']} הכנסות, עמוד {page} מתוך {results['total_pages']})\n"
+    message += "══════════════════\n\n"
+    keyboard = []
+    for number, income in enumerate(results['incomes'], 1):
+        message += f"{number}. {income.created_at.strftime('%d/%m/%Y')} | {income.amount:.2f} ₪ | {income.description}\n"
+        keyboard.append([(f"✏️ עריכת {number}", f'edit_income_{income.id}'),
+                         (f"🗑️ מחיקת {number}", f'delete_income_{income.id}')])
+    
+    nav_buttons = []
+    if page > 1:
+        nav_buttons.append(("◀️ הקודם", f'search_page_{page-1}'))
+    if page < results['total_pages']:
+        nav_buttons.append(("הבא ▶️", f'search_page_{page+1}'))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+        
+    keyboard.append([("חזרה לתפריט הראשי", 'main_menu')])
+    return message, keyboard
+
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
+    """Show a page of the results of the user's last /search."""
+    text = context.user_data.get('search_query')
+    if update.callback_query:
+        await update.callback_query.answer()
+        if not text:
+            await update.callback_query.edit_message_text("🔍 החיפוש פג תוקף. חפש שוב עם /search")
             return
         
-        # Calculate total pages and validate current page
-        total_pages = len(operations)
-        page = min(max(1, page), total_pages)
-        
-        # Get current operation
-        op_type, operation = operations[page - 1]
-        
-        # Build message for current operation
-        message = f"📖 היסטוריית פעולות (פעולה {page} מתוך {total_pages})\n"
-        message += "══════════════════\n\n"
-        
-        if op_type == 'income':
-            calc_amount = operation.amount * 0.1 if operation.calc_type == CalculationType.MAASER.value else operation.amount * 0.2
-            message += "*📥 הכנסה*\n"
-            message += "──────────────────\n"
-            message += f"• מאריך: {operation.created_at.strftime('%d/%m/%Y')}\n"
-            message += f"• סכום: {operation.amount:.2f} ₪\n"
-            message += f"• {operation.calc_type}: {calc_amount:.2f} ₪"
-            if operation.description:
-                message += f"\n• תיאור: {operation.description}"
-        else:  # payment
-            message += "*💸 תשלום*\n"
-            message += "──────────────────\n"
-            message += f"• מאריך: {operation.created_at.strftime('%d/%m/%Y')}\n"
-            message += f"• סכום: {operation.amount:.2f} ₪"
+    user = context.db_user
+    with read_session() as db:
+        message, rows = render_search_page(db, user, text, page)
         
-        # Build keyboard with navigation and action buttons
-        keyboard = []
+    keyboard = [[InlineKeyboardButton(label, callback_data=data) for label, data in row] for row in rows]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message, reply_markup=reply_markup)
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /search command - find incomes by words of their description."""
+    if not await check_user_permission(update, context):
+        await update.message.reply_text("⚠️ אין לך הרשאה להשתמש בבוט.")
+        return ConversationHandler.END
+        
+    text = ' '.join(context.args or []).strip()
+    if not text:
+        await update.message.reply_text("🔍 שימוש: /search מילים מתיאור ההכנסה\nלמשל: /search בונוס מרץ")
+        return CHOOSING
         
-        # Add edit/delete buttons
-        if op_type == 'income':
-            edit_buttons = [InlineKeyboardButton("✏️ עריכת סכום", callback_data=f'edit_income_amount_{operation.id}')]
-            if operation.description:
-                edit_buttons.append(InlineKeyboardButton("✏️ עריכת תיאור", callback_data=f'edit_income_desc_{operation.id}'))
+    context.user_data['search_query'] = text
+    await show_search_results(update, context)
+    # The result buttons are handled in the main menu state
+    return CHOOSING
+
+def format_report_row(row: dict) -> str:
+    """Format the totals of a single report period."""
+    text = f"💵 הכנסות: {row['income']:.2f} ₪\n"
+    for calc_type, amount in sorted(row['obligation'].items()):
+        text += f"✨ {calc_type}: {amount:.2f} ₪\n"
+    text += f"💸 שולם: {row['paid']:.2f} ₪\n"
+    text += f"📌 יתרה בסוף התקופה: {row['closing']:.2f} ₪"
+    return text
+
+async def show_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the yearly overview, the months of a year, or a single month."""
+    query = update.callback_query
+    parts = query.data.split('_')
+    
+    user = context.db_user
+    with read_session() as db:
+        if query.data == 'reports':
+            rows = get_years_report(db, user.id)
+            message = "📅 דוח שנתי\n══════════════════\n\n"
+            keyboard = []
+            for row in reversed(rows):
+                message += f"*{row['period']}*\n{format_report_row(row)}\n──────────────────\n"
+                keyboard.append([InlineKeyboardButton(f"📆 פירוט חודשי {row['period']}", callback_data=f"report_year_{row['period']}")])
+            if not rows:
+                message += "לא נמצאו נתונים עדיין.\nהתחל על ידי הוספת הכנסה! 💪"
+            keyboard.append([InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')])
+            
+        elif parts[1] == 'year':
+            year = int(parts[2])
+            rows = get_months_report(db, user.id, year)
+            opening = rows[0]['opening'] if rows else 0.0
+            message = f"📆 דוח חודשי {year}\n══════════════════\n\n"
+            message += f"↪️ יתרה מהשנים הקודמות: {opening:.2f} ₪\n\n"
+            for row in rows:
+                owed = sum(row['obligation'].values())
+                message += f"*{row['period']:02d}/{year}*: הכנסות {row['income']:.2f} ₪ | חובה {owed:.2f} ₪ | שולם {row['paid']:.2f} ₪\n"
+            months = [
+                InlineKeyboardButton(f"{row['period']:02d}", callback_data=f"report_month_{year}_{row['period']}")
+                for row in rows
+            ]
+            keyboard = [months[i:i + 6] for i in range(0, len(months), 6)]
+            keyboard.append([InlineKeyboardButton("חזרה לדוח השנתי", callback_data='reports')])
+            
+        else:  # month
+            year, month = int(parts[2]), int(parts[3])
+            row = get_month_report(db, user.id, year, month)
+            message = f"📆 דוח חודש {month:02d}/{year}\n══════════════════\n\n"
+            if row:
+                message += f"↪️ יתרה מהתקופה הקודמת: {row['opening']:.2f} ₪\n{format_report_row(row)}"
             else:
-                edit_buttons.append(InlineKeyboardButton("➕ הוספת תיאור", callback_data=f'edit_income_desc_{operation.id}'))
-            keyboard.append(edit_buttons)
-            keyboard.append([InlineKeyboardButton("🗑️ מחיקת הכנסה", callback_data=f'delete_income_{operation.id}')])
-        else:  # payment
-            keyboard.append([InlineKeyboardButton("✏️ עריכת סכום", callback_data=f'edit_payment_{operation.id}')])
-            keyboard.append([InlineKeyboardButton("🗑️ מחיקת תשלום", callback_data=f'delete_payment_{operation.id}')])
-        
-        # Add navigation buttons
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton("◀️ הקודם", callback_data=f'history_page_{page-1}'))
-        if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton("הבא ▶️", callback_data=f'history_page_{page+1}'))
-        
-        if nav_buttons:
-            keyboard.append(nav_buttons)
+                message += "אין נתונים לחודש זה."
+            keyboard = [[InlineKeyboardButton(f"חזרה לדוח {year}", callback_data=f'report_year_{year}')]]
             
-        keyboard.append([InlineKeyboardButton("חזרה לתפריט הראשי", callback_data='main_menu')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_select_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle selection of edit/delete action."""
@@ -1233,8 +1874,8 @@ async def handle_selected_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.delete()
         
         # Check if it's an income or payment
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
+        with update_session() as db:
+            user = context.db_user
             income = db.query(Income).filter(Income.id == item_id, Income.user_id == user.id).first()
             payment = None if income else db.query(Payment).filter(Payment.id == item_id, Payment.user_id == user.id).first()
             
@@ -1331,24 +1972,20 @@ async def handle_edit_income(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Delete user's message
         await update.message.delete()
         
-        with SessionLocal() as db:
-            user = get_or_create_user(db, update.effective_user.id)
+        with update_session() as db:
+            user = context.db_user
             income_id = context.user_data.get('editing_income_id')
             
             if not income_id:
                 await context.user_data['original_message'].edit_text("❌ אירעה שגיאה. נסה שוב.")
                 return CHOOSING
             
-            income = db.query(Income).filter(Income.id == income_id, Income.user_id == user.id).first()
+            # Update the income amount
+            income = edit_income(db, income_id, user.id, amount=amount)
             if not income:
                 await context.user_data['original_message'].edit_text("❌ ההכנסה לא נמצאה.")
                 return CHOOSING
             
-            # Update the income amount
-            income.amount = amount
-            db.commit()
-            logger.info(f"הכנסה {income_id} עודכנה בהצלחה")
-            
             message = f"✅ ההכנסה עודכנה בהצלחה לסכום {amount:.2f} ₪"
             keyboard = [
                 [InlineKeyboardButton("חזרה להיסטוריה", callback_data='history')],
@@ -1384,24 +2021,20 @@ async def handle_edit_income_description(update: Update, context: ContextTypes.D
     # Delete user's message
     await update.message.delete()
     
-    with SessionLocal() as db:
-        user = get_or_create_user(db, update.effective_user.id)
+    with update_session() as db:
+        user = context.db_user
         income_id = context.user_data.get('editing_income_id')
         
         if not income_id:
             await context.user_data['original_message'].edit_text("❌ אירעה שגיאה. נסה שוב.")
             return CHOOSING
         
-        income = db.query(Income).filter(Income.id == income_id, Income.user_id == user.id).first()
+        # Update the income description
+        income = edit_income(db, income_id, user.id, description=description)
         if not income:
             await context.user_data['original_message'].edit_text("❌ ההכנסה לא נמצאה.")
             return CHOOSING
         
-        # Update the income description
-        income.description = description
-        db.commit()
-        logger.info(f"תיאור הכנסה {income_id} עודכן בהצלחה")
-        
         message = "✅ תיאור ההכנסה עודכן בהצלחה"
         keyboard = [
             [InlineKeyboardButton("חזרה להיסטוריה", callback_data='history')],
@@ -1413,21 +2046,105 @@ async def handle_edit_income_description(update: Update, context: ContextTypes.D
         
     return CHOOSING
 
+async def post_init(application: Application) -> None:
+    """Start background services once the application is initialized."""
+    settings = get_settings()
+    guard = IdempotencyGuard(
+        update_ttl=settings.dedup_update_ttl,
+        callback_ttl=settings.dedup_callback_ttl,
+        path=settings.dedup_state_file
+    )
+    guard.load()
+    application.bot_data[IDEMPOTENCY_KEY] = guard
+    application.bot_data[FLOOD_GUARD_KEY] = FloodGuard(rate=settings.flood_rate, burst=settings.flood_burst)
+    
+    # Created in main(), since the bot's rate limiter sends through it as well
+    await application.bot_data[SEND_QUEUE_KEY].start()
+    
+    metrics.register_gauge('cache.hit_ratio', cache.hit_ratio)
+    
+    # Continue broadcasts interrupted by the previous shutdown
+    resume_broadcasts(application)
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background services, sending whatever is still queued."""
+    await stop_broadcasts(application)
+    send_queue = application.bot_data.pop(SEND_QUEUE_KEY, None)
+    if send_queue:
+        await send_queue.stop()
+    shutdown_executor()
+    
+    guard = application.bot_data.get(IDEMPOTENCY_KEY)
+    if guard:
+        guard.save()
+    
+    # Counters live in memory only - keep the final values in the log
+    logger.info("Final metrics: %s", metrics.snapshot())
+    cache.close()
+    dispose_engine()
+    shutdown_logging()
+
 def main():
     """Start the bot."""
+    settings = get_settings()
+
+    # Enable logging
+    setup_logging()
+
+    # Refuse to start against a database that needs an upgrade
+    check_schema()
+    
+    profiler.keep = settings.profile_keep
+    if settings.profile_every or settings.profile_user_id:
+        profiler.configure(every=settings.profile_every, user_id=settings.profile_user_id)
+    
+    if settings.db_raiseload:
+        logger.warning("DB_RAISELOAD is on: lazy relationship loads will raise")
+        enable_raiseload()
+
+    send_queue = SendQueue(
+        global_rate=settings.send_global_rate,
+        per_chat_rate=settings.send_chat_rate
+    )
+
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(settings.bot_token)
+        .rate_limiter(SendQueueRateLimiter(send_queue))
+        .concurrent_updates(DrainingUpdateProcessor())
+        .context_types(ContextTypes(context=BotContext))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.bot_data[SEND_QUEUE_KEY] = send_queue
     
     # Add error handler
     application.add_error_handler(error_handler)
     
+    # Drop floods from a single user before anything else runs
+    application.add_handler(TypeHandler(Update, throttle_floods), group=-3)
+    # Remember whose update is handled, so their reads see their own writes
+    application.add_handler(TypeHandler(Update, remember_current_user), group=-2)
+    # Drop duplicate deliveries and double taps before any other handler runs
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
+    
     # Add admin commands
     application.add_handler(CommandHandler("approve_request", approve_request_command))
     application.add_handler(CommandHandler("reject_request", reject_request_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast_command))
+    application.add_handler(CommandHandler("chart", chart_command))
+    application.add_handler(CommandHandler("recurring", recurring_command))
+    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(ChosenInlineResultHandler(inline_result_chosen))
+    application.add_handler(CommandHandler("slow_queries", slow_queries_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     
     # Add conversation handler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', start), CommandHandler('search', search_command)],
         states={
             CHOOSING: [
                 CallbackQueryHandler(handle_main_menu, pattern='^main_menu$'),
@@ -1460,6 +2177,11 @@ def main():
                 CallbackQueryHandler(handle_income_description, pattern='^skip_description$'),
                 CallbackQueryHandler(handle_main_menu, pattern='^main_menu$')
             ],
+            TYPING_CUSTOM_RATE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_rate),
+                CallbackQueryHandler(handle_main_menu, pattern='^main_menu$'),
+                CallbackQueryHandler(button)
+            ],
             TYPING_PAYMENT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_payment),
                 CallbackQueryHandler(handle_main_menu, pattern='^main_menu$')
@@ -1491,43 +2213,68 @@ def main():
                 CallbackQueryHandler(button)
             ]
         },
-        fallbacks=[CommandHandler('start', start)],
+        fallbacks=[CommandHandler('start', start), CommandHandler('search', search_command)],
         per_message=False
     )
     
     application.add_handler(conv_handler)
     
+    # Schedule balance reminders
+    if application.job_queue:
+        application.job_queue.run_repeating(
+            send_balance_reminders,
+            interval=timedelta(minutes=settings.reminder_check_minutes),
+            first=timedelta(minutes=1),
+            name='balance_reminders'
+        )
+        application.job_queue.run_repeating(
+            compact_deleted_rows,
+            interval=timedelta(minutes=settings.compaction_minutes),
+            first=timedelta(minutes=5),
+            name='compact_deleted_rows'
+        )
+        application.job_queue.run_repeating(
+            add_recurring_entries,
+            interval=timedelta(minutes=settings.recurring_minutes),
+            first=timedelta(minutes=2),
+            name='add_recurring_entries'
+        )
+        application.job_queue.run_repeating(
+            maintain_history_storage,
+            interval=timedelta(days=1),
+            first=timedelta(minutes=10),
+            name='maintain_history_storage'
+        )
+    else:
+        logger.warning("JobQueue not available - balance reminders are disabled")
+    
     # Check if webhook URL is set
-    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_url = settings.webhook_url
     
     if webhook_url:
-        # Get port and webhook settings from environment variables
-        port = int(os.getenv("PORT", "10000"))
-        webhook_secret = os.getenv("WEBHOOK_SECRET", "your-secret-token")
-        
         # Extract path from webhook URL
         from urllib.parse import urlparse
         webhook_path = urlparse(webhook_url).path or "/webhook"
         
-        logger.info(f"Starting webhook on port {port} with path {webhook_path}")
+        logger.info("Starting webhook on port %s with path %s", settings.port, webhook_path)
         
-        # Delete existing webhook before setting a new one
-        application.bot.delete_webhook()
-        
-        # Start the webhook
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            webhook_url=webhook_url,
-            secret_token=webhook_secret,
-            url_path=webhook_path,
-            allowed_updates=["message", "callback_query"],
-            drop_pending_updates=True
-        )
+        # Our own server, so the load balancer can reach /healthz and /readyz on the same port
+        from maaserbot.webhook import serve
+        asyncio.run(serve(application, settings, webhook_path))
     else:
         # Run the bot in polling mode
         logger.info("Starting bot in polling mode")
-        application.run_polling(allowed_updates=["message", "callback_query"])
+        
+        async def start_polling():
+            await application.updater.start_polling(
+                allowed_updates=ALLOWED_UPDATES, drop_pending_updates=settings.drop_pending_updates
+            )
+        
+        async def stop_polling():
+            if application.updater.running:
+                await application.updater.stop()
+        
+        asyncio.run(run_application(application, start_polling, stop_polling, settings.shutdown_timeout))
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""Settings for MaaserBot, loaded once from the environment (and .env)."""
+
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from dotenv import load_dotenv
+
+def _database_url(url: Optional[str]) -> str:
+    if not url:
+        # Fallback to SQLite if no DATABASE_URL is provided
+        return "sqlite:///maaser.db"
+    # Render.com's PostgreSQL URLs use postgres://, SQLAlchemy needs postgresql://
+    return url.replace("postgres://", "postgresql://", 1)
+
+@dataclass(frozen=True)
+class Settings:
+    """Bot configuration. See .env.example for the matching environment variables."""
+
+    bot_token: Optional[str] = None
+    admin_id: int = 0
+    database_url: str = "sqlite:///maaser.db"
+
+    # Optional read replica for read-only screens, and the replication lag (seconds) it may have
+    database_read_url: Optional[str] = None
+    replica_max_lag: float = 5
+
+    # Webhook mode is used when webhook_url is set, polling otherwise
+    webhook_url: Optional[str] = None
+    webhook_secret: str = "your-secret-token"
+    port: int = 10000
+    # Discard the updates Telegram queued while the bot was down, instead of handling them
+    drop_pending_updates: bool = False
+
+    # Outbound message rate limits (messages per second)
+    send_global_rate: float = 25
+    send_chat_rate: float = 1
+
+    # Balance reminders
+    reminder_check_minutes: float = 60
+    reminder_repeat_days: float = 7
+
+    # Purging of deleted entries once they can no longer be undone
+    compaction_minutes: float = 60
+
+    # Minutes between runs of the job adding due recurring incomes and payments
+    recurring_minutes: float = 60
+
+    # Years kept in the live tables, the current one included; older ones are archived. 0 = off
+    archive_keep_years: int = 0
+
+    # Shared cache (redis://...) for multi-process deployments; in-process when unset
+    cache_url: Optional[str] = None
+
+    # Flood protection: updates per second each user may send, and how many at once
+    flood_rate: float = 2
+    flood_burst: float = 10
+
+    # Duplicate update protection (seconds)
+    dedup_update_ttl: float = 600
+    dedup_callback_ttl: float = 10
+    dedup_state_file: Optional[str] = None
+
+    chart_workers: int = 1
+
+    # Seconds Telegram may reuse a user's inline results (they show the balance)
+    inline_cache_seconds: int = 10
+
+    # Statements slower than this (milliseconds) are logged (0 = off)
+    slow_query_ms: float = 200
+    # Updates running more SQL statements than this are logged (0 = off)
+    query_warn_threshold: int = 15
+    # Development: make lazy relationship loads raise, to catch N+1 queries
+    db_raiseload: bool = False
+
+    # Update profiling: one in N updates (0 = off) and/or every update of one user,
+    # keeping the slowest profile_keep profiles for /profile dump
+    profile_every: int = 0
+    profile_user_id: Optional[int] = None
+    profile_keep: int = 10
+    profile_dir: str = "profiles"
+
+    # Logging: level, 'json' or 'text' lines, file (empty for stderr only) and
+    # per-logger sampling of INFO records, e.g. "httpx=0.05,maaserbot.utils.db=0.2"
+    log_level: str = "INFO"
+    log_format: str = "json"
+    log_file: str = "bot.log"
+    log_sample: str = "httpx=0.05"
+
+    # Seconds to wait for in-flight updates on shutdown
+    shutdown_timeout: float = 20
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """Build settings from environment variables, after loading .env."""
+        load_dotenv()
+        env = os.environ
+        return cls(
+            bot_token=env.get("BOT_TOKEN"),
+            admin_id=int(env.get("ADMIN_ID", "0")),
+            database_url=_database_url(env.get("DATABASE_URL")),
+            database_read_url=_database_url(env.get("DATABASE_READ_URL")) if env.get("DATABASE_READ_URL") else None,
+            replica_max_lag=float(env.get("REPLICA_MAX_LAG", "5")),
+            webhook_url=env.get("WEBHOOK_URL") or None,
+            webhook_secret=env.get("WEBHOOK_SECRET", "your-secret-token"),
+            port=int(env.get("PORT", "10000")),
+            drop_pending_updates=env.get("DROP_PENDING_UPDATES", "").lower() in ("1", "true", "yes"),
+            send_global_rate=float(env.get("SEND_GLOBAL_RATE", "25")),
+            send_chat_rate=float(env.get("SEND_CHAT_RATE", "1")),
+            reminder_check_minutes=float(env.get("REMINDER_CHECK_MINUTES", "60")),
+            reminder_repeat_days=float(env.get("REMINDER_REPEAT_DAYS", "7")),
+            compaction_minutes=float(env.get("COMPACTION_MINUTES", "60")),
+            recurring_minutes=float(env.get("RECURRING_MINUTES", "60")),
+            archive_keep_years=int(env.get("ARCHIVE_KEEP_YEARS", "0")),
+            cache_url=env.get("CACHE_URL") or None,
+            flood_rate=float(env.get("FLOOD_RATE", "2")),
+            flood_burst=float(env.get("FLOOD_BURST", "10")),
+            dedup_update_ttl=float(env.get("DEDUP_UPDATE_TTL", "600")),
+            dedup_callback_ttl=float(env.get("DEDUP_CALLBACK_TTL", "10")),
+            dedup_state_file=env.get("DEDUP_STATE_FILE") or None,
+            chart_workers=int(env.get("CHART_WORKERS", "1")),
+            inline_cache_seconds=int(env.get("INLINE_CACHE_SECONDS", "10")),
+            slow_query_ms=float(env.get("SLOW_QUERY_MS", "200")),
+            query_warn_threshold=int(env.get("QUERY_WARN_THRESHOLD", "15")),
+            db_raiseload=env.get("DB_RAISELOAD", "").lower() in ("1", "true", "yes"),
+            profile_every=int(env.get("PROFILE_EVERY", "0")),
+            profile_user_id=int(env["PROFILE_USER_ID"]) if env.get("PROFILE_USER_ID") else None,
+            profile_keep=int(env.get("PROFILE_KEEP", "10")),
+            profile_dir=env.get("PROFILE_DIR", "profiles"),
+            log_level=env.get("LOG_LEVEL", "INFO"),
+            log_format=env.get("LOG_FORMAT", "json"),
+            log_file=env.get("LOG_FILE", "bot.log"),
+            log_sample=env.get("LOG_SAMPLE", "httpx=0.05"),
+            shutdown_timeout=float(env.get("SHUTDOWN_TIMEOUT", "20")),
+        )
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Get the process-wide settings, loading them on first use."""
+    return Settings.from_env()
@@ -8,6 +8,7 @@ from maaserbot.utils.db import approve_access_request, reject_access_request
 from maaserbot.models.models import AccessRequest
 from maaserbot.utils.logging_utils import log_admin_action
 from maaserbot.utils.errors import wrap_errors, AuthorizationError
+from maaserbot.utils.send_queue import notify
 
 # הגדרת לוגר
 logger = logging.getLogger(__name__)
@@ -38,15 +39,13 @@ async def approve_request_command(update: Update, context: ContextTypes.DEFAULT_
             # Get the request to get the user's telegram_id
             request = db.query(AccessRequest).filter(AccessRequest.id == request_id).first()
             if request:
-                # Send message to the approved user
-                try:
-                    await context.bot.send_message(
-                        chat_id=request.telegram_id,
-                        text="✅ בקשת הגישה שלך לבוט אושרה!\n"
-                             "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send approval message to user {request.telegram_id}: {str(e)}")
+                # Queue the message to the approved user so a burst of approvals respects flood limits
+                notify(
+                    context,
+                    request.telegram_id,
+                    "✅ בקשת הגישה שלך לבוט אושרה!\n"
+                    "אתה יכול להתחיל להשתמש בבוט על ידי לחיצה על /start"
+                )
             
             await update.message.reply_text(f"✅ בקשת גישה {request_id} אושרה בהצלחה")
         else:
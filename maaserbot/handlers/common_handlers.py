@@ -5,7 +5,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.error import Conflict, TelegramError
 from maaserbot.models import SessionLocal
-from maaserbot.utils.db import get_or_create_user
+from maaserbot.utils.db import get_user_permissions
 from maaserbot.utils.errors import MaaserBotError, AuthorizationError, send_error_message
 
 # הגדרת לוגר
@@ -63,11 +63,11 @@ async def check_user_permission(update: Update, context: ContextTypes.DEFAULT_TY
         AuthorizationError: If the user is not approved
     """
     with SessionLocal() as db:
-        user = get_or_create_user(db, update.effective_user.id)
-        if not user.is_approved:
-            logger.warning(f"Unauthorized access attempt by user {update.effective_user.id}")
-            raise AuthorizationError(
-                f"User {update.effective_user.id} attempted to access without approval",
-                "אין לך הרשאה להשתמש בבוט. אנא בקש גישה מהמנהל."
-            )
-        return True 
\ No newline at end of file
+        permissions = get_user_permissions(db, update.effective_user.id)
+    if not permissions['is_approved']:
+        logger.warning("Unauthorized access attempt by user %s", update.effective_user.id)
+        raise AuthorizationError(
+            f"User {update.effective_user.id} attempted to access without approval",
+            "אין לך הרשאה להשתמש בבוט. אנא בקש גישה מהמנהל."
+        )
+    return True 
\ No newline at end of file
@@ -1,8 +1,6 @@
 """User management handlers for MaaserBot."""
 
 import logging
-import os
-from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, ConversationHandler
 from maaserbot.models import SessionLocal
@@ -11,10 +9,9 @@ from maaserbot.utils.db import (
     create_access_request
 )
 from maaserbot.models.models import AccessRequest
+from maaserbot.config import get_settings
 
-# Load environment variables
-load_dotenv()
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # Default to 0 if not set
+ADMIN_ID = get_settings().admin_id
 
 # הגדרת לוגר
 logger = logging.getLogger(__name__)
@@ -33,7 +30,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Returns:
         int: The next conversation state
     """
-    logger.info(f"User {update.effective_user.id} started the bot")
+    logger.info("User %s started the bot", update.effective_user.id)
     with SessionLocal() as db:
         user = get_or_create_user(db, update.effective_user.id)
         
@@ -151,7 +148,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "אנא נסה שוב מאוחר יותר."
                 )
     except Exception as e:
-        logger.error(f"Error in request_access: {str(e)}")
+        logger.error("Error in request_access: %s", e)
         await query.edit_message_text(
             "❌ אירעה שגיאה בשליחת בקשת הגישה.\n"
             "אנא נסה שוב מאוחר יותר."
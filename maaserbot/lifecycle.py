@@ -0,0 +1,140 @@
+"""Startup and graceful shutdown for MaaserBot.
+
+Shutdown order on SIGINT/SIGTERM:
+
+1. Stop accepting updates (stop polling / close the webhook server).
+2. Let queued and in-flight updates finish, up to a deadline. Handlers still
+   running at the deadline are cancelled, so their transactions roll back
+   instead of the process being killed mid-commit.
+3. Stop the application and run post_stop / post_shutdown, which flush the
+   send queue, persisted state and logs and dispose the database pool.
+"""
+
+import asyncio
+import logging
+import signal
+from typing import Awaitable, Callable
+
+from telegram.ext import Application, SimpleUpdateProcessor
+
+from maaserbot.utils.profiling import profiler
+from maaserbot.utils.querycount import count_update_queries
+from maaserbot.utils.unit_of_work import run_in_unit_of_work
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Update types the bot asks Telegram for, in polling and webhook mode
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query", "chosen_inline_result"]
+
+class DrainingUpdateProcessor(SimpleUpdateProcessor):
+    """Update processor that knows which updates are in flight and can abort them.
+
+    Each update runs in its own database unit of work (see maaserbot.utils.unit_of_work).
+    It also counts the SQL statements each update runs (see maaserbot.utils.querycount)
+    and profiles sampled updates (see maaserbot.utils.profiling).
+    """
+
+    def __init__(self, max_concurrent_updates: int = 1):
+        super().__init__(max_concurrent_updates)
+        self._in_flight: set[asyncio.Task] = set()
+        self._aborting = False
+
+    @property
+    def in_flight(self) -> int:
+        """Number of updates being handled right now."""
+        return len(self._in_flight)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        # Own task per update, so abort() can cancel it without cancelling the update fetcher
+        handling = run_in_unit_of_work(update, coroutine)
+        task = asyncio.ensure_future(count_update_queries(update, profiler.wrap(update, handling)))
+        self._in_flight.add(task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not (self._aborting and task.cancelled()):
+                raise
+        finally:
+            self._in_flight.discard(task)
+
+    def abort(self) -> int:
+        """
+        Cancel all in-flight updates.
+
+        Returns:
+            int: The number of cancelled updates
+        """
+        self._aborting = True
+        for task in self._in_flight:
+            task.cancel()
+        return len(self._in_flight)
+
+async def drain_updates(application: Application, timeout: float) -> bool:
+    """
+    Wait for queued and in-flight updates to be handled.
+
+    Args:
+        application: The running application, no longer receiving updates
+        timeout: Seconds to wait before dropping what is left
+
+    Returns:
+        bool: True if everything was handled in time
+    """
+    queue = application.update_queue
+    try:
+        await asyncio.wait_for(queue.join(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        pass
+
+    dropped = 0
+    while not queue.empty():
+        queue.get_nowait()
+        queue.task_done()
+        dropped += 1
+    processor = application.update_processor
+    cancelled = processor.abort() if isinstance(processor, DrainingUpdateProcessor) else 0
+    logger.warning(
+        "Shutdown deadline of %ss reached: cancelled %s in-flight and dropped %s queued updates",
+        timeout, cancelled, dropped
+    )
+    return False
+
+async def run_application(application: Application,
+                          start_intake: Callable[[], Awaitable],
+                          stop_intake: Callable[[], Awaitable],
+                          drain_timeout: float) -> None:
+    """
+    Run the application until SIGINT/SIGTERM, then shut down gracefully.
+
+    Args:
+        application: The application to run
+        start_intake: Starts receiving updates (polling or the webhook server)
+        stop_intake: Stops receiving updates; must be safe to call if start_intake failed
+        drain_timeout: Seconds to wait for pending updates on shutdown
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await start_intake()
+        await stop.wait()
+        logger.info("Shutting down")
+    finally:
+        await stop_intake()
+        if application.running:
+            await drain_updates(application, drain_timeout)
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logger.info("Shutdown complete")
@@ -1,5 +1,10 @@
-from .base import Base, engine, SessionLocal
-from .models import User, Income, Payment, CalculationType
+from .base import Base, SessionLocal, get_engine, dispose_engine
+from .models import User, Income, Payment, CalculationType, Broadcast
+from .schema import SchemaVersion, check_schema
+from . import routing
 
-# Create all tables
-Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+def __getattr__(name):
+    # The engine is created on first use rather than at import
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,20 @@
+"""Database commands: python -m maaserbot.models [init | upgrade | version | rebuild [workers] | partitions [convert | status]].
+
+rebuild recomputes the monthly totals (see maaserbot.models.rollup) and
+partitions converts incomes and payments to yearly partitions on PostgreSQL
+(see maaserbot.models.partitions). The
+package imports these modules, so running one of them itself with -m would
+define its tables and event listeners a second time.
+"""
+
+import sys
+
+from maaserbot.models import partitions, rollup, schema
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['rebuild']:
+        rollup.main(sys.argv[1:])
+    elif sys.argv[1:2] == ['partitions']:
+        partitions.main(sys.argv[2:])
+    else:
+        schema.main()
@@ -1,31 +1,71 @@
-from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# Get database URL from environment variable
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-# If using Render.com's PostgreSQL, fix the URL format
-if DATABASE_URL:
-    # Replace postgres:// with postgresql:// for psycopg2
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-else:
-    # Fallback to SQLite if no DATABASE_URL is provided
-    DATABASE_URL = "sqlite:///maaser.db"
-
-# Create engine with appropriate settings
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    pool_recycle=1800
-)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-Base = declarative_base() 
\ No newline at end of file
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, declarative_base
+from maaserbot.config import get_settings
+
+_engine: Engine = None
+_read_engine: Engine = None
+
+def _create_engine(url: str) -> Engine:
+    # Create engine with appropriate settings
+    return create_engine(
+        url,
+        pool_size=5,
+        max_overflow=10,
+        pool_timeout=30,
+        pool_recycle=1800
+    )
+
+def get_engine() -> Engine:
+    """Get the database engine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        _engine = _create_engine(get_settings().database_url)
+    return _engine
+
+def has_read_replica() -> bool:
+    """Check whether a read replica is configured (DATABASE_READ_URL)."""
+    return get_settings().database_read_url is not None
+
+def get_read_engine() -> Engine:
+    """Get the read replica engine, or the primary engine when no replica is configured."""
+    global _read_engine
+    if not has_read_replica():
+        return get_engine()
+    if _read_engine is None:
+        _read_engine = _create_engine(get_settings().database_read_url)
+    return _read_engine
+
+def dispose_engine() -> None:
+    """Close all pooled connections (on shutdown)."""
+    global _engine, _read_engine
+    for engine in (_engine, _read_engine):
+        if engine is not None:
+            engine.dispose()
+    _engine = None
+    _read_engine = None
+
+class LazySessionMaker(sessionmaker):
+    """sessionmaker that binds to the engine when the first session is opened."""
+
+    def __init__(self, get_bind=get_engine, **kw):
+        super().__init__(**kw)
+        self._get_bind = get_bind
+
+    def __call__(self, **local_kw):
+        if self.kw.get('bind') is None and local_kw.get('bind') is None:
+            self.configure(bind=self._get_bind())
+        return super().__call__(**local_kw)
+
+SessionLocal = LazySessionMaker(autocommit=False, autoflush=False)
+
+# Sessions on the read replica - use maaserbot.utils.unit_of_work.read_session rather than this directly
+ReadSessionLocal = LazySessionMaker(get_read_engine, autocommit=False, autoflush=False)
+
+Base = declarative_base()
+
+def __getattr__(name):
+    # `engine` used to be created at import time; keep it importable without that cost
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, BigInteger, ForeignKey, Float, Enum
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, BigInteger, ForeignKey, Float, Enum, Index, event, text
+from sqlalchemy.orm import relationship, Session, with_loader_criteria
 from datetime import datetime
 import enum
 from .base import Base
@@ -7,6 +7,51 @@ from .base import Base
 class CalculationType(str, enum.Enum):
     MAASER = "מעשר"
     CHOMESH = "חומש"
+    CUSTOM = "אחוז אישי"  # the user's own custom_rate
+
+# Share of the income owed for each calculation type
+CALCULATION_RATES = {
+    CalculationType.MAASER.value: 0.1,
+    CalculationType.CHOMESH.value: 0.2,
+}
+
+def calculation_rate(calc_type: str, custom_rate: float = None) -> float:
+    """
+    Get the share of the income owed for a calculation type.
+
+    Args:
+        calc_type: The calculation type value
+        custom_rate: The user's custom rate, used for CalculationType.CUSTOM
+
+    Returns:
+        float: The rate (e.g. 0.1 for maaser)
+    """
+    if calc_type == CalculationType.CUSTOM.value and custom_rate is not None:
+        return custom_rate
+    if calc_type == CalculationType.MAASER.value:
+        return CALCULATION_RATES[CalculationType.MAASER.value]
+    return CALCULATION_RATES[CalculationType.CHOMESH.value]
+
+def obligation_for(amount: float, rate: float, deductible: float = 0.0) -> float:
+    """Amount owed on an income after deductible expenses."""
+    return max(amount - (deductible or 0.0), 0.0) * rate
+
+class SoftDeleteMixin:
+    """
+    Rows are tombstoned by setting deleted_at and purged later by the compaction job.
+
+    ORM queries skip tombstones automatically (see _exclude_deleted); pass
+    execution_options(include_deleted=True) to see them.
+    """
+    deleted_at = Column(DateTime, nullable=True)
+
+def live_and_tombstone_indexes(table: str) -> tuple:
+    """Partial indexes: live rows by user and date for reads, tombstones by age for compaction."""
+    live, tombstone = text('deleted_at IS NULL'), text('deleted_at IS NOT NULL')
+    return (
+        Index(f'ix_{table}_live', 'user_id', 'created_at', sqlite_where=live, postgresql_where=live),
+        Index(f'ix_{table}_tombstones', 'deleted_at', sqlite_where=tombstone, postgresql_where=tombstone),
+    )
 
 class AccessRequest(Base):
     """Model for access requests."""
@@ -34,29 +79,136 @@ class User(Base):
     default_calc_type = Column(String, default=CalculationType.MAASER.value)
     is_approved = Column(Boolean, default=False)
     is_admin = Column(Boolean, default=False)
+    custom_rate = Column(Float, nullable=True)  # used when default_calc_type is CUSTOM
+    reminder_threshold = Column(Float, nullable=True)  # remind when the balance exceeds this; None = off
+    last_reminded_at = Column(DateTime, nullable=True)
+    data_version = Column(Integer, default=0, nullable=False)  # bumped on every income/payment change
     created_at = Column(DateTime, default=datetime.utcnow)
     
     incomes = relationship("Income", back_populates="user", cascade="all, delete-orphan")
     payments = relationship("Payment", back_populates="user", cascade="all, delete-orphan")
 
-class Income(Base):
+class Income(SoftDeleteMixin, Base):
     __tablename__ = "incomes"
+    __table_args__ = live_and_tombstone_indexes("incomes")
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     amount = Column(Float, nullable=False)
     description = Column(String, nullable=True)
     calc_type = Column(String, default=CalculationType.MAASER.value)
+    rate = Column(Float, nullable=False)  # share owed, fixed when the income is written
+    deductible = Column(Float, default=0.0, nullable=False)  # expenses not subject to maaser
+    obligation_amount = Column(Float, nullable=False)  # (amount - deductible) * rate
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="incomes")
 
-class Payment(Base):
+@event.listens_for(Income, 'before_insert')
+@event.listens_for(Income, 'before_update')
+def _store_obligation(mapper, connection, income: Income) -> None:
+    """Keep the stored obligation in line with amount, rate and deductible."""
+    if income.calc_type is None:
+        income.calc_type = CalculationType.MAASER.value
+    if income.rate is None:
+        income.rate = calculation_rate(income.calc_type)
+    if income.deductible is None:
+        income.deductible = 0.0
+    income.obligation_amount = obligation_for(income.amount, income.rate, income.deductible)
+
+class Payment(SoftDeleteMixin, Base):
     __tablename__ = "payments"
+    __table_args__ = live_and_tombstone_indexes("payments")
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     amount = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    user = relationship("User", back_populates="payments") 
\ No newline at end of file
+    user = relationship("User", back_populates="payments")
+
+class IncomeArchive(SoftDeleteMixin, Base):
+    """Incomes from closed years, moved out of `incomes` by the archival job (SQLite)."""
+    __tablename__ = "incomes_archive"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    amount = Column(Float, nullable=False)
+    description = Column(String, nullable=True)
+    calc_type = Column(String)
+    rate = Column(Float, nullable=False)
+    deductible = Column(Float, default=0.0, nullable=False)
+    obligation_amount = Column(Float, nullable=False)
+    created_at = Column(DateTime)
+
+class PaymentArchive(SoftDeleteMixin, Base):
+    """Payments from closed years, moved out of `payments` by the archival job (SQLite)."""
+    __tablename__ = "payments_archive"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    amount = Column(Float, nullable=False)
+    created_at = Column(DateTime)
+
+class UserMonthlyTotal(Base):
+    """A user's totals per month, kept up to date on every write (see maaserbot.models.rollup)."""
+    __tablename__ = "user_monthly_totals"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    month = Column(Integer, primary_key=True)  # year * 100 + month, e.g. 202403
+    income = Column(Float, default=0.0, nullable=False)
+    obligation_maaser = Column(Float, default=0.0, nullable=False)
+    obligation_chomesh = Column(Float, default=0.0, nullable=False)
+    obligation_custom = Column(Float, default=0.0, nullable=False)
+    paid = Column(Float, default=0.0, nullable=False)
+
+class RecurringEntry(Base):
+    """A monthly income or payment added automatically (see maaserbot.utils.recurring)."""
+    __tablename__ = "recurring_entries"
+    __table_args__ = (
+        # The scheduler only looks for active rules that are due
+        Index('ix_recurring_entries_due', 'next_run_at', sqlite_where=text('active'), postgresql_where=text('active')),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    kind = Column(String, nullable=False)  # income, payment
+    amount = Column(Float, nullable=False)
+    description = Column(String, nullable=True)
+    calc_type = Column(String, nullable=True)  # incomes only
+    deductible = Column(Float, default=0.0, nullable=False)  # incomes only
+    day_of_month = Column(Integer, nullable=False)  # 1-28, so every month has it
+    next_run_at = Column(DateTime, nullable=False)  # date of the next entry to add
+    active = Column(Boolean, default=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<RecurringEntry(id={self.id}, kind={self.kind}, amount={self.amount}, day={self.day_of_month})>"
+
+@event.listens_for(Session, 'do_orm_execute')
+def _exclude_deleted(execute_state) -> None:
+    """Add `deleted_at IS NULL` to every ORM statement on soft-deleted models."""
+    if (execute_state.is_column_load or execute_state.is_relationship_load
+            or execute_state.execution_options.get('include_deleted', False)):
+        return
+    execute_state.statement = execute_state.statement.options(
+        with_loader_criteria(SoftDeleteMixin, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+    )
+
+class Broadcast(Base):
+    """Model for admin broadcasts to all approved users."""
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    admin_telegram_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    status = Column(String, default='running')  # running, done, cancelled
+    last_user_id = Column(Integer, default=0)  # checkpoint - recipients up to this users.id were handled
+    delivered = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<Broadcast(id={self.id}, status={self.status}, last_user_id={self.last_user_id})>"
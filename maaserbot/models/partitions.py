@@ -0,0 +1,122 @@
+"""Yearly range partitioning of incomes and payments on PostgreSQL.
+
+Existing tables are converted once with:
+
+    python -m maaserbot.models partitions convert
+
+After that the bot creates the partitions for the current and the next year
+automatically (see maaserbot.utils.archival), so queries restricted to a
+period only touch that period's partition and old years can be vacuumed,
+detached or dropped independently.
+
+SQLite has no partitioning - use the archival mode instead (ARCHIVE_KEEP_YEARS).
+"""
+
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+
+from .base import get_engine
+from .models import Income, Payment
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+PARTITIONED_MODELS = (Income, Payment)
+
+def is_partitioned(engine: Engine, table: str) -> bool:
+    """Check whether a table is partitioned (always False outside PostgreSQL)."""
+    if engine.dialect.name != 'postgresql':
+        return False
+    with engine.connect() as connection:
+        return connection.execute(
+            text("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table"),
+            {'table': table}
+        ).first() is not None
+
+def _create_partition(connection, table: str, year: int) -> None:
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {table}_y{year} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+    ))
+
+def ensure_partitions(engine: Engine, years: list[int]) -> None:
+    """
+    Create the yearly partitions that don't exist yet.
+
+    Args:
+        engine: The database engine
+        years: Years that need a partition (usually the current and the next)
+    """
+    for model in PARTITIONED_MODELS:
+        table = model.__tablename__
+        if not is_partitioned(engine, table):
+            continue
+        for year in years:
+            try:
+                with engine.begin() as connection:
+                    _create_partition(connection, table, year)
+            except SQLAlchemyError as e:
+                # Happens when the default partition already holds rows of that year
+                logger.error("Could not create partition %s_y%s: %s", table, year, e)
+
+def convert_to_partitioned(engine: Engine, model) -> None:
+    """
+    Rebuild a table as a partitioned table, one partition per year.
+
+    Runs in a single transaction and locks the table while copying, so run it
+    while the bot is stopped.
+    """
+    table = model.__tablename__
+    old = f"{table}_unpartitioned"
+    with engine.begin() as connection:
+        # Make room for the names of the new table's constraint and indexes
+        connection.execute(text(f"ALTER TABLE {table} RENAME TO {old}"))
+        connection.execute(text(f"ALTER TABLE {old} RENAME CONSTRAINT {table}_pkey TO {old}_pkey"))
+        for index in model.__table__.indexes:
+            connection.execute(text(f"ALTER INDEX IF EXISTS {index.name} RENAME TO {index.name}_old"))
+
+        # The partition key must be part of the primary key and can't be NULL
+        connection.execute(text(f"UPDATE {old} SET created_at = now() WHERE created_at IS NULL"))
+        connection.execute(text(
+            f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+        ))
+        connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN created_at SET NOT NULL"))
+        connection.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id, created_at)"))
+        connection.execute(text(f"ALTER TABLE {table} ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+        # Keep the id sequence when the old table is dropped
+        connection.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+        for index in model.__table__.indexes:
+            connection.execute(CreateIndex(index))
+
+        first_year = connection.execute(text(f"SELECT EXTRACT(YEAR FROM min(created_at)) FROM {old}")).scalar()
+        current_year = datetime.utcnow().year
+        for year in range(int(first_year or current_year), current_year + 2):
+            _create_partition(connection, table, year)
+        connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+
+        connection.execute(text(f"INSERT INTO {table} SELECT * FROM {old}"))
+        connection.execute(text(f"DROP TABLE {old}"))
+    logger.info("Converted %s to yearly partitions", table)
+
+def main(argv: list = None) -> None:
+    """Command line entry point: convert | status."""
+    logging.basicConfig(level=logging.INFO)
+    command = ((argv if argv is not None else sys.argv[1:]) or ['status'])[0]
+    engine = get_engine()
+    if engine.dialect.name != 'postgresql':
+        sys.exit("Partitioning needs PostgreSQL. On SQLite set ARCHIVE_KEEP_YEARS instead.")
+    if command == 'convert':
+        for model in PARTITIONED_MODELS:
+            if not is_partitioned(engine, model.__tablename__):
+                convert_to_partitioned(engine, model)
+    elif command == 'status':
+        for model in PARTITIONED_MODELS:
+            print(f"{model.__tablename__}: {'partitioned' if is_partitioned(engine, model.__tablename__) else 'not partitioned'}")
+    else:
+        sys.exit(f"Unknown command {command!r}. Use convert or status.")
@@ -0,0 +1,301 @@
+"""Per-user monthly totals (user_monthly_totals), so totals over time never rescan the entries.
+
+Reports, balances and reminders read at most 12 rows per user and year
+instead of summing incomes and payments. The rollup covers archived entries
+too, exactly like the reports always did.
+
+It is kept up to date on every write, in the writing transaction:
+
+- entries added, changed or deleted through the ORM adjust their month by
+  the difference (see _apply_flush), including edits that move an entry to
+  another month or tombstone it;
+- bulk statements (tombstoning and restoring in maaserbot.utils.db) recompute
+  the months they touched with refresh_months;
+- bulk inserts (recurring entries) add their totals with add_to_months.
+
+Existing databases are filled by schema migration 7. To rebuild everything,
+e.g. after changing entries by hand:
+
+    python -m maaserbot.models rebuild [workers]
+"""
+
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, event, extract, func, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .base import SessionLocal
+from .models import (
+    CalculationType, Income, Payment, IncomeArchive, PaymentArchive, User, UserMonthlyTotal
+)
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+_TABLE = UserMonthlyTotal.__table__
+
+# Column holding the obligation of each calculation type
+OBLIGATION_COLUMNS = {
+    CalculationType.MAASER.value: 'obligation_maaser',
+    CalculationType.CHOMESH.value: 'obligation_chomesh',
+    CalculationType.CUSTOM.value: 'obligation_custom',
+}
+AMOUNT_COLUMNS = ('income', *OBLIGATION_COLUMNS.values(), 'paid')
+
+def obligation_column(calc_type: Optional[str]) -> str:
+    """The rollup column of a calculation type; unknown types count as chomesh, like calculation_rate."""
+    return OBLIGATION_COLUMNS.get(calc_type, OBLIGATION_COLUMNS[CalculationType.CHOMESH.value])
+
+def month_key(when: datetime) -> int:
+    """The rollup month of a date, e.g. 202403."""
+    return when.year * 100 + when.month
+
+def month_start(month: int) -> datetime:
+    """First moment of a rollup month."""
+    return datetime(month // 100, month % 100, 1)
+
+def next_month(month: int) -> int:
+    """The rollup month after `month`."""
+    return month + 89 if month % 100 == 12 else month + 1
+
+def add_to_months(connection, deltas: dict) -> None:
+    """
+    Add amounts to users' months, creating the months that don't exist yet.
+
+    For writers that insert entries with Core statements, which the flush
+    hook doesn't see.
+
+    Args:
+        connection: A connection (not a session), in the writing transaction
+        deltas: {(user_id, month): {column: amount}}
+    """
+    dialect = connection.dialect.name
+    rows = [
+        {'user_id': user_id, 'month': month, **{column: values.get(column, 0.0) for column in AMOUNT_COLUMNS}}
+        for (user_id, month), values in deltas.items() if any(values.values())
+    ]
+    if not rows:
+        return
+    if dialect in ('postgresql', 'sqlite'):
+        # One upsert for all months
+        insert = (postgresql if dialect == 'postgresql' else sqlite).insert(_TABLE)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=['user_id', 'month'],
+            set_={column: _TABLE.c[column] + insert.excluded[column] for column in AMOUNT_COLUMNS}
+        ), rows)
+        return
+    for row in rows:
+        result = connection.execute(
+            update(_TABLE)
+            .where(_TABLE.c.user_id == row['user_id'], _TABLE.c.month == row['month'])
+            .values({column: _TABLE.c[column] + row[column] for column in AMOUNT_COLUMNS})
+        )
+        if result.rowcount == 0:
+            connection.execute(_TABLE.insert().values(**row))
+
+def _aggregate(connection, user_ids: Iterable[int], start: Optional[datetime] = None,
+               end: Optional[datetime] = None) -> dict:
+    # Month totals computed from the entries themselves: live rows of the hot and archive tables
+    totals = {}
+
+    def row(user_id, year, month) -> dict:
+        key = (user_id, int(year) * 100 + int(month))
+        return totals.setdefault(key, dict.fromkeys(AMOUNT_COLUMNS, 0.0))
+
+    for model, is_income in ((Income, True), (IncomeArchive, True), (Payment, False), (PaymentArchive, False)):
+        table = model.__table__
+        year, month = extract('year', table.c.created_at), extract('month', table.c.created_at)
+        # Entries without a date can't be placed in a month
+        condition = [table.c.user_id.in_(list(user_ids)), table.c.deleted_at.is_(None), table.c.created_at.isnot(None)]
+        if start is not None:
+            condition += [table.c.created_at >= start, table.c.created_at < end]
+        if is_income:
+            stmt = select(table.c.user_id, year, month, table.c.calc_type,
+                          func.sum(table.c.amount), func.sum(table.c.obligation_amount))
+            group = (table.c.user_id, year, month, table.c.calc_type)
+        else:
+            stmt = select(table.c.user_id, year, month, func.sum(table.c.amount))
+            group = (table.c.user_id, year, month)
+        for values in connection.execute(stmt.where(*condition).group_by(*group)):
+            if is_income:
+                user_id, y, m, calc_type, income, obligation = values
+                entry = row(user_id, y, m)
+                entry['income'] += income
+                entry[obligation_column(calc_type)] += obligation
+            else:
+                user_id, y, m, paid = values
+                row(user_id, y, m)['paid'] += paid
+    return totals
+
+def refresh_months(db: Session, user_id: int, dates: Iterable[datetime]) -> None:
+    """
+    Recompute a user's months containing the given dates from their entries.
+
+    Used after bulk statements that the ORM can't report entry by entry.
+    Runs in the caller's transaction.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        dates: created_at of the changed entries
+    """
+    months = {month_key(when) for when in dates if when is not None}
+    if not months:
+        return
+    first, last = min(months), max(months)
+    totals = _aggregate(db, [user_id], month_start(first), month_start(next_month(last)))
+    db.execute(
+        delete(_TABLE)
+        .where(_TABLE.c.user_id == user_id, _TABLE.c.month.in_(months))
+        .execution_options(synchronize_session=False)
+    )
+    rows = [
+        {'user_id': user_id, 'month': month, **values}
+        for (_, month), values in totals.items() if month in months
+    ]
+    if rows:
+        db.execute(_TABLE.insert(), rows)
+
+# Attributes that decide how much an entry adds to which month
+_INCOME_ATTRIBUTES = ('user_id', 'created_at', 'deleted_at', 'amount', 'obligation_amount', 'calc_type')
+_PAYMENT_ATTRIBUTES = ('user_id', 'created_at', 'deleted_at', 'amount')
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+# Load the old value before these attributes are changed (even on expired
+# entries, e.g. after a commit), so the flush knows which month to take it from
+for _model, _attributes in ((Income, _INCOME_ATTRIBUTES), (Payment, _PAYMENT_ATTRIBUTES)):
+    for _name in _attributes:
+        event.listen(getattr(_model, _name), 'set', _keep_old_value, active_history=True, retval=True)
+
+def _values(state, attributes: tuple, old: bool, inserted: bool = False) -> Optional[dict]:
+    # The entry's values before (old) or after the flush; None if one of them isn't known
+    values = {}
+    for name in attributes:
+        history = state.attrs[name].history
+        known = (history.deleted if old else history.added) or history.unchanged
+        if not known and inserted:
+            # Columns an inserted entry was never given are NULL
+            known = [state.dict.get(name)]
+        if not known:
+            if (old and history.added) or name not in state.dict:
+                # Changed without its old value ever being loaded, or not loaded at all
+                return None
+            known = [state.dict[name]]
+        values[name] = known[0]
+    return values
+
+def _contribution(model, values: Optional[dict]) -> Optional[tuple]:
+    # ((user_id, month), {column: amount}) an entry adds to the rollup
+    if not values or values['deleted_at'] is not None or values['user_id'] is None or values['created_at'] is None:
+        return None
+    key = (values['user_id'], month_key(values['created_at']))
+    if model is Income:
+        return key, {'income': values['amount'] or 0.0,
+                     obligation_column(values['calc_type']): values['obligation_amount'] or 0.0}
+    return key, {'paid': values['amount'] or 0.0}
+
+@event.listens_for(Session, 'after_flush')
+def _apply_flush(session: Session, flush_context) -> None:
+    """Adjust the months of the incomes and payments written by this flush."""
+    deltas, refresh = {}, set()
+
+    def add(contribution, sign: int) -> None:
+        if contribution is None:
+            return
+        key, values = contribution
+        entry = deltas.setdefault(key, {})
+        for column, amount in values.items():
+            entry[column] = entry.get(column, 0.0) + sign * amount
+
+    for instances, change in ((session.new, 'new'), (session.dirty, 'dirty'), (session.deleted, 'deleted')):
+        for instance in instances:
+            model = type(instance)
+            if model not in (Income, Payment):
+                continue
+            attributes = _INCOME_ATTRIBUTES if model is Income else _PAYMENT_ATTRIBUTES
+            state = inspect(instance)
+            if change == 'dirty' and not any(state.attrs[name].history.has_changes() for name in attributes):
+                continue
+            old = _values(state, attributes, old=True) if change != 'new' else {}
+            new = _values(state, attributes, old=False, inserted=change == 'new') if change != 'deleted' else {}
+            if old is None or new is None:
+                # Not all values were loaded - recompute the entry's months instead
+                refresh.add((state.dict.get('user_id'), state.dict.get('created_at')))
+                continue
+            add(_contribution(model, old), -1)
+            add(_contribution(model, new), +1)
+
+    if deltas:
+        add_to_months(session.connection(), deltas)
+    for user_id, created_at in refresh:
+        if user_id is not None and created_at is not None:
+            refresh_months(session, user_id, [created_at])
+
+def rebuild_users(connection, user_ids: list[int]) -> int:
+    """
+    Recompute all months of the given users from their entries.
+
+    Args:
+        connection: A connection or session, committed by the caller
+        user_ids: The users to rebuild
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    totals = _aggregate(connection, user_ids)
+    connection.execute(delete(_TABLE).where(_TABLE.c.user_id.in_(user_ids)))
+    rows = [{'user_id': user_id, 'month': month, **values} for (user_id, month), values in totals.items()]
+    if rows:
+        connection.execute(_TABLE.insert(), rows)
+    return len(rows)
+
+def _rebuild_batch(user_ids: list[int]) -> int:
+    with SessionLocal() as db:
+        written = rebuild_users(db, user_ids)
+        db.commit()
+    return written
+
+def rebuild(workers: int = 4, batch_size: int = 500) -> int:
+    """
+    Rebuild the whole rollup, users split in batches over parallel workers.
+
+    Each batch is rebuilt in its own transaction, so readers see a user's old
+    or new months, never a half-written set.
+
+    Args:
+        workers: Batches rebuilt at the same time (each uses a pooled connection)
+        batch_size: Users per batch
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    with SessionLocal() as db:
+        user_ids = db.execute(select(User.id).order_by(User.id)).scalars().all()
+    batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        written = sum(executor.map(_rebuild_batch, batches))
+    logger.info("Rebuilt %s monthly totals for %s users", written, len(user_ids))
+    return written
+
+def migrate(connection) -> None:
+    """Schema migration 7: fill the new rollup from the existing entries."""
+    user_ids = connection.execute(select(User.id)).scalars().all()
+    for i in range(0, len(user_ids), 500):
+        rebuild_users(connection, user_ids[i:i + 500])
+
+def main(argv: list = None) -> None:
+    """Command line entry point: rebuild [workers]."""
+    logging.basicConfig(level=logging.INFO)
+    argv = argv if argv is not None else sys.argv[1:]
+    command = argv[0] if argv else 'rebuild'
+    if command != 'rebuild':
+        sys.exit(f"Unknown command {command!r}. Use rebuild.")
+    workers = int(argv[1]) if len(argv) > 1 else 4
+    print(f"Wrote {rebuild(workers)} monthly totals")
@@ -0,0 +1,154 @@
+"""Routing of read-only screens to the read replica.
+
+Read-only screens open their session with read_session() (see
+maaserbot.utils.unit_of_work). It is a session on the replica
+(DATABASE_READ_URL) unless:
+
+- no replica is configured,
+- the replica lags more than REPLICA_MAX_LAG seconds behind the primary, or
+- the user of the current update committed a change within the last
+  REPLICA_MAX_LAG seconds, so they always see their own writes.
+
+Otherwise the screen reads in the update's own session, and everything that
+writes uses SessionLocal sessions. Replica sessions refuse to write (see
+ReplicaWriteError), so a screen that does is caught before the replica
+rejects it.
+The current user is set per update (see bot.py); a commit on a SessionLocal
+session that wrote anything counts as a write by that user.
+"""
+
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from maaserbot.config import get_settings
+from maaserbot.utils import metrics
+from .base import SessionLocal, ReadSessionLocal, has_read_replica, get_read_engine
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Seconds a measured replica lag is trusted before it is measured again
+LAG_CHECK_INTERVAL = 2.0
+
+# Lag of a PostgreSQL hot standby; 0 when it has replayed everything it received
+_REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+# Telegram id of the user whose update is being handled
+current_user: ContextVar[Optional[int]] = ContextVar('current_user', default=None)
+
+# Telegram id to the (monotonic) time of their last committed write
+_last_write: dict[int, float] = {}
+_lag: Optional[float] = None
+_lag_checked_at: Optional[float] = None
+
+class ReplicaWriteError(RuntimeError):
+    """Raised when something tries to write through a read replica session."""
+
+def set_current_user(telegram_id: Optional[int]) -> None:
+    """Set the user the current update comes from."""
+    current_user.set(telegram_id)
+
+def _sticky_seconds() -> float:
+    # A write is visible on the replica once it is older than the replica's lag,
+    # which may have grown since it was last measured
+    return get_settings().replica_max_lag + LAG_CHECK_INTERVAL
+
+def note_write(telegram_id: int) -> None:
+    """Send the user's reads to the primary until the replica has caught up with this write."""
+    now = time.monotonic()
+    _last_write[telegram_id] = now
+    if len(_last_write) > 10000:
+        for key, written_at in list(_last_write.items()):
+            if now - written_at > _sticky_seconds():
+                del _last_write[key]
+
+def wrote_recently(telegram_id: int) -> bool:
+    """Check whether the user committed a write the replica may not have yet."""
+    written_at = _last_write.get(telegram_id)
+    return written_at is not None and time.monotonic() - written_at <= _sticky_seconds()
+
+def measure_replica_lag(engine: Engine) -> Optional[float]:
+    """
+    Measure how far the replica is behind the primary.
+
+    Args:
+        engine: The replica engine
+
+    Returns:
+        Optional[float]: Lag in seconds (0 outside PostgreSQL), None if the replica is unreachable
+    """
+    if engine.dialect.name != 'postgresql':
+        return 0.0
+    try:
+        with engine.connect() as connection:
+            lag = connection.execute(_REPLICA_LAG_SQL).scalar()
+    except Exception as e:
+        logger.error("Could not measure replica lag: %s", e)
+        return None
+    # NULL when the server is not a streaming standby
+    return float(lag or 0)
+
+def replica_lag() -> Optional[float]:
+    """The replica lag, measured at most every LAG_CHECK_INTERVAL seconds."""
+    global _lag, _lag_checked_at
+    now = time.monotonic()
+    if _lag_checked_at is None or now - _lag_checked_at >= LAG_CHECK_INTERVAL:
+        if _lag_checked_at is None:
+            metrics.register_gauge('db.replica_lag', lambda: float('nan') if _lag is None else _lag)
+        _lag = measure_replica_lag(get_read_engine())
+        _lag_checked_at = now
+    return _lag
+
+def use_replica(telegram_id: Optional[int] = None) -> bool:
+    """
+    Decide whether a read for this user can go to the replica.
+
+    Args:
+        telegram_id: The user the read is for, None if unknown
+
+    Returns:
+        bool: True for the replica, False for the primary
+    """
+    if not has_read_replica():
+        return False
+    if telegram_id is None or wrote_recently(telegram_id):
+        return False
+    lag = replica_lag()
+    return lag is not None and lag <= get_settings().replica_max_lag
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(SessionLocal, 'do_orm_execute')
+def _executed(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _committed(session):
+    if session.info.pop('wrote', False):
+        telegram_id = current_user.get()
+        if telegram_id is not None:
+            note_write(telegram_id)
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('wrote', None)
+
+@event.listens_for(ReadSessionLocal, 'before_flush')
+def _refuse_flush(session, flush_context, instances):
+    raise ReplicaWriteError("Read replica sessions can't write - use the update's session")
+
+@event.listens_for(ReadSessionLocal, 'do_orm_execute')
+def _refuse_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        raise ReplicaWriteError("Read replica sessions can't write - use the update's session")
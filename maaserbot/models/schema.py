@@ -0,0 +1,144 @@
+"""Database schema versioning.
+
+The bot checks the schema version on startup instead of running create_all.
+A fresh database is created at the current version. An existing one must be
+upgraded with:
+
+    python -m maaserbot.models upgrade
+
+Upgrading first creates any tables that do not exist yet from the models and
+then runs the pending migrations in order: SQL files from migrations/, or
+Python functions for backfills that need more than portable SQL. Migrations
+should therefore only alter tables that already existed or backfill data.
+"""
+
+import logging
+import sys
+from pathlib import Path
+
+from sqlalchemy import Column, Integer, inspect, select, delete
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from .base import Base, get_engine
+from .rollup import migrate as fill_monthly_totals
+from .search import migrate as index_income_descriptions
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "migrations"
+
+# Version -> migration file, or function called with the connection.
+# Version 1 is the schema before versioning was introduced.
+MIGRATIONS = {
+    2: "add_reminders.sql",
+    3: "add_data_version.sql",
+    4: "add_obligation_amount.sql",
+    5: "add_soft_delete.sql",
+    6: "add_archive.sql",
+    7: fill_monthly_totals,
+    8: index_income_descriptions,
+    9: "add_recurring.sql",
+}
+
+SCHEMA_VERSION = max(MIGRATIONS, default=1)
+
+class SchemaVersion(Base):
+    """The version of the database schema (a single row)."""
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+
+class SchemaVersionError(RuntimeError):
+    """Raised when the database schema is older than the code expects."""
+
+def get_schema_version(engine: Engine) -> int:
+    """
+    Get the schema version of the database.
+
+    Returns:
+        int: 0 for an empty database, 1 for a database from before versioning
+    """
+    table_names = set(inspect(engine).get_table_names())
+    if SchemaVersion.__tablename__ not in table_names:
+        return 1 if "users" in table_names else 0
+    with engine.connect() as connection:
+        return connection.execute(select(SchemaVersion.version)).scalar() or 1
+
+def _stamp(connection, version: int) -> None:
+    connection.execute(delete(SchemaVersion.__table__))
+    connection.execute(SchemaVersion.__table__.insert().values(version=version))
+
+def init_schema(engine: Engine) -> None:
+    """Create all tables and mark the database as up to date."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        _stamp(connection, SCHEMA_VERSION)
+    logger.info("Created database schema version %s", SCHEMA_VERSION)
+
+def upgrade_schema(engine: Engine) -> None:
+    """Create missing tables and run the pending migrations."""
+    current = get_schema_version(engine)
+    if current == 0:
+        init_schema(engine)
+        return
+
+    Base.metadata.create_all(bind=engine)
+    for version in sorted(v for v in MIGRATIONS if v > current):
+        migration = MIGRATIONS[version]
+        with engine.begin() as connection:
+            if callable(migration):
+                migration(connection)
+            else:
+                sql = (MIGRATIONS_DIR / migration).read_text(encoding='utf-8')
+                # Drop comment lines first - they may contain semicolons
+                sql = '\n'.join(line for line in sql.splitlines() if not line.strip().startswith('--'))
+                for statement in sql.split(';'):
+                    if statement.strip():
+                        connection.exec_driver_sql(statement)
+            _stamp(connection, version)
+        logger.info("Applied migration %s (schema version %s)", getattr(migration, '__name__', migration), version)
+
+def check_schema(engine: Engine = None) -> None:
+    """
+    Verify on startup that the database schema matches the code.
+
+    An empty database is initialized. This costs a couple of cheap queries,
+    unlike create_all which inspects every table.
+
+    Raises:
+        SchemaVersionError: If the database needs to be upgraded
+    """
+    engine = engine or get_engine()
+    current = get_schema_version(engine)
+    if current == 0:
+        init_schema(engine)
+    elif current < SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {current}, this code needs version {SCHEMA_VERSION}. "
+            f"Run `python -m maaserbot.models upgrade`."
+        )
+    elif current > SCHEMA_VERSION:
+        logger.warning("Database schema version %s is newer than this code (%s)", current, SCHEMA_VERSION)
+
+def main(argv: list = None) -> None:
+    """Command line entry point: init | upgrade | version."""
+    logging.basicConfig(level=logging.INFO)
+    command = (argv if argv is not None else sys.argv[1:] or ['upgrade'])[0]
+    engine = get_engine()
+    try:
+        if command == 'init':
+            if get_schema_version(engine) == 0:
+                init_schema(engine)
+            else:
+                upgrade_schema(engine)
+        elif command == 'upgrade':
+            upgrade_schema(engine)
+        elif command == 'version':
+            print(f"database: {get_schema_version(engine)}, code: {SCHEMA_VERSION}")
+        else:
+            sys.exit(f"Unknown command {command!r}. Use init, upgrade or version.")
+    except SQLAlchemyError as e:
+        logger.error("Schema %s failed: %s", command, e)
+        raise
@@ -0,0 +1,223 @@
+"""Full-text search over income descriptions (income_search).
+
+SQLite keeps the search terms in an FTS5 table, PostgreSQL in a tsvector
+column with a GIN index. The terms are prepared here rather than by the
+database, which has no Hebrew support of its own (see search_terms): niqqud
+is dropped, final letters are folded and words are also indexed without
+their prefix letters, so "בונוס" finds "והבונוס". Every query word matches
+as a prefix, so "מר" finds "מרץ".
+
+The index is written together with the income (see _index_flush), so it
+follows add_income and edit_income. Tombstoned incomes stay indexed for
+undo and are filtered out when searching; entries purged or archived are
+dropped by remove_from_search_index. Other databases search with LIKE.
+
+Existing databases are indexed by schema migration 8.
+"""
+
+import logging
+import re
+import unicodedata
+from typing import Iterable, Optional
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, and_, delete, event, func, inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from .base import Base
+from .models import Income
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+# Letters that attach to the front of a Hebrew word: ו, ה, ב, כ, ל, מ, ש
+_PREFIX_LETTERS = 'והבכלמש'
+_WORD = re.compile(r'[^\W_]+')
+# Geresh and gershayim inside abbreviations (צה"ל, ש׳) don't split the word
+_INNER_QUOTES = re.compile(r'(?<=\w)["\'׳״](?=\w)')
+
+def _words(value: str) -> list[str]:
+    value = unicodedata.normalize('NFD', value or '')
+    value = ''.join(char for char in value if not unicodedata.combining(char))
+    return _WORD.findall(_INNER_QUOTES.sub('', value).casefold().translate(_FINAL_LETTERS))
+
+def search_terms(description: Optional[str]) -> str:
+    """
+    The terms indexed for a description, space separated.
+
+    Each word is indexed as written and without up to three leading letters
+    that can be Hebrew prefixes, as long as three letters remain. Stripping a
+    letter of the word itself only adds a term nobody searches for.
+    """
+    terms = []
+    for word in _words(description):
+        terms.append(word)
+        stripped = word
+        while len(word) - len(stripped) < 3 and stripped[:1] in _PREFIX_LETTERS and len(stripped) > 3:
+            stripped = stripped[1:]
+            terms.append(stripped)
+    return ' '.join(dict.fromkeys(terms))
+
+def query_words(query: str) -> list[str]:
+    """The words of a search query, normalized like the index."""
+    return list(dict.fromkeys(_words(query)))
+
+# PostgreSQL index table. SQLite uses an FTS5 table of the same name with the
+# income id as rowid, which create_all can't describe (see _create_search_index).
+_metadata = MetaData()
+_SEARCH = Table(
+    'income_search', _metadata,
+    Column('income_id', Integer, primary_key=True, autoincrement=False),
+    Column('user_id', Integer, nullable=False, index=True),
+    Column('terms', postgresql.TSVECTOR, nullable=False),
+    Index('ix_income_search_terms', 'terms', postgresql_using='gin'),
+)
+_SQLITE_CREATE = text(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS income_search USING fts5(terms, user_id, tokenize = 'unicode61')"
+)
+# How SQLite statements see the FTS5 table
+_FTS = Table(
+    'income_search', MetaData(),
+    Column('rowid', Integer, primary_key=True),
+    Column('terms', String),
+    Column('user_id', Integer),
+)
+_SQLITE_MATCH = text("SELECT rowid AS income_id FROM income_search WHERE income_search MATCH :match").columns(
+    income_id=Integer
+)
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_search_index(target, connection, **kw) -> None:
+    """Create the index table with the other tables."""
+    if connection.dialect.name == 'sqlite':
+        connection.execute(_SQLITE_CREATE)
+    elif connection.dialect.name == 'postgresql':
+        _metadata.create_all(connection)
+
+def _dialect(connection) -> str:
+    # Works with a connection or a session
+    return (connection.dialect if hasattr(connection, 'dialect') else connection.get_bind().dialect).name
+
+def _write(connection, rows: list[dict], removed: Iterable[int] = ()) -> None:
+    # rows: {'income_id', 'user_id', 'terms'}; incomes without terms are removed
+    removed = set(removed) | {row['income_id'] for row in rows if not row['terms']}
+    rows = [row for row in rows if row['terms']]
+    dialect = _dialect(connection)
+    if dialect == 'sqlite':
+        if removed:
+            connection.execute(delete(_FTS).where(_FTS.c.rowid.in_(removed)))
+        if rows:
+            connection.execute(_FTS.insert().prefix_with('OR REPLACE'), [
+                {'rowid': row['income_id'], 'terms': row['terms'], 'user_id': row['user_id']} for row in rows
+            ])
+    elif dialect == 'postgresql':
+        if removed:
+            connection.execute(delete(_SEARCH).where(_SEARCH.c.income_id.in_(removed)))
+        for row in rows:
+            stmt = postgresql.insert(_SEARCH).values(
+                income_id=row['income_id'], user_id=row['user_id'], terms=func.to_tsvector('simple', row['terms'])
+            )
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=['income_id'],
+                set_={'user_id': stmt.excluded.user_id, 'terms': stmt.excluded.terms}
+            ))
+
+@event.listens_for(Session, 'after_flush')
+def _index_flush(session: Session, flush_context) -> None:
+    """Index the descriptions of the incomes written by this flush."""
+    rows = []
+    for instance in session.new | session.dirty:
+        if not isinstance(instance, Income):
+            continue
+        state = inspect(instance)
+        if instance in session.dirty and not any(
+            state.attrs[name].history.has_changes() for name in ('description', 'user_id')
+        ):
+            continue
+        terms = search_terms(instance.description)
+        if terms or instance not in session.new:
+            rows.append({'income_id': instance.id, 'user_id': instance.user_id, 'terms': terms})
+    removed = [instance.id for instance in session.deleted if isinstance(instance, Income)]
+    if rows or removed:
+        _write(session.connection(), rows, removed)
+
+def index_descriptions(connection, incomes: list[dict]) -> None:
+    """
+    Index incomes inserted with Core statements, which the flush hook doesn't see.
+
+    Args:
+        connection: A connection or session, in the writing transaction
+        incomes: {'id', 'user_id', 'description'} of each income
+    """
+    _write(connection, [
+        {'income_id': income['id'], 'user_id': income['user_id'], 'terms': search_terms(income['description'])}
+        for income in incomes if income['description']
+    ])
+
+def search_condition(dialect: str, user_id: int, query: str):
+    """
+    Condition on Income selecting a user's incomes whose description matches.
+
+    Every word of the query must match, as a prefix of a word of the description.
+
+    Args:
+        dialect: Name of the database dialect the condition runs on
+        user_id: The user's id
+        query: The search text
+
+    Returns:
+        The condition, or None if the query has no words
+    """
+    words = query_words(query)
+    if not words:
+        return None
+    if dialect == 'sqlite':
+        # Words are letters and digits only, so they can be quoted as they are
+        match = f'user_id : "{user_id}" AND terms : (' + ' AND '.join(f'"{word}"*' for word in words) + ')'
+        return Income.id.in_(select(_SQLITE_MATCH.bindparams(match=match).subquery().c.income_id))
+    if dialect == 'postgresql':
+        tsquery = func.to_tsquery('simple', ' & '.join(f'{word}:*' for word in words))
+        return Income.id.in_(
+            select(_SEARCH.c.income_id).where(_SEARCH.c.user_id == user_id, _SEARCH.c.terms.op('@@')(tsquery))
+        )
+    return and_(*(Income.description.ilike(f'%{word}%') for word in query.split()))
+
+def reindex(connection) -> int:
+    """
+    Index the descriptions of all incomes, tombstoned ones included.
+
+    Args:
+        connection: A connection or session, committed by the caller
+
+    Returns:
+        int: Number of indexed incomes
+    """
+    table = Income.__table__
+    rows = [
+        {'income_id': income_id, 'user_id': user_id, 'terms': search_terms(description)}
+        for income_id, user_id, description in connection.execute(
+            select(table.c.id, table.c.user_id, table.c.description).where(table.c.description.isnot(None))
+        )
+    ]
+    _write(connection, rows)
+    return sum(1 for row in rows if row['terms'])
+
+def remove_from_search_index(db: Session, income_ids) -> None:
+    """
+    Drop the index entries of incomes about to be purged or archived.
+
+    Args:
+        db: The database session
+        income_ids: The incomes' ids, as a list or a select
+    """
+    dialect = _dialect(db)
+    if dialect == 'sqlite':
+        db.execute(delete(_FTS).where(_FTS.c.rowid.in_(income_ids)))
+    elif dialect == 'postgresql':
+        db.execute(delete(_SEARCH).where(_SEARCH.c.income_id.in_(income_ids)))
+
+def migrate(connection) -> None:
+    """Schema migration 8: index the descriptions of the existing incomes."""
+    _create_search_index(None, connection)
+    logger.info("Indexed %s income descriptions", reindex(connection))
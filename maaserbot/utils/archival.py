@@ -0,0 +1,92 @@
+"""Keeping incomes and payments small: yearly partitions and archival of closed years.
+
+Runs daily as a job. On PostgreSQL with partitioned tables it creates next
+year's partition ahead of time. With ARCHIVE_KEEP_YEARS set (meant for
+SQLite) it moves entries from closed years to the archive tables, keeping
+the last ARCHIVE_KEEP_YEARS years (the current one included) live.
+
+Archival can also be run by hand:
+
+    python -m maaserbot.utils.archival [keep_years]
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import datetime
+
+from telegram.ext import ContextTypes
+
+from maaserbot.config import get_settings
+from maaserbot.models import SessionLocal, get_engine
+from maaserbot.models.partitions import ensure_partitions
+from maaserbot.utils import metrics
+from maaserbot.utils.db import get_users_with_closed_entries, archive_closed_entries
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Users per archival transaction
+BATCH_SIZE = 100
+
+def archive_cutoff(keep_years: int, now: datetime = None) -> datetime:
+    """First day that stays live when keeping `keep_years` years, the current one included."""
+    now = now or datetime.utcnow()
+    return datetime(now.year - keep_years + 1, 1, 1)
+
+def _users_to_archive(before: datetime) -> list[int]:
+    with SessionLocal() as db:
+        return get_users_with_closed_entries(db, before)
+
+def _archive_batch(user_ids: list[int], before: datetime) -> int:
+    # Each batch in its own session, so it can run in a worker thread
+    with SessionLocal() as db:
+        return archive_closed_entries(db, user_ids, before)
+
+def archive_batches(before: datetime):
+    """
+    Archive everything dated before `before`, one batch of users at a time.
+
+    Yields:
+        int: Users archived in each batch
+    """
+    user_ids = _users_to_archive(before)
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        yield _archive_batch(user_ids[i:i + BATCH_SIZE], before)
+
+async def maintain_history_storage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job callback: create upcoming partitions and archive closed years.
+
+    Args:
+        context: The job context
+    """
+    year = datetime.utcnow().year
+    await asyncio.to_thread(ensure_partitions, get_engine(), [year, year + 1])
+
+    keep_years = get_settings().archive_keep_years
+    if not keep_years:
+        return
+
+    # The statements run in worker threads, so updates are handled meanwhile
+    before = archive_cutoff(keep_years)
+    user_ids = await asyncio.to_thread(_users_to_archive, before)
+    archived = 0
+    for i in range(0, len(user_ids), BATCH_SIZE):
+        archived += await asyncio.to_thread(_archive_batch, user_ids[i:i + BATCH_SIZE], before)
+
+    if archived:
+        metrics.inc('archival.users', archived)
+        logger.info("Archived closed years for %s users", archived)
+
+def main(argv: list = None) -> None:
+    """Command line entry point: archive everything older than [keep_years] (default 1)."""
+    logging.basicConfig(level=logging.INFO)
+    argv = argv if argv is not None else sys.argv[1:]
+    keep_years = int(argv[0]) if argv else get_settings().archive_keep_years or 1
+    before = archive_cutoff(keep_years)
+    total = sum(archive_batches(before))
+    print(f"Archived entries before {before:%Y-%m-%d} for {total} users")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Micro-benchmark of the per-call Python overhead of the hot database lookups.
+
+Runs each hot lookup of maaserbot.utils.db against an in-memory SQLite
+database, next to the Query API form it replaced, and prints the time per
+call and the compiled cache hit ratio. SQLite answers these in microseconds,
+so the difference is almost all statement building and compiling.
+
+    python -m maaserbot.utils.benchmark [calls]
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from maaserbot.models import Base, User, Income, Payment
+from maaserbot.utils import slowquery
+from maaserbot.utils.db import get_or_create_user, get_user_balance, get_user_history
+
+def _seed(db: Session, entries: int = 50) -> User:
+    user = get_or_create_user(db, 1000)
+    start = datetime.utcnow() - timedelta(days=entries)
+    for day in range(entries):
+        db.add(Income(user_id=user.id, amount=1000, calc_type='maaser', created_at=start + timedelta(days=day)))
+        db.add(Payment(user_id=user.id, amount=50, created_at=start + timedelta(days=day)))
+    db.commit()
+    return user
+
+def _query_api_lookups(db: Session, user_id: int) -> dict:
+    # The Query API forms the hot lookups used before they were built once
+    return {
+        'get_or_create_user': lambda: db.query(User).filter(User.telegram_id == 1000).first(),
+        'get_user_history': lambda: (
+            db.query(User).filter(User.id == user_id).first(),
+            db.query(Income).filter(Income.user_id == user_id).count(),
+            db.query(Payment).filter(Payment.user_id == user_id).count(),
+            db.query(Income).filter(Income.user_id == user_id).order_by(Income.created_at.desc()).offset(5).limit(5).all(),
+            db.query(Payment).filter(Payment.user_id == user_id).order_by(Payment.created_at.desc()).offset(5).limit(5).all(),
+        ),
+    }
+
+def _time_per_call(function, calls: int) -> float:
+    function()
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - started) / calls
+
+def run(calls: int = 2000) -> list[tuple[str, float, float]]:
+    """
+    Time the hot lookups.
+
+    Args:
+        calls: Calls per lookup
+
+    Returns:
+        list: (lookup, seconds per call with the Query API or None, seconds per call now)
+    """
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        user = _seed(db)
+        before = _query_api_lookups(db, user.id)
+        now = {
+            'get_or_create_user': lambda: get_or_create_user(db, 1000),
+            'get_user_history': lambda: get_user_history(db, user.id, page=2),
+            'get_user_balance': lambda: get_user_balance(db, user.id),
+        }
+        slowquery.stats.reset()
+        return [
+            (name, _time_per_call(before[name], calls) if name in before else None, _time_per_call(function, calls))
+            for name, function in now.items()
+        ]
+
+def main(argv: list = None) -> None:
+    """Command line entry point: benchmark with [calls] calls per lookup (default 2000)."""
+    argv = argv if argv is not None else sys.argv[1:]
+    calls = int(argv[0]) if argv else 2000
+    for name, before, now in run(calls):
+        line = f"{name:<20} {now * 1e6:8.1f} µs/call"
+        if before:
+            line += f"  (Query API {before * 1e6:.1f} µs, {1 - now / before:.0%} less)"
+        print(line)
+    print(f"compiled cache hit ratio: {slowquery.stats.cache_hit_ratio:.1%}")
+
+if __name__ == '__main__':
+    main()
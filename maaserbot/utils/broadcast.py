@@ -0,0 +1,152 @@
+"""Resumable fan-out of admin broadcasts to all approved users."""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict
+
+from telegram import Bot
+from telegram.error import Forbidden
+from telegram.ext import Application
+
+from maaserbot.models import SessionLocal
+from maaserbot.utils import metrics
+from maaserbot.utils.db import get_broadcast, get_running_broadcasts, iter_broadcast_recipients, update_broadcast_progress
+from maaserbot.utils.send_queue import SendQueue, SEND_QUEUE_KEY, PRIORITY_BULK, PRIORITY_NOTIFICATION
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Key under which running broadcast tasks are stored in application.bot_data
+BROADCAST_TASKS_KEY = 'broadcast_tasks'
+
+# Recipients sent per checkpoint. After a crash at most one batch is sent twice.
+BATCH_SIZE = 100
+
+@dataclass
+class BroadcastResult:
+    """Delivery counts of a single batch."""
+    delivered: int = 0
+    failed: int = 0
+    blocked: int = 0
+
+async def send_batch(bot: Bot, send_queue: SendQueue, recipients: list, text: str) -> BroadcastResult:
+    """
+    Send `text` to a batch of recipients concurrently through the send queue.
+
+    Args:
+        bot: The bot used for sending
+        send_queue: The rate-limited send queue
+        recipients: Rows of (users.id, telegram_id)
+        text: The message text
+
+    Returns:
+        BroadcastResult: Delivery counts for the batch
+    """
+    futures = [
+        send_queue.submit(bot.send_message, chat_id=telegram_id, text=text, priority=PRIORITY_BULK)
+        for _, telegram_id in recipients
+    ]
+    result = BroadcastResult()
+    for outcome in await asyncio.gather(*futures, return_exceptions=True):
+        if isinstance(outcome, Forbidden):
+            # The user blocked the bot or deleted their account
+            result.blocked += 1
+        elif isinstance(outcome, Exception):
+            result.failed += 1
+        else:
+            result.delivered += 1
+    return result
+
+async def run_broadcast(bot: Bot, send_queue: SendQueue, broadcast_id: int) -> None:
+    """
+    Send a broadcast, resuming from its last checkpoint.
+
+    Recipients are read from the database a batch at a time and progress is
+    committed after every batch, so a restart continues from the last completed batch. The
+    admin receives a report with the final counts.
+
+    Args:
+        bot: The bot used for sending
+        send_queue: The rate-limited send queue
+        broadcast_id: The broadcast to run
+    """
+    with SessionLocal() as db:
+        broadcast = get_broadcast(db, broadcast_id)
+        if not broadcast or broadcast.status != "running":
+            return
+        text = broadcast.text
+        admin_id = broadcast.admin_telegram_id
+        last_user_id = broadcast.last_user_id or 0
+
+    logger.info("Running broadcast %s from user id %s", broadcast_id, last_user_id)
+
+    with SessionLocal() as db:
+        for batch in iter_broadcast_recipients(db, last_user_id, BATCH_SIZE):
+            result = await send_batch(bot, send_queue, batch, text)
+            last_user_id = batch[-1][0]
+            broadcast = update_broadcast_progress(
+                db, broadcast_id, last_user_id, result.delivered, result.failed, result.blocked
+            )
+            metrics.inc('broadcast.delivered', result.delivered)
+            metrics.inc('broadcast.failed', result.failed)
+            metrics.inc('broadcast.blocked', result.blocked)
+            if broadcast.status != "running":
+                logger.info("Broadcast %s stopped with status %s", broadcast_id, broadcast.status)
+                break
+        else:
+            broadcast = update_broadcast_progress(db, broadcast_id, last_user_id, finished=True)
+
+        report = (
+            f"📣 דוח שידור #{broadcast_id}\n\n"
+            f"✅ נמסרו: {broadcast.delivered}\n"
+            f"🚫 חסמו את הבוט: {broadcast.blocked}\n"
+            f"❌ נכשלו: {broadcast.failed}"
+        )
+
+    logger.info("Broadcast %s finished", broadcast_id)
+    try:
+        await send_queue.send(bot.send_message, chat_id=admin_id, text=report, priority=PRIORITY_NOTIFICATION)
+    except Exception as e:
+        logger.error("Failed to send broadcast report to admin %s: %s", admin_id, e)
+
+def start_broadcast(application: Application, broadcast_id: int) -> asyncio.Task:
+    """
+    Run a broadcast in the background.
+
+    Args:
+        application: The running application
+        broadcast_id: The broadcast to run
+
+    Returns:
+        asyncio.Task: The background task
+    """
+    tasks: Dict[int, asyncio.Task] = application.bot_data.setdefault(BROADCAST_TASKS_KEY, {})
+    task = asyncio.create_task(
+        run_broadcast(application.bot, application.bot_data[SEND_QUEUE_KEY], broadcast_id),
+        name=f'broadcast_{broadcast_id}'
+    )
+    tasks[broadcast_id] = task
+
+    def done(finished: asyncio.Task):
+        tasks.pop(broadcast_id, None)
+        if not finished.cancelled() and finished.exception():
+            logger.error("Broadcast %s failed", broadcast_id, exc_info=finished.exception())
+
+    task.add_done_callback(done)
+    return task
+
+def resume_broadcasts(application: Application) -> None:
+    """Restart broadcasts that were interrupted by a shutdown."""
+    with SessionLocal() as db:
+        broadcast_ids = [broadcast.id for broadcast in get_running_broadcasts(db)]
+    for broadcast_id in broadcast_ids:
+        logger.info("Resuming broadcast %s", broadcast_id)
+        start_broadcast(application, broadcast_id)
+
+async def stop_broadcasts(application: Application) -> None:
+    """Cancel running broadcast tasks. Their checkpoints let them resume on the next start."""
+    tasks: Dict[int, asyncio.Task] = application.bot_data.get(BROADCAST_TASKS_KEY, {})
+    for task in list(tasks.values()):
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
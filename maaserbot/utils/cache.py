@@ -0,0 +1,308 @@
+"""Cache for computed data: in-process, or shared by all bot processes through Redis.
+
+With CACHE_URL set (redis://...) the cache lives in Redis, so every process
+benefits from what the others computed. Each process keeps a short-lived
+local copy of the entries it reads; sets and deletes are announced on a
+pub-sub channel so the other processes drop their copies. Without CACHE_URL
+the cache is a LocalCache in this process.
+
+Both implement the same interface: get, set (with an optional TTL), delete,
+clear and close. Values stored in Redis must be picklable.
+"""
+
+import json
+import logging
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from maaserbot.config import get_settings
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class LocalCache:
+    """
+    Thread-safe LRU cache with optional per-entry expiry.
+
+    Entries are evicted least-recently-used first once `max_size` is reached.
+    """
+
+    def __init__(self, max_size: int = 10000, default_ttl: Optional[float] = None):
+        """
+        Args:
+            max_size: Maximum number of entries
+            default_ttl: Seconds an entry stays valid, None for no expiry
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a cached value, or `default` if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a value.
+
+        Args:
+            key: The cache key
+            value: The value to store
+            ttl: Seconds the entry stays valid (defaults to `default_ttl`)
+        """
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: Hashable) -> None:
+        """Remove entries if present."""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def close(self) -> None:
+        """Nothing to release for an in-process cache."""
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class RedisCache:
+    """
+    Cache shared through a Redis server, with a local copy of recently read entries.
+
+    Redis errors are logged and treated as cache misses, so an unavailable
+    server slows the bot down but doesn't break it.
+    """
+
+    # Pub-sub channel for "drop your local copy of these keys"
+    CHANNEL = 'maaserbot:cache:invalidate'
+
+    def __init__(self, url: str, prefix: str = 'maaserbot:', default_ttl: Optional[float] = 86400,
+                 local_ttl: float = 30, client=None):
+        """
+        Args:
+            url: Redis server URL (redis://host:port/db)
+            prefix: Prefix of all keys in Redis
+            default_ttl: Seconds an entry stays in Redis, None for no expiry
+            local_ttl: Seconds a local copy is used without asking Redis; bounds
+                staleness if an invalidation message is missed
+            client: A redis.Redis client to use instead of connecting to `url`
+
+        Raises:
+            ImportError: If the redis package is not installed
+        """
+        if client is None:
+            import redis
+            # Connections are made on first use; an unreachable server fails fast
+            client = redis.Redis.from_url(url, socket_connect_timeout=1)
+        self._redis = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+        self.local = LocalCache(default_ttl=local_ttl)
+        self.hits = 0
+        self.misses = 0
+        # Our own invalidation messages are skipped
+        self._id = uuid.uuid4().hex
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        # Subscribing connects, so it is done by the listener thread, which
+        # keeps retrying while Redis is unreachable
+        self._stopped = threading.Event()
+        self._listener = threading.Thread(target=self._listen, name='cache-invalidations', daemon=True)
+        self._listener.start()
+
+    def _key(self, key: Hashable) -> str:
+        parts = key if isinstance(key, tuple) else (key,)
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def _publish(self, pipe, keys: list) -> None:
+        pipe.publish(self.CHANNEL, json.dumps({'from': self._id, 'keys': keys}))
+
+    def _on_invalidate(self, message: dict) -> None:
+        try:
+            data = json.loads(message['data'])
+        except (ValueError, TypeError):
+            logger.warning("Ignoring malformed cache invalidation: %r", message)
+            return
+        if data.get('from') == self._id:
+            return
+        if data.get('keys') is None:
+            self.local.clear()
+        else:
+            self.local.delete(*data['keys'])
+
+    def _listen(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                if not self._pubsub.subscribed:
+                    self._pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+                self._pubsub.get_message(timeout=0.5)
+            except Exception as e:
+                # Invalidations sent meanwhile are lost; local copies expire after local_ttl anyway
+                logger.warning("Cache invalidation listener failed, retrying: %s", e)
+                self._stopped.wait(1)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a cached value, or `default` if missing, expired or Redis is unreachable."""
+        redis_key = self._key(key)
+        value = self.local.get(redis_key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        try:
+            data = self._redis.get(redis_key)
+        except Exception as e:
+            logger.warning("Cache get failed for %s: %s", redis_key, e)
+            data = None
+        if data is None:
+            self.misses += 1
+            return default
+        value = pickle.loads(data)
+        self.local.set(redis_key, value)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a value.
+
+        Args:
+            key: The cache key - a string or a tuple of strings and numbers
+            value: The value to store
+            ttl: Seconds the entry stays valid (defaults to `default_ttl`)
+        """
+        ttl = ttl if ttl is not None else self.default_ttl
+        redis_key = self._key(key)
+        self.local.set(redis_key, value, ttl=min(ttl, self.local.default_ttl) if ttl is not None else None)
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.set(redis_key, pickle.dumps(value), px=int(ttl * 1000) if ttl is not None else None)
+            self._publish(pipe, [redis_key])
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Cache set failed for %s: %s", redis_key, e)
+
+    def delete(self, *keys: Hashable) -> None:
+        """Remove entries if present, here and in the local copies of all processes."""
+        if not keys:
+            return
+        redis_keys = [self._key(key) for key in keys]
+        self.local.delete(*redis_keys)
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.delete(*redis_keys)
+            self._publish(pipe, redis_keys)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Cache delete failed for %s: %s", redis_keys, e)
+
+    def clear(self) -> None:
+        """Remove all entries under the prefix."""
+        self.local.clear()
+        try:
+            keys = list(self._redis.scan_iter(match=self.prefix + '*'))
+            pipe = self._redis.pipeline(transaction=False)
+            if keys:
+                pipe.delete(*keys)
+            self._publish(pipe, None)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Cache clear failed: %s", e)
+
+    def close(self) -> None:
+        """Stop listening for invalidations and close the connections."""
+        self._stopped.set()
+        self._listener.join(timeout=2)
+        self._pubsub.close()
+        self._redis.close()
+
+    def __len__(self) -> int:
+        return len(self.local)
+
+def create_cache(url: Optional[str] = None):
+    """
+    Create the cache for a CACHE_URL.
+
+    Args:
+        url: A redis:// URL, or None for an in-process cache
+
+    Returns:
+        LocalCache or RedisCache
+    """
+    if not url:
+        return LocalCache()
+    return RedisCache(url)
+
+class SharedCache:
+    """The process-wide cache. Its backend is created from CACHE_URL on first use."""
+
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        """The LocalCache or RedisCache in use."""
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = create_cache(get_settings().cache_url)
+        return self._backend
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self.backend.get(key, default)
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        self.backend.set(key, value, ttl)
+
+    def delete(self, *keys: Hashable) -> None:
+        self.backend.delete(*keys)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def close(self) -> None:
+        """Release the backend (on shutdown); a later use creates a new one."""
+        with self._lock:
+            backend, self._backend = self._backend, None
+        if backend is not None:
+            backend.close()
+
+    def hit_ratio(self) -> float:
+        """Share of lookups in this process that were hits."""
+        backend = self.backend
+        lookups = backend.hits + backend.misses
+        return backend.hits / lookups if lookups else 0.0
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+# Shared cache for the process
+cache = SharedCache()
@@ -0,0 +1,89 @@
+"""Chart rendering for MaaserBot.
+
+Rendering runs in a process pool so matplotlib never blocks the event loop.
+This module is imported by the worker processes, so it must stay free of
+heavy imports - matplotlib is only loaded inside the worker.
+"""
+
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import accumulate
+from typing import Optional
+
+from maaserbot.config import get_settings
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+def render_balance_chart(series: list[tuple]) -> bytes:
+    """
+    Render cumulative income, obligation and payments as a PNG.
+
+    Args:
+        series: Rows of (day as 'YYYY-MM-DD', income, obligation, paid), oldest first
+
+    Returns:
+        bytes: The PNG image
+
+    Raises:
+        ImportError: If matplotlib is not installed
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    days = [datetime.strptime(row[0], '%Y-%m-%d') for row in series]
+    income = list(accumulate(row[1] for row in series))
+    obligation = list(accumulate(row[2] for row in series))
+    paid = list(accumulate(row[3] for row in series))
+
+    fig, income_axis = plt.subplots(figsize=(8, 4.5), dpi=100)
+    try:
+        income_axis.step(days, income, where='post', color='tab:blue', label='Income')
+        income_axis.set_ylabel('Income (ILS)')
+
+        # Obligation and payments are an order of magnitude smaller than income
+        giving_axis = income_axis.twinx()
+        giving_axis.step(days, obligation, where='post', color='tab:orange', label='Obligation')
+        giving_axis.step(days, paid, where='post', color='tab:green', label='Paid')
+        giving_axis.fill_between(days, paid, obligation, step='post', color='tab:orange', alpha=0.15)
+        giving_axis.set_ylabel('Maaser (ILS)')
+
+        income_axis.xaxis.set_major_formatter(mdates.DateFormatter('%m/%Y'))
+        fig.autofmt_xdate()
+        lines = income_axis.get_lines() + giving_axis.get_lines()
+        income_axis.legend(lines, [line.get_label() for line in lines], loc='upper left')
+        income_axis.grid(alpha=0.3)
+        fig.tight_layout()
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+def get_executor() -> ProcessPoolExecutor:
+    """Get the shared rendering pool, creating it on first use."""
+    global _executor
+    if _executor is None:
+        # spawn - forking a process with running threads and an event loop is unsafe
+        _executor = ProcessPoolExecutor(
+            max_workers=get_settings().chart_workers,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+async def render_chart(series: list[tuple]) -> bytes:
+    """Render a balance chart in the process pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), render_balance_chart, series)
+
+def shutdown_executor() -> None:
+    """Stop the rendering pool if it was started."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
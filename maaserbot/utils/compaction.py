@@ -0,0 +1,46 @@
+"""Background purge of soft-deleted incomes and payments."""
+
+import asyncio
+import logging
+from datetime import datetime
+
+from telegram.ext import ContextTypes
+
+from maaserbot.models import SessionLocal
+from maaserbot.utils import metrics
+from maaserbot.utils.db import UNDO_WINDOW, SOFT_DELETE_MODELS, purge_deleted
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Rows per DELETE - small enough that each transaction holds its locks briefly
+BATCH_SIZE = 500
+
+def _purge_batch(model, before: datetime) -> int:
+    # Each batch in its own session, so it can run in a worker thread
+    with SessionLocal() as db:
+        return purge_deleted(db, model, before, BATCH_SIZE)
+
+async def compact_deleted_rows(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job callback: purge tombstones whose undo window has passed.
+
+    Runs in small batches in a worker thread, so updates keep being handled
+    while a large deletion is cleaned up.
+
+    Args:
+        context: The job context
+    """
+    before = datetime.utcnow() - UNDO_WINDOW
+    purged = 0
+
+    for model in SOFT_DELETE_MODELS:
+        while True:
+            count = await asyncio.to_thread(_purge_batch, model, before)
+            purged += count
+            if count < BATCH_SIZE:
+                break
+
+    if purged:
+        metrics.inc('compaction.purged', purged)
+        logger.info("Purged %s deleted entries", purged)
@@ -1,22 +1,83 @@
 from sqlalchemy.orm import Session
-from maaserbot.models.models import User, Income, Payment, CalculationType, AccessRequest
-from datetime import datetime
-import os
-from dotenv import load_dotenv
+from maaserbot.models.models import (
+    User, Income, Payment, CalculationType, AccessRequest, Broadcast, calculation_rate,
+    IncomeArchive, PaymentArchive, UserMonthlyTotal, RecurringEntry, obligation_for
+)
+from maaserbot.models.rollup import OBLIGATION_COLUMNS, refresh_months, add_to_months, month_key, obligation_column
+from maaserbot.models.search import search_condition, remove_from_search_index, index_descriptions
+from datetime import datetime, timedelta
 import logging
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import func
+from sqlalchemy import bindparam, func, select, or_, update, delete, insert
+from typing import Callable, Iterator, Optional
 
-# Load environment variables
-load_dotenv()
-ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # Default to 0 if not set
+from maaserbot.config import get_settings
+from maaserbot.utils.cache import cache
+
+ADMIN_ID = get_settings().admin_id
 
 # הגדרת לוגר
 logger = logging.getLogger(__name__)
 
+# Callbacks run after a user's incomes or payments change, called as
+# callback(user_id, dates) with the created_at of every affected entry
+_data_change_listeners: list[Callable[[int, tuple], None]] = []
+
+def add_data_change_listener(callback: Callable[[int, tuple], None]) -> None:
+    """Register a callback to run after a user's incomes or payments change (e.g. cache invalidation)."""
+    if callback not in _data_change_listeners:
+        _data_change_listeners.append(callback)
+
+def _bump_data_version(db: Session, user_id: int) -> None:
+    # Runs in the caller's transaction, so the version changes together with the data.
+    # A loaded user gets the new version too: update sessions don't expire on commit,
+    # and caches keyed by the version must not serve the data from before the change.
+    db.execute(
+        update(User).where(User.id == user_id).values(data_version=User.data_version + 1)
+        .execution_options(synchronize_session='evaluate')
+    )
+
+# How long a deletion can be undone. The compaction job purges tombstones after this.
+UNDO_WINDOW = timedelta(minutes=10)
+
+def _data_changed(user_id: int, *dates: datetime) -> None:
+    for callback in _data_change_listeners:
+        try:
+            callback(user_id, dates)
+        except Exception as e:
+            logger.error("Data change listener %s failed for user %s: %s", callback.__name__, user_id, e)
+
+# Statements of the hottest lookups, built once. Values are passed as bound
+# parameters, so each call skips building the statement and hits the
+# engine's compiled cache (see the compiled cache line of /slow_queries).
+_USER_BY_TELEGRAM_ID = select(User).where(User.telegram_id == bindparam('telegram_id'))
+_ADMIN_BY_TELEGRAM_ID = _USER_BY_TELEGRAM_ID.where(User.is_admin == True)
+_USER_CUSTOM_RATE = select(User.custom_rate).where(User.id == bindparam('user_id'))
+_OBLIGATION = sum(getattr(UserMonthlyTotal, column) for column in OBLIGATION_COLUMNS.values())
+_BALANCE_TOTALS = select(
+    func.coalesce(func.sum(UserMonthlyTotal.income), 0.0),
+    func.coalesce(func.sum(_OBLIGATION), 0.0),
+    func.coalesce(func.sum(UserMonthlyTotal.paid), 0.0),
+).where(UserMonthlyTotal.user_id == bindparam('user_id'))
+_INCOME_COUNT = select(func.count()).select_from(Income).where(Income.user_id == bindparam('user_id'))
+_PAYMENT_COUNT = select(func.count()).select_from(Payment).where(Payment.user_id == bindparam('user_id'))
+_INCOME_PAGE = (
+    select(Income).where(Income.user_id == bindparam('user_id'))
+    .order_by(Income.created_at.desc()).offset(bindparam('offset')).limit(bindparam('limit'))
+)
+_PAYMENT_PAGE = (
+    select(Payment).where(Payment.user_id == bindparam('user_id'))
+    .order_by(Payment.created_at.desc()).offset(bindparam('offset')).limit(bindparam('limit'))
+)
+_USER_INCOME = select(Income).where(Income.id == bindparam('income_id'), Income.user_id == bindparam('user_id'))
+_USER_PAYMENT = select(Payment).where(Payment.id == bindparam('payment_id'), Payment.user_id == bindparam('user_id'))
+
+def _get_admin(db: Session, telegram_id: int) -> Optional[User]:
+    return db.execute(_ADMIN_BY_TELEGRAM_ID, {'telegram_id': telegram_id}).scalars().first()
+
 def get_or_create_user(db: Session, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> User:
     """Get or create a user."""
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    user = db.execute(_USER_BY_TELEGRAM_ID, {'telegram_id': telegram_id}).scalars().first()
     if not user:
         user = User(
             telegram_id=telegram_id,
@@ -31,6 +92,31 @@ def get_or_create_user(db: Session, telegram_id: int, username: str = None, firs
         db.commit()
     return user
 
+# Permission records change rarely, and approvals drop them right away
+PERMISSION_CACHE_TTL = 300
+
+def _permission_key(telegram_id: int) -> tuple:
+    return ('permission', telegram_id)
+
+def get_user_permissions(db: Session, telegram_id: int) -> dict:
+    """
+    Get a user's permission record, cached across bot processes.
+
+    Args:
+        db: The database session, only used on a cache miss
+        telegram_id: The user's Telegram ID (the user is created if new)
+
+    Returns:
+        dict: {'is_approved': bool, 'is_admin': bool}
+    """
+    key = _permission_key(telegram_id)
+    permissions = cache.get(key)
+    if permissions is None:
+        user = get_or_create_user(db, telegram_id)
+        permissions = {'is_approved': bool(user.is_approved), 'is_admin': bool(user.is_admin)}
+        cache.set(key, permissions, ttl=PERMISSION_CACHE_TTL)
+    return permissions
+
 def create_access_request(db: Session, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> AccessRequest:
     """Create a new access request."""
     try:
@@ -52,10 +138,10 @@ def create_access_request(db: Session, telegram_id: int, username: str = None, f
         db.add(request)
         db.commit()
         db.refresh(request)
-        logger.info(f"Created new access request for user {telegram_id}")
+        logger.info("Created new access request for user %s", telegram_id)
         return request
     except SQLAlchemyError as e:
-        logger.error(f"Database error in create_access_request: {str(e)}")
+        logger.error("Database error in create_access_request: %s", e)
         db.rollback()
         raise
 
@@ -64,15 +150,15 @@ def get_pending_access_requests(db: Session) -> list[AccessRequest]:
     try:
         return db.query(AccessRequest).filter(AccessRequest.status == "pending").all()
     except SQLAlchemyError as e:
-        logger.error(f"Database error in get_pending_access_requests: {str(e)}")
+        logger.error("Database error in get_pending_access_requests: %s", e)
         raise
 
 def approve_access_request(db: Session, admin_id: int, request_id: int) -> bool:
     """Approve an access request."""
     try:
-        admin = db.query(User).filter(User.telegram_id == admin_id).first()
-        if not admin or not admin.is_admin:
-            logger.warning(f"Non-admin user {admin_id} tried to approve access request")
+        admin = _get_admin(db, admin_id)
+        if not admin:
+            logger.warning("Non-admin user %s tried to approve access request", admin_id)
             return False
             
         request = db.query(AccessRequest).filter(AccessRequest.id == request_id).first()
@@ -93,19 +179,20 @@ def approve_access_request(db: Session, admin_id: int, request_id: int) -> bool:
         user.is_approved = True
         
         db.commit()
-        logger.info(f"Access request {request_id} approved by admin {admin_id}")
+        cache.delete(_permission_key(request.telegram_id))
+        logger.info("Access request %s approved by admin %s", request_id, admin_id)
         return True
     except SQLAlchemyError as e:
-        logger.error(f"Database error in approve_access_request: {str(e)}")
+        logger.error("Database error in approve_access_request: %s", e)
         db.rollback()
         raise
 
 def reject_access_request(db: Session, admin_id: int, request_id: int) -> bool:
     """Reject an access request."""
     try:
-        admin = db.query(User).filter(User.telegram_id == admin_id).first()
-        if not admin or not admin.is_admin:
-            logger.warning(f"Non-admin user {admin_id} tried to reject access request")
+        admin = _get_admin(db, admin_id)
+        if not admin:
+            logger.warning("Non-admin user %s tried to reject access request", admin_id)
             return False
             
         request = db.query(AccessRequest).filter(AccessRequest.id == request_id).first()
@@ -114,27 +201,48 @@ def reject_access_request(db: Session, admin_id: int, request_id: int) -> bool:
             
         request.status = "rejected"
         db.commit()
-        logger.info(f"Access request {request_id} rejected by admin {admin_id}")
+        logger.info("Access request %s rejected by admin %s", request_id, admin_id)
         return True
     except SQLAlchemyError as e:
-        logger.error(f"Database error in reject_access_request: {str(e)}")
+        logger.error("Database error in reject_access_request: %s", e)
         db.rollback()
         raise
 
-def add_income(db: Session, user_id: int, amount: float, calc_type: CalculationType = None, description: str = None) -> Income:
-    """Add a new income."""
+def add_income(db: Session, user_id: int, amount: float, calc_type: CalculationType = None, description: str = None,
+               deductible: float = 0.0) -> Income:
+    """
+    Add a new income.
+
+    The rate and the amount owed are stored with the income, so later changes
+    to the user's settings don't rewrite history.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        amount: The income amount
+        calc_type: The calculation type, defaults to the user's default
+        description: Optional description
+        deductible: Expenses deducted from the amount before calculating the obligation
+    """
+    user = db.get(User, user_id)
     if calc_type is None:
-        user = db.query(User).filter(User.id == user_id).first()
         calc_type = user.default_calc_type
+    calc_type = calc_type.value if isinstance(calc_type, CalculationType) else calc_type
+    created_at = datetime.utcnow()
     income = Income(
         user_id=user_id,
         amount=amount,
-        calc_type=calc_type.value if isinstance(calc_type, CalculationType) else calc_type,
-        description=description
+        calc_type=calc_type,
+        rate=calculation_rate(calc_type, user.custom_rate if user else None),
+        deductible=deductible,
+        description=description,
+        created_at=created_at
     )
     db.add(income)
+    _bump_data_version(db, user_id)
     db.commit()
-    logger.info(f"Added income for user {user_id}: {amount}")
+    _data_changed(user_id, created_at)
+    logger.info("Added income for user %s: %s", user_id, amount)
     return income
 
 def add_payment(db: Session, user_id: int, amount: float) -> Payment:
@@ -145,35 +253,24 @@ def add_payment(db: Session, user_id: int, amount: float) -> Payment:
             amount=amount
         )
         db.add(payment)
+        _bump_data_version(db, user_id)
         db.commit()
         db.refresh(payment)
-        logger.info(f"Added payment for user {user_id}: {amount}")
+        _data_changed(user_id, payment.created_at)
+        logger.info("Added payment for user %s: %s", user_id, amount)
         return payment
     except SQLAlchemyError as e:
-        logger.error(f"Database error in add_payment: {str(e)}")
+        logger.error("Database error in add_payment: %s", e)
         db.rollback()
         raise
 
 def get_user_balance(db: Session, user_id: int) -> dict:
-    user = db.query(User).filter(User.id == user_id).first()
+    user = db.get(User, user_id)
     if not user:
         return None
         
-    total_income = 0
-    total_maaser = 0
-    total_paid = 0
-    
-    # Calculate total income and maaser
-    for income in user.incomes:
-        total_income += income.amount
-        if income.calc_type == CalculationType.MAASER:
-            total_maaser += income.amount * 0.1
-        else:  # CHOMESH
-            total_maaser += income.amount * 0.2
-            
-    # Calculate total paid
-    for payment in user.payments:
-        total_paid += payment.amount
+    # All-time totals from the monthly rollup, archived years included
+    total_income, total_maaser, total_paid = db.execute(_BALANCE_TOTALS, {'user_id': user_id}).one()
         
     return {
         "total_income": total_income,
@@ -182,21 +279,106 @@ def get_user_balance(db: Session, user_id: int) -> dict:
         "remaining": total_maaser - total_paid
     } 
 
+def get_cached_balance(db: Session, user: User) -> dict:
+    """
+    Get the balance of a loaded user, cached across bot processes.
+
+    The cache key includes the user's data version, so any change to their
+    incomes or payments makes the next call compute it again.
+
+    Args:
+        db: The database session, only used on a cache miss
+        user: The user
+
+    Returns:
+        dict: Same as get_user_balance
+    """
+    key = ('balance', user.id, user.data_version)
+    balance = cache.get(key)
+    if balance is None:
+        balance = get_user_balance(db, user.id)
+        cache.set(key, balance)
+    return balance
+
+def get_period_totals(db: Session, user_id: int, year: int = None) -> dict:
+    """
+    Get a user's totals bucketed by period.
+    
+    Without `year` the buckets are years; with `year` they are the months of that year.
+    
+    Args:
+        db: The database session
+        user_id: The user's id
+        year: Restrict to this year and bucket by month
+        
+    Returns:
+        dict: Bucket (year or month number) to {'income', 'obligation': {calc_type: amount}, 'paid'}
+    """
+    # At most 12 rollup rows per year, archived years included. Columns rather than
+    # objects, since the rollup is written with Core statements the session doesn't track.
+    stmt = select(UserMonthlyTotal.__table__).where(UserMonthlyTotal.user_id == user_id)
+    if year is not None:
+        stmt = stmt.where(UserMonthlyTotal.month.between(year * 100 + 1, year * 100 + 12))
+        
+    totals = {}
+    for row in db.execute(stmt):
+        entry = totals.setdefault(row.month % 100 if year is not None else row.month // 100,
+                                  {'income': 0.0, 'obligation': {}, 'paid': 0.0})
+        entry['income'] += row.income
+        entry['paid'] += row.paid
+        for calc_type, column in OBLIGATION_COLUMNS.items():
+            amount = getattr(row, column)
+            if amount:
+                entry['obligation'][calc_type] = entry['obligation'].get(calc_type, 0.0) + amount
+            
+    return totals
+
+def get_daily_totals(db: Session, user_id: int) -> list[tuple]:
+    """
+    Get a user's income, obligation and payments summed per day, archived years included.
+    
+    Returns:
+        list: Rows of (day as 'YYYY-MM-DD', income, obligation, paid), oldest first
+    """
+    days = {}
+    for model in (Income, IncomeArchive):
+        income_day = func.date(model.created_at)
+        for day, income, obligation in db.execute(
+            select(income_day, func.sum(model.amount), func.sum(model.obligation_amount))
+            .where(model.user_id == user_id)
+            .group_by(income_day)
+        ):
+            totals = days.setdefault(str(day), [0.0, 0.0, 0.0])
+            totals[0] += income
+            totals[1] += obligation
+            
+    for model in (Payment, PaymentArchive):
+        payment_day = func.date(model.created_at)
+        for day, paid in db.execute(
+            select(payment_day, func.sum(model.amount))
+            .where(model.user_id == user_id)
+            .group_by(payment_day)
+        ):
+            days.setdefault(str(day), [0.0, 0.0, 0.0])[2] += paid
+            
+    return [(day, *totals) for day, totals in sorted(days.items())]
+
 def get_user_history(db: Session, user_id: int, page: int = 1, items_per_page: int = 5) -> dict:
     """Get user's income and payment history with pagination."""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = db.get(User, user_id)
     if not user:
         return None
         
     # Get total counts
-    total_incomes = db.query(Income).filter(Income.user_id == user_id).count()
-    total_payments = db.query(Payment).filter(Payment.user_id == user_id).count()
+    params = {'user_id': user_id}
+    total_incomes = db.execute(_INCOME_COUNT, params).scalar()
+    total_payments = db.execute(_PAYMENT_COUNT, params).scalar()
     
     # Calculate offset
-    offset = (page - 1) * items_per_page
+    page_params = {'user_id': user_id, 'offset': (page - 1) * items_per_page, 'limit': items_per_page}
         
-    incomes = db.query(Income).filter(Income.user_id == user_id).order_by(Income.created_at.desc()).offset(offset).limit(items_per_page).all()
-    payments = db.query(Payment).filter(Payment.user_id == user_id).order_by(Payment.created_at.desc()).offset(offset).limit(items_per_page).all()
+    incomes = db.execute(_INCOME_PAGE, page_params).scalars().all()
+    payments = db.execute(_PAYMENT_PAGE, page_params).scalars().all()
     
     # Calculate total pages
     total_items = max(total_incomes, total_payments)
@@ -211,166 +393,712 @@ def get_user_history(db: Session, user_id: int, page: int = 1, items_per_page: i
         "total_payments": total_payments
     } 
 
-def update_user_settings(db: Session, user_id: int, default_calc_type: CalculationType = None) -> User:
-    """Update user settings."""
-    user = db.query(User).filter(User.id == user_id).first()
+def search_incomes(db: Session, user_id: int, query: str, page: int = 1, items_per_page: int = 5) -> dict:
+    """
+    Search a user's incomes by description, newest first.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        query: The search text; every word must match the start of a word in the description
+        page: Page number, from 1
+        items_per_page: Incomes per page
+
+    Returns:
+        dict: incomes, current_page, total_pages and total (no incomes for a query without words)
+    """
+    condition = search_condition(db.get_bind().dialect.name, user_id, query)
+    if condition is None:
+        return {"incomes": [], "current_page": 1, "total_pages": 0, "total": 0}
+    criteria = (Income.user_id == user_id, condition)
+    total = db.execute(select(func.count()).select_from(Income).where(*criteria)).scalar()
+    total_pages = (total + items_per_page - 1) // items_per_page
+    page = min(max(1, page), max(total_pages, 1))
+    incomes = db.execute(
+        select(Income).where(*criteria).order_by(Income.created_at.desc())
+        .offset((page - 1) * items_per_page).limit(items_per_page)
+    ).scalars().all()
+    return {"incomes": incomes, "current_page": page, "total_pages": total_pages, "total": total}
+
+def update_user_settings(db: Session, user_id: int, default_calc_type: CalculationType = None,
+                         custom_rate: float = None) -> User:
+    """Update user settings. custom_rate is the share owed with CalculationType.CUSTOM (e.g. 0.15)."""
+    user = db.get(User, user_id)
     if user:
         if default_calc_type is not None:
             user.default_calc_type = default_calc_type.value
+        if custom_rate is not None:
+            user.custom_rate = custom_rate
         db.commit()
     return user
 
-def delete_all_user_data(db: Session, user_id: int) -> bool:
-    """Delete all data for a user."""
+def set_reminder_threshold(db: Session, user_id: int, threshold: float = None) -> User:
+    """Set the balance above which the user gets reminders. None turns reminders off."""
+    user = db.get(User, user_id)
+    if user:
+        user.reminder_threshold = threshold
+        db.commit()
+    return user
+
+def get_users_due_for_reminder(db: Session, repeat_after: timedelta, now: datetime = None):
+    """
+    Find users whose outstanding balance exceeds their reminder threshold.
+    
+    All balances are computed in a single aggregated query, restricted to users
+    with reminders turned on who were not reminded within `repeat_after`.
+    
+    Args:
+        db: The database session
+        repeat_after: Minimum time between two reminders to the same user
+        now: The current time (defaults to utcnow)
+        
+    Returns:
+        Result: Rows of (id, telegram_id, outstanding), streamed from the database
+    """
+    now = now or datetime.utcnow()
+    eligible = (
+        select(User.id)
+        .where(
+            User.is_approved == True,
+            User.reminder_threshold.isnot(None),
+            or_(User.last_reminded_at.is_(None), User.last_reminded_at <= now - repeat_after)
+        )
+    )
+    # Balances from the monthly rollup, archived years included
+    totals = (
+        select(UserMonthlyTotal.user_id, func.sum(_OBLIGATION - UserMonthlyTotal.paid).label('outstanding'))
+        .where(UserMonthlyTotal.user_id.in_(eligible))
+        .group_by(UserMonthlyTotal.user_id)
+        .subquery()
+    )
+    outstanding = func.coalesce(totals.c.outstanding, 0)
+    stmt = (
+        select(User.id, User.telegram_id, outstanding.label('outstanding'))
+        .outerjoin(totals, totals.c.user_id == User.id)
+        .where(User.id.in_(eligible), outstanding > User.reminder_threshold)
+        .order_by(User.id)
+        .execution_options(stream_results=True, yield_per=500)
+    )
+    return db.execute(stmt)
+
+def mark_users_reminded(db: Session, user_ids: list[int], when: datetime = None) -> None:
+    """Record that the given users were reminded, in a single UPDATE."""
+    if not user_ids:
+        return
     try:
-        db.query(Income).filter(Income.user_id == user_id).delete()
-        db.query(Payment).filter(Payment.user_id == user_id).delete()
-        user = db.query(User).filter(User.id == user_id).first()
-        if user:
-            user.default_calc_type = CalculationType.MAASER.value
+        db.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            .values(last_reminded_at=when or datetime.utcnow())
+        )
         db.commit()
-        logger.warning(f"Deleted all data for user {user_id}")
-        return True
     except SQLAlchemyError as e:
-        logger.error(f"Database error in delete_all_user_data: {str(e)}")
+        logger.error("Database error in mark_users_reminded: %s", e)
         db.rollback()
-        return False
+        raise
+
+# Tables with tombstones - delete-all, undo and compaction cover all of them
+SOFT_DELETE_MODELS = (Income, Payment, IncomeArchive, PaymentArchive)
+
+def _tombstone(db: Session, model, user_id: int, deleted_at: datetime, *criteria) -> list[datetime]:
+    # A single UPDATE; returns the created_at of the rows it deleted, whose months
+    # the caller refreshes in the monthly rollup
+    return db.execute(
+        update(model)
+        .where(model.user_id == user_id, *criteria)
+        .values(deleted_at=deleted_at)
+        .returning(model.created_at)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
 
-def delete_income(db: Session, income_id: int, user_id: int) -> bool:
-    """מחיקת הכנסה ספציפית."""
+def delete_all_user_data(db: Session, user_id: int) -> Optional[datetime]:
+    """
+    Delete all data for a user.
+
+    Entries are tombstoned and purged later by the compaction job, so the
+    deletion can be undone with restore_deleted within UNDO_WINDOW. Recurring
+    entries are stopped, and stay stopped after an undo.
+
+    Returns:
+        datetime: The deletion time (the undo token), or None on error
+    """
     try:
-        income = db.query(Income).filter(Income.id == income_id, Income.user_id == user_id).first()
-        if not income:
-            logger.warning(f"ניסיון למחוק הכנסה {income_id} שלא קיימת או לא שייכת למשתמש {user_id}")
-            return False
+        deleted_at = datetime.utcnow()
+        dates = []
+        for model in SOFT_DELETE_MODELS:
+            dates += _tombstone(db, model, user_id, deleted_at)
+        refresh_months(db, user_id, dates)
+        db.execute(
+            update(RecurringEntry).where(RecurringEntry.user_id == user_id, RecurringEntry.active == True)
+            .values(active=False)
+        )
+        _bump_data_version(db, user_id)
+        db.execute(update(User).where(User.id == user_id).values(default_calc_type=CalculationType.MAASER.value))
+        db.commit()
+        _data_changed(user_id, *set(dates))
+        logger.warning("Deleted all data for user %s", user_id)
+        return deleted_at
+    except SQLAlchemyError as e:
+        logger.error("Database error in delete_all_user_data: %s", e)
+        db.rollback()
+        return None
+
+def delete_income(db: Session, income_id: int, user_id: int) -> Optional[datetime]:
+    """מחיקת הכנסה ספציפית. מחזיר את זמן המחיקה (לביטול) או None אם ההכנסה לא נמצאה."""
+    try:
+        deleted_at = datetime.utcnow()
+        dates = _tombstone(db, Income, user_id, deleted_at, Income.id == income_id)
+        if not dates:
+            logger.warning("ניסיון למחוק הכנסה %s שלא קיימת או לא שייכת למשתמש %s", income_id, user_id)
+            db.rollback()
+            return None
             
-        db.delete(income)
+        refresh_months(db, user_id, dates)
+        _bump_data_version(db, user_id)
         db.commit()
-        logger.info(f"הכנסה {income_id} נמחקה בהצלחה")
-        return True
+        _data_changed(user_id, *dates)
+        logger.info("הכנסה %s נמחקה בהצלחה", income_id)
+        return deleted_at
     except Exception as e:
-        logger.error(f"שגיאה במחיקת הכנסה {income_id}: {str(e)}")
+        logger.error("שגיאה במחיקת הכנסה %s: %s", income_id, e)
         db.rollback()
         raise
 
-def delete_payment(db: Session, payment_id: int, user_id: int) -> bool:
-    """מחיקת תשלום ספציפי."""
+def delete_payment(db: Session, payment_id: int, user_id: int) -> Optional[datetime]:
+    """מחיקת תשלום ספציפי. מחזיר את זמן המחיקה (לביטול) או None אם התשלום לא נמצא."""
     try:
-        payment = db.query(Payment).filter(Payment.id == payment_id, Payment.user_id == user_id).first()
-        if not payment:
-            logger.warning(f"ניסיון למחוק תשלום {payment_id} שלא קיים או לא שייך למשתמש {user_id}")
-            return False
+        deleted_at = datetime.utcnow()
+        dates = _tombstone(db, Payment, user_id, deleted_at, Payment.id == payment_id)
+        if not dates:
+            logger.warning("ניסיון למחוק תשלום %s שלא קיים או לא שייך למשתמש %s", payment_id, user_id)
+            db.rollback()
+            return None
             
-        db.delete(payment)
+        refresh_months(db, user_id, dates)
+        _bump_data_version(db, user_id)
         db.commit()
-        logger.info(f"תשלום {payment_id} נמחק בהצלחה")
-        return True
+        _data_changed(user_id, *dates)
+        logger.info("תשלום %s נמחק בהצלחה", payment_id)
+        return deleted_at
     except Exception as e:
-        logger.error(f"שגיאה במחיקת תשלום {payment_id}: {str(e)}")
+        logger.error("שגיאה במחיקת תשלום %s: %s", payment_id, e)
+        db.rollback()
+        raise
+
+def restore_deleted(db: Session, user_id: int, deleted_at: datetime, now: datetime = None) -> int:
+    """
+    Undo a deletion.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        deleted_at: The deletion time returned by the delete function
+        now: Current time (for tests)
+
+    Returns:
+        int: Number of restored entries - 0 if the undo window has passed
+    """
+    now = now or datetime.utcnow()
+    if now - deleted_at > UNDO_WINDOW:
+        return 0
+    try:
+        dates = []
+        for model in SOFT_DELETE_MODELS:
+            dates += db.execute(
+                update(model)
+                .where(model.user_id == user_id, model.deleted_at == deleted_at)
+                .values(deleted_at=None)
+                .returning(model.created_at)
+                .execution_options(include_deleted=True)
+            ).scalars().all()
+        if dates:
+            refresh_months(db, user_id, dates)
+            _bump_data_version(db, user_id)
+        db.commit()
+        _data_changed(user_id, *set(dates))
+        logger.info("Restored %s deleted entries for user %s", len(dates), user_id)
+        return len(dates)
+    except SQLAlchemyError as e:
+        logger.error("Database error in restore_deleted: %s", e)
+        db.rollback()
+        raise
+
+def purge_deleted(db: Session, model, before: datetime, batch_size: int) -> int:
+    """
+    Permanently delete one batch of tombstones.
+
+    Args:
+        db: The database session
+        model: One of SOFT_DELETE_MODELS
+        before: Only tombstones deleted before this time are purged
+        batch_size: Maximum rows to delete
+
+    Returns:
+        int: Number of purged rows
+    """
+    try:
+        # The ids are read first, so the search index and the rows lose exactly the same batch
+        batch = db.execute(
+            select(model.id)
+            .where(model.deleted_at.isnot(None), model.deleted_at < before)
+            .order_by(model.id)
+            .limit(batch_size)
+            .execution_options(include_deleted=True)
+        ).scalars().all()
+        if not batch:
+            return 0
+        if model is Income:
+            remove_from_search_index(db, batch)
+        result = db.execute(
+            delete(model).where(model.id.in_(batch)).execution_options(include_deleted=True, synchronize_session=False)
+        )
+        db.commit()
+        return result.rowcount
+    except SQLAlchemyError as e:
+        logger.error("Database error in purge_deleted: %s", e)
+        db.rollback()
+        raise
+
+def get_users_with_closed_entries(db: Session, before: datetime) -> list[int]:
+    """
+    Find users with live incomes or payments dated before `before`.
+
+    Returns:
+        list: User ids, ascending
+    """
+    rows = db.execute(
+        select(Income.user_id).where(Income.created_at < before)
+        .union(select(Payment.user_id).where(Payment.created_at < before))
+    ).scalars().all()
+    return sorted(rows)
+
+def _move_to_archive(db: Session, model, archive, user_ids: list[int], before: datetime) -> set:
+    # Core statements on the tables, so the tombstone filter is spelled out
+    table = model.__table__
+    condition = (table.c.user_id.in_(user_ids), table.c.created_at < before, table.c.deleted_at.is_(None))
+    columns = [column.name for column in archive.__table__.columns if column.name != 'deleted_at']
+    moved = set(db.execute(select(table.c.user_id).where(*condition).distinct()).scalars())
+    db.execute(insert(archive.__table__).from_select(columns, select(*(table.c[name] for name in columns)).where(*condition)))
+    if model is Income:
+        # Archived incomes leave the history screen and the search with it
+        remove_from_search_index(db, select(table.c.id).where(*condition))
+    db.execute(delete(table).where(*condition))
+    return moved
+
+def archive_closed_entries(db: Session, user_ids: list[int], before: datetime) -> int:
+    """
+    Move the given users' entries dated before `before` to the archive tables.
+
+    Balances and reports read the monthly totals, which cover the archive
+    too, so they stay the same while the hot tables only keep the open period.
+
+    Args:
+        db: The database session
+        user_ids: Users to archive (a batch from get_users_with_closed_entries)
+        before: Start of the first period that stays live (January 1st)
+
+    Returns:
+        int: Number of users whose entries were archived
+    """
+    try:
+        changed = (_move_to_archive(db, Income, IncomeArchive, user_ids, before)
+                   | _move_to_archive(db, Payment, PaymentArchive, user_ids, before))
+        # Archived entries leave the history screen, so cached screens must be rendered again
+        if changed:
+            db.execute(
+                update(User).where(User.id.in_(changed)).values(data_version=User.data_version + 1)
+                .execution_options(synchronize_session=False)
+            )
+        db.commit()
+        return len(changed)
+    except SQLAlchemyError as e:
+        logger.error("Database error in archive_closed_entries: %s", e)
         db.rollback()
         raise
 
-def edit_income(db: Session, income_id: int, user_id: int, amount: float = None, description: str = None, calc_type: CalculationType = None) -> Income:
-    """עריכת הכנסה קיימת."""
+def edit_income(db: Session, income_id: int, user_id: int, amount: float = None, description: str = None, calc_type: CalculationType = None,
+                deductible: float = None) -> Income:
+    """עריכת הכנסה קיימת. הסכום לתשלום מחושב מחדש בשמירה."""
     try:
-        income = db.query(Income).filter(Income.id == income_id, Income.user_id == user_id).first()
+        income = db.execute(_USER_INCOME, {'income_id': income_id, 'user_id': user_id}).scalars().first()
         if not income:
-            logger.warning(f"ניסיון לערוך הכנסה {income_id} שלא קיימת או לא שייכת למשתמש {user_id}")
+            logger.warning("ניסיון לערוך הכנסה %s שלא קיימת או לא שייכת למשתמש %s", income_id, user_id)
             return None
             
         if amount is not None:
             income.amount = amount
         if description is not None:
             income.description = description
+        if deductible is not None:
+            income.deductible = deductible
         if calc_type is not None:
-            income.calc_type = calc_type
+            income.calc_type = calc_type.value if isinstance(calc_type, CalculationType) else calc_type
+            custom_rate = db.execute(_USER_CUSTOM_RATE, {'user_id': user_id}).scalar()
+            income.rate = calculation_rate(income.calc_type, custom_rate)
             
+        _bump_data_version(db, user_id)
         db.commit()
         db.refresh(income)
-        logger.info(f"הכנסה {income_id} עודכנה בהצלחה")
+        _data_changed(user_id, income.created_at)
+        logger.info("הכנסה %s עודכנה בהצלחה", income_id)
         return income
     except Exception as e:
-        logger.error(f"שגיאה בעריכת הכנסה {income_id}: {str(e)}")
+        logger.error("שגיאה בעריכת הכנסה %s: %s", income_id, e)
         db.rollback()
         raise
 
 def edit_payment(db: Session, payment_id: int, user_id: int, amount: float) -> Payment:
     """עריכת תשלום קיים."""
     try:
-        payment = db.query(Payment).filter(Payment.id == payment_id, Payment.user_id == user_id).first()
+        payment = db.execute(_USER_PAYMENT, {'payment_id': payment_id, 'user_id': user_id}).scalars().first()
         if not payment:
-            logger.warning(f"ניסיון לערוך תשלום {payment_id} שלא קיים או לא שייך למשתמש {user_id}")
+            logger.warning("ניסיון לערוך תשלום %s שלא קיים או לא שייך למשתמש %s", payment_id, user_id)
             return None
             
         payment.amount = amount
+        _bump_data_version(db, user_id)
         db.commit()
         db.refresh(payment)
-        logger.info(f"תשלום {payment_id} עודכן בהצלחה")
+        _data_changed(user_id, payment.created_at)
+        logger.info("תשלום %s עודכן בהצלחה", payment_id)
         return payment
     except Exception as e:
-        logger.error(f"שגיאה בעריכת תשלום {payment_id}: {str(e)}")
+        logger.error("שגיאה בעריכת תשלום %s: %s", payment_id, e)
         db.rollback()
         raise 
 
+RECURRING_KINDS = ('income', 'payment')
+
+def next_occurrence(after: datetime, day_of_month: int) -> datetime:
+    """The first day_of_month (at midnight) later than `after`."""
+    occurrence = datetime(after.year, after.month, day_of_month)
+    if occurrence <= after:
+        occurrence = datetime(after.year + after.month // 12, after.month % 12 + 1, day_of_month)
+    return occurrence
+
+def add_recurring_entry(db: Session, user_id: int, kind: str, amount: float, day_of_month: int,
+                        description: str = None, calc_type: CalculationType = None, deductible: float = 0.0,
+                        now: datetime = None) -> RecurringEntry:
+    """
+    Add a monthly income or payment, first added on the next day_of_month.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        kind: 'income' or 'payment'
+        amount: The amount added every month
+        day_of_month: Day of the month to add it on, 1-28
+        description: Optional description, stored with the incomes
+        calc_type: The calculation type of the incomes, defaults to the user's default
+        deductible: Expenses deducted from every income
+
+    Raises:
+        ValueError: If the kind, amount or day is invalid
+    """
+    if kind not in RECURRING_KINDS or amount <= 0 or not 1 <= day_of_month <= 28:
+        raise ValueError("Kind must be income or payment, the amount positive and the day 1-28")
+    try:
+        if kind == 'income' and calc_type is None:
+            calc_type = db.get(User, user_id).default_calc_type
+        entry = RecurringEntry(
+            user_id=user_id,
+            kind=kind,
+            amount=amount,
+            description=description,
+            calc_type=(calc_type.value if isinstance(calc_type, CalculationType) else calc_type) if kind == 'income' else None,
+            deductible=deductible if kind == 'income' else 0.0,
+            day_of_month=day_of_month,
+            next_run_at=next_occurrence(now or datetime.utcnow(), day_of_month)
+        )
+        db.add(entry)
+        db.commit()
+        logger.info("Added recurring %s for user %s: %s on day %s", kind, user_id, amount, day_of_month)
+        return entry
+    except SQLAlchemyError as e:
+        logger.error("Database error in add_recurring_entry: %s", e)
+        db.rollback()
+        raise
+
+def get_recurring_entries(db: Session, user_id: int) -> list[RecurringEntry]:
+    """Get a user's active recurring entries."""
+    return db.execute(
+        select(RecurringEntry)
+        .where(RecurringEntry.user_id == user_id, RecurringEntry.active == True)
+        .order_by(RecurringEntry.id)
+    ).scalars().all()
+
+def delete_recurring_entry(db: Session, entry_id: int, user_id: int) -> bool:
+    """Stop a recurring entry. Entries it already added are kept."""
+    try:
+        result = db.execute(
+            update(RecurringEntry)
+            .where(RecurringEntry.id == entry_id, RecurringEntry.user_id == user_id, RecurringEntry.active == True)
+            .values(active=False)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        return result.rowcount > 0
+    except SQLAlchemyError as e:
+        logger.error("Database error in delete_recurring_entry: %s", e)
+        db.rollback()
+        raise
+
+def materialize_recurring_entries(db: Session, now: datetime = None, batch_size: int = 1000) -> int:
+    """
+    Add the due occurrences of one batch of recurring entries, for all users at once.
+
+    Occurrences missed while the bot was down are added too. The incomes and
+    the payments are each written with one bulk insert, and the monthly
+    totals, the search index, the users' data versions and the rules' next
+    dates are updated in the same transaction, so a batch is added entirely
+    or not at all. On PostgreSQL rules taken by another process are skipped.
+
+    Args:
+        db: The database session
+        now: Occurrences up to this time are due
+        batch_size: Maximum rules handled
+
+    Returns:
+        int: Number of rules handled (less than batch_size when none are left)
+    """
+    now = now or datetime.utcnow()
+    try:
+        due = db.execute(
+            select(RecurringEntry, User.custom_rate)
+            .join(User, User.id == RecurringEntry.user_id)
+            .where(RecurringEntry.active == True, RecurringEntry.next_run_at <= now)
+            .order_by(RecurringEntry.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True, of=RecurringEntry)
+        ).all()
+        if not due:
+            return 0
+        
+        incomes, payments, deltas, dates = [], [], {}, {}
+        for entry, custom_rate in due:
+            occurrence = entry.next_run_at
+            while occurrence <= now:
+                month = deltas.setdefault((entry.user_id, month_key(occurrence)), {})
+                if entry.kind == 'income':
+                    rate = calculation_rate(entry.calc_type, custom_rate)
+                    obligation = obligation_for(entry.amount, rate, entry.deductible)
+                    incomes.append({
+                        'user_id': entry.user_id, 'amount': entry.amount, 'description': entry.description,
+                        'calc_type': entry.calc_type, 'rate': rate, 'deductible': entry.deductible,
+                        'obligation_amount': obligation, 'created_at': occurrence,
+                    })
+                    month['income'] = month.get('income', 0.0) + entry.amount
+                    column = obligation_column(entry.calc_type)
+                    month[column] = month.get(column, 0.0) + obligation
+                else:
+                    payments.append({'user_id': entry.user_id, 'amount': entry.amount, 'created_at': occurrence})
+                    month['paid'] = month.get('paid', 0.0) + entry.amount
+                dates.setdefault(entry.user_id, []).append(occurrence)
+                occurrence = next_occurrence(occurrence, entry.day_of_month)
+            entry.next_run_at = occurrence
+            
+        if incomes:
+            table = Income.__table__
+            inserted = db.execute(insert(table).returning(table.c.id, table.c.user_id, table.c.description), incomes)
+            index_descriptions(db, [row._asdict() for row in inserted])
+        if payments:
+            db.execute(insert(Payment.__table__), payments)
+        add_to_months(db.connection(), deltas)
+        db.execute(
+            update(User).where(User.id.in_(dates)).values(data_version=User.data_version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except SQLAlchemyError as e:
+        logger.error("Database error in materialize_recurring_entries: %s", e)
+        db.rollback()
+        raise
+        
+    for user_id, user_dates in dates.items():
+        _data_changed(user_id, *user_dates)
+    logger.info("Added %s incomes and %s payments from %s recurring entries", len(incomes), len(payments), len(due))
+    return len(due)
+
 def approve_user(db: Session, admin_id: int, user_telegram_id: int) -> bool:
     """Approve a user. Only admins can approve users."""
     try:
-        admin = db.query(User).filter(User.telegram_id == admin_id, User.is_admin == True).first()
+        admin = _get_admin(db, admin_id)
         if not admin:
-            logger.warning(f"Non-admin user {admin_id} tried to approve user {user_telegram_id}")
+            logger.warning("Non-admin user %s tried to approve user %s", admin_id, user_telegram_id)
             return False
             
-        user = db.query(User).filter(User.telegram_id == user_telegram_id).first()
+        user = db.execute(_USER_BY_TELEGRAM_ID, {'telegram_id': user_telegram_id}).scalars().first()
         if not user:
-            logger.warning(f"Tried to approve non-existent user {user_telegram_id}")
+            logger.warning("Tried to approve non-existent user %s", user_telegram_id)
             return False
             
         user.is_approved = True
         db.commit()
-        logger.info(f"User {user_telegram_id} approved by admin {admin_id}")
+        cache.delete(_permission_key(user_telegram_id))
+        logger.info("User %s approved by admin %s", user_telegram_id, admin_id)
         return True
     except SQLAlchemyError as e:
-        logger.error(f"Database error in approve_user: {str(e)}")
+        logger.error("Database error in approve_user: %s", e)
         db.rollback()
         return False
 
 def remove_user_approval(db: Session, admin_id: int, user_telegram_id: int) -> bool:
     """Remove user approval. Only admins can remove approval."""
     try:
-        admin = db.query(User).filter(User.telegram_id == admin_id, User.is_admin == True).first()
+        admin = _get_admin(db, admin_id)
         if not admin:
-            logger.warning(f"Non-admin user {admin_id} tried to remove approval from user {user_telegram_id}")
+            logger.warning("Non-admin user %s tried to remove approval from user %s", admin_id, user_telegram_id)
             return False
             
-        user = db.query(User).filter(User.telegram_id == user_telegram_id).first()
+        user = db.execute(_USER_BY_TELEGRAM_ID, {'telegram_id': user_telegram_id}).scalars().first()
         if not user:
-            logger.warning(f"Tried to remove approval from non-existent user {user_telegram_id}")
+            logger.warning("Tried to remove approval from non-existent user %s", user_telegram_id)
             return False
             
         if user.is_admin:
-            logger.warning(f"Tried to remove approval from admin user {user_telegram_id}")
+            logger.warning("Tried to remove approval from admin user %s", user_telegram_id)
             return False
             
         user.is_approved = False
         db.commit()
-        logger.info(f"User {user_telegram_id} approval removed by admin {admin_id}")
+        cache.delete(_permission_key(user_telegram_id))
+        logger.info("User %s approval removed by admin %s", user_telegram_id, admin_id)
         return True
     except SQLAlchemyError as e:
-        logger.error(f"Database error in remove_user_approval: {str(e)}")
+        logger.error("Database error in remove_user_approval: %s", e)
         db.rollback()
         return False
 
 def get_all_users(db: Session, admin_id: int) -> list:
     """Get all users. Only admins can see all users."""
     try:
-        admin = db.query(User).filter(User.telegram_id == admin_id, User.is_admin == True).first()
+        admin = _get_admin(db, admin_id)
         if not admin:
-            logger.warning(f"Non-admin user {admin_id} tried to get all users")
+            logger.warning("Non-admin user %s tried to get all users", admin_id)
             return None
             
         users = db.query(User).all()
         return users
     except SQLAlchemyError as e:
-        logger.error(f"Database error in get_all_users: {str(e)}")
+        logger.error("Database error in get_all_users: %s", e)
+        db.rollback()
+        return None 
+
+def create_broadcast(db: Session, admin_id: int, text: str) -> Broadcast:
+    """Create a broadcast to all approved users. Only admins can broadcast."""
+    try:
+        admin = _get_admin(db, admin_id)
+        if not admin:
+            logger.warning("Non-admin user %s tried to create a broadcast", admin_id)
+            return None
+            
+        broadcast = Broadcast(admin_telegram_id=admin_id, text=text)
+        db.add(broadcast)
+        db.commit()
+        db.refresh(broadcast)
+        logger.info("Broadcast %s created by admin %s", broadcast.id, admin_id)
+        return broadcast
+    except SQLAlchemyError as e:
+        logger.error("Database error in create_broadcast: %s", e)
         db.rollback()
-        return None 
\ No newline at end of file
+        raise
+
+def get_broadcast(db: Session, broadcast_id: int) -> Broadcast:
+    """Get a broadcast by id."""
+    return db.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+
+def get_running_broadcasts(db: Session) -> list[Broadcast]:
+    """Get broadcasts that were started and have not finished yet."""
+    try:
+        return db.query(Broadcast).filter(Broadcast.status == "running").order_by(Broadcast.id).all()
+    except SQLAlchemyError as e:
+        logger.error("Database error in get_running_broadcasts: %s", e)
+        raise
+
+def iter_broadcast_recipients(db: Session, after_user_id: int, batch_size: int = 200) -> Iterator[list]:
+    """
+    Approved users in id order, in batches.
+    
+    Each batch is a separate keyset query (users.id after the previous batch),
+    so no cursor stays open between batches and the caller can commit its
+    checkpoint in the same session.
+    
+    Args:
+        db: The database session
+        after_user_id: Only users with a larger users.id are returned
+        batch_size: Number of recipients per batch
+        
+    Yields:
+        list: Rows of (users.id, telegram_id)
+    """
+    while True:
+        batch = db.execute(
+            select(User.id, User.telegram_id)
+            .where(User.is_approved == True, User.id > after_user_id)
+            .order_by(User.id)
+            .limit(batch_size)
+        ).all()
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after_user_id = batch[-1][0]
+
+def update_broadcast_progress(db: Session, broadcast_id: int, last_user_id: int, delivered: int = 0,
+                              failed: int = 0, blocked: int = 0, finished: bool = False) -> Broadcast:
+    """
+    Checkpoint a broadcast after a batch was sent.
+    
+    Args:
+        db: The database session
+        broadcast_id: The broadcast to update
+        last_user_id: The largest users.id handled so far
+        delivered: Messages delivered in this batch
+        failed: Messages that failed in this batch
+        blocked: Recipients that blocked the bot in this batch
+        finished: Whether the broadcast is complete
+        
+    Returns:
+        Broadcast: The updated broadcast, or None if it does not exist
+    """
+    try:
+        broadcast = db.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+        if not broadcast:
+            return None
+            
+        broadcast.last_user_id = last_user_id
+        broadcast.delivered += delivered
+        broadcast.failed += failed
+        broadcast.blocked += blocked
+        if finished and broadcast.status == "running":
+            broadcast.status = "done"
+            broadcast.finished_at = datetime.utcnow()
+        db.commit()
+        return broadcast
+    except SQLAlchemyError as e:
+        logger.error("Database error in update_broadcast_progress: %s", e)
+        db.rollback()
+        raise
+
+def cancel_broadcast(db: Session, admin_id: int, broadcast_id: int) -> bool:
+    """Cancel a running broadcast. Only admins can cancel broadcasts."""
+    try:
+        admin = _get_admin(db, admin_id)
+        if not admin:
+            logger.warning("Non-admin user %s tried to cancel broadcast %s", admin_id, broadcast_id)
+            return False
+            
+        broadcast = db.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+        if not broadcast or broadcast.status != "running":
+            return False
+            
+        broadcast.status = "cancelled"
+        broadcast.finished_at = datetime.utcnow()
+        db.commit()
+        logger.info("Broadcast %s cancelled by admin %s", broadcast_id, admin_id)
+        return True
+    except SQLAlchemyError as e:
+        logger.error("Database error in cancel_broadcast: %s", e)
+        db.rollback()
+        return False
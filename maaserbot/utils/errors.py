@@ -73,7 +73,7 @@ def wrap_errors(func: Callable[[Update, ContextTypes.DEFAULT_TYPE, Any], Awaitab
             return await func(update, context, *args, **kwargs)
         except MaaserBotError as e:
             # Already a MaaserBot error, use its user message
-            logger.error(f"MaaserBotError in {func.__name__}: {e.message}")
+            logger.error("MaaserBotError in %s: %s", func.__name__, e.message)
             await send_error_message(update, e.user_message)
         except Exception as e:
             # Map standard exceptions to MaaserBot errors
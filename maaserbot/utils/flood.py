@@ -0,0 +1,93 @@
+"""Per-user flood protection for incoming updates."""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from maaserbot.utils import metrics
+from maaserbot.utils.send_queue import TokenBucket
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Key under which the guard is stored in application.bot_data
+FLOOD_GUARD_KEY = 'flood_guard'
+
+class FloodGuard:
+    """
+    Limits how fast each user's updates are handled, with a token bucket per user.
+
+    A user may send `burst` updates at once and `rate` per second after that;
+    the rest are dropped until the bucket refills.
+    """
+
+    def __init__(self, rate: float = 2, burst: float = 10, max_users: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            rate: Updates per second a user may send
+            burst: Updates a user may send at once
+            max_users: Buckets kept - the least recently active users are dropped first,
+                which is harmless since their buckets have refilled by then
+            clock: Monotonic clock, replaceable for tests
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.clock = clock
+        self._buckets: OrderedDict = OrderedDict()
+        # Updates dropped per user since they were last allowed through, pruned with the buckets
+        self.throttled: dict[int, int] = {}
+
+    def allow(self, user_id: int) -> bool:
+        """
+        Take a token from the user's bucket.
+
+        Returns:
+            bool: True if the update may be handled, False if it should be dropped
+        """
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, clock=self.clock)
+            self._buckets[user_id] = bucket
+            if len(self._buckets) > self.max_users:
+                idle_user, _ = self._buckets.popitem(last=False)
+                self.throttled.pop(idle_user, None)
+        self._buckets.move_to_end(user_id)
+
+        if bucket.consume():
+            dropped = self.throttled.pop(user_id, 0)
+            if dropped:
+                logger.info("User %s is no longer throttled, %s updates were dropped", user_id, dropped)
+            return True
+
+        self.throttled[user_id] = self.throttled.get(user_id, 0) + 1
+        metrics.inc('updates.throttled')
+        if self.throttled[user_id] == 1:
+            logger.warning("Throttling user %s: more than %s/s", user_id, self.rate)
+        return False
+
+async def throttle_floods(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for the first handler group: drop a user's excess updates before any database work.
+
+    Args:
+        update: The incoming update
+        context: The context object
+    """
+    guard: Optional[FloodGuard] = context.bot_data.get(FLOOD_GUARD_KEY)
+    if guard is None or not isinstance(update, Update) or update.effective_user is None:
+        return
+
+    user_id = update.effective_user.id
+    if guard.allow(user_id):
+        return
+
+    # Tell the user once per burst; later taps just time out, so a flood costs no API calls either
+    if update.callback_query and guard.throttled[user_id] == 1:
+        await update.callback_query.answer("⏳ יותר מדי בקשות, נסה שוב בעוד רגע")
+    raise ApplicationHandlerStop
@@ -0,0 +1,206 @@
+"""Liveness and readiness probes for MaaserBot.
+
+The load balancer polls /healthz and /readyz (see maaserbot.webhook). Probes
+that cost a round trip (database, Bot API) are cached for a few seconds so
+frequent polling does not add load of its own.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from telegram.ext import Application
+
+from maaserbot.models import get_engine
+from maaserbot.utils import metrics
+from maaserbot.utils.send_queue import SEND_QUEUE_KEY
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+HEALTH_KEY = 'health'
+
+@dataclass(frozen=True)
+class ReadinessLimits:
+    """Thresholds above which an instance reports itself as not ready."""
+    db_latency: float = 1.0
+    bot_api_latency: float = 3.0
+    loop_lag: float = 0.5
+    pool_saturation: float = 0.9
+    update_queue_depth: int = 100
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how late a periodic sleep wakes up.
+
+    A loop blocked by synchronous work (a slow query, CPU bound code) shows
+    up here long before requests start timing out.
+    """
+
+    def __init__(self, interval: float = 0.5, window: int = 20):
+        self.interval = interval
+        self.window = window
+        self._samples: list[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def lag(self) -> float:
+        """The worst lag over the recent window, in seconds."""
+        return max(self._samples, default=0.0)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            metrics.register_gauge('event_loop.lag', lambda: self.lag)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            metrics.unregister_gauge('event_loop.lag')
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self._samples.append(max(0.0, loop.time() - start - self.interval))
+            del self._samples[:-self.window]
+
+def pool_status(engine: Engine) -> dict:
+    """
+    Get connection pool usage.
+
+    Returns:
+        dict: checked_out, capacity and saturation (checked_out / capacity).
+        Pools without a fixed size (e.g. SQLite in memory) report only checked_out.
+    """
+    pool = engine.pool
+    checked_out = pool.checkedout() if hasattr(pool, 'checkedout') else 0
+    status = {'checked_out': checked_out}
+    if hasattr(pool, 'size') and hasattr(pool, '_max_overflow'):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status['capacity'] = capacity
+        status['saturation'] = checked_out / capacity if capacity else 0.0
+    return status
+
+def _ping_db(engine: Engine) -> float:
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    return time.perf_counter() - start
+
+class HealthChecker:
+    """
+    Collects the readiness report for an application.
+
+    Args:
+        application: The running application
+        limits: Readiness thresholds
+        probe_ttl: Seconds to reuse a database / Bot API probe result
+    """
+
+    def __init__(self, application: Application, limits: ReadinessLimits = ReadinessLimits(),
+                 probe_ttl: float = 5.0, engine: Engine = None):
+        self.application = application
+        self.limits = limits
+        self.probe_ttl = probe_ttl
+        self.engine = engine
+        self.loop_monitor = LoopLagMonitor()
+        self.started_at = time.monotonic()
+        self._probes: dict = {}
+        self._lock = asyncio.Lock()
+
+    def start(self) -> None:
+        """Start measuring event loop lag and publish the gauges."""
+        self.loop_monitor.start()
+        metrics.register_gauge('updates.queue_depth', self.application.update_queue.qsize)
+        metrics.register_gauge('db.pool.checked_out',
+                               lambda: pool_status(self.engine or get_engine())['checked_out'])
+
+    async def stop(self) -> None:
+        await self.loop_monitor.stop()
+        metrics.unregister_gauge('updates.queue_depth')
+        metrics.unregister_gauge('db.pool.checked_out')
+
+    async def _probe(self, name: str, probe) -> dict:
+        cached = self._probes.get(name)
+        if cached and time.monotonic() - cached[0] < self.probe_ttl:
+            return cached[1]
+        try:
+            result = {'ok': True, 'latency': await probe()}
+        except Exception as e:
+            logger.warning("Health probe %s failed: %s", name, e)
+            result = {'ok': False, 'error': str(e)}
+        self._probes[name] = (time.monotonic(), result)
+        return result
+
+    async def _probe_db(self) -> float:
+        # A blocked pool must not block the loop that serves the health check
+        return await asyncio.to_thread(_ping_db, self.engine or get_engine())
+
+    async def _probe_bot_api(self) -> float:
+        start = time.perf_counter()
+        await self.application.bot.get_me()
+        return time.perf_counter() - start
+
+    def liveness(self) -> dict:
+        """Liveness report: answering at all means the loop is running."""
+        return {
+            'status': 'ok',
+            'uptime': round(time.monotonic() - self.started_at, 1),
+            'loop_lag': round(self.loop_monitor.lag, 4),
+        }
+
+    async def readiness(self) -> tuple[bool, dict]:
+        """
+        Check whether this instance should receive traffic.
+
+        Returns:
+            tuple: (ready, report) where report lists each check and the reasons for not being ready
+        """
+        async with self._lock:
+            db = await self._probe('db', self._probe_db)
+            bot_api = await self._probe('bot_api', self._probe_bot_api)
+
+        limits = self.limits
+        pool = pool_status(self.engine or get_engine())
+        loop_lag = self.loop_monitor.lag
+        update_queue = self.application.update_queue.qsize()
+        send_queue = self.application.bot_data.get(SEND_QUEUE_KEY)
+
+        reasons = []
+        if not db['ok']:
+            reasons.append('database unreachable')
+        elif db['latency'] > limits.db_latency:
+            reasons.append('database slow')
+        if not bot_api['ok']:
+            reasons.append('bot api unreachable')
+        elif bot_api['latency'] > limits.bot_api_latency:
+            reasons.append('bot api slow')
+        if pool.get('saturation', 0.0) > limits.pool_saturation:
+            reasons.append('connection pool saturated')
+        if loop_lag > limits.loop_lag:
+            reasons.append('event loop lagging')
+        if update_queue > limits.update_queue_depth:
+            reasons.append('update queue backlog')
+
+        report = {
+            'status': 'ok' if not reasons else 'unavailable',
+            'reasons': reasons,
+            'db': db,
+            'bot_api': bot_api,
+            'pool': pool,
+            'loop_lag': round(loop_lag, 4),
+            'update_queue_depth': update_queue,
+            'send_queue_depth': send_queue.depth() if send_queue else None,
+        }
+        return not reasons, report
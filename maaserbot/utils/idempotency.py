@@ -0,0 +1,164 @@
+"""Deduplication of repeated update deliveries and double-tapped buttons."""
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from maaserbot.utils import metrics
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Key under which the guard is stored in application.bot_data
+IDEMPOTENCY_KEY = 'idempotency_guard'
+
+class TTLSet:
+    """Set whose members expire `ttl` seconds after they were added."""
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        """
+        Args:
+            ttl: Seconds a member stays in the set
+            max_size: Maximum number of members - the oldest are dropped first
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._members: OrderedDict = OrderedDict()
+
+    def _prune(self, now: float) -> None:
+        while self._members:
+            key, expires_at = next(iter(self._members.items()))
+            if expires_at > now and len(self._members) <= self.max_size:
+                break
+            self._members.popitem(last=False)
+
+    def add(self, key: Hashable) -> bool:
+        """
+        Add a member.
+
+        Returns:
+            bool: False if the key was already present (a duplicate), True otherwise
+        """
+        now = time.time()
+        self._prune(now)
+        expires_at = self._members.get(key)
+        if expires_at is not None and expires_at > now:
+            return False
+        self._members[key] = now + self.ttl
+        self._members.move_to_end(key)
+        return True
+
+    def discard(self, key: Hashable) -> None:
+        """Remove a member if present."""
+        self._members.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires_at = self._members.get(key)
+        return expires_at is not None and expires_at > time.time()
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def dump(self) -> list:
+        """Members and their expiry times, for persisting. Only JSON-compatible keys are supported."""
+        self._prune(time.time())
+        return [[list(key) if isinstance(key, tuple) else key, expires_at]
+                for key, expires_at in self._members.items()]
+
+    def load(self, members: list) -> None:
+        """Restore members saved by dump(), skipping the expired ones."""
+        now = time.time()
+        for key, expires_at in members:
+            if expires_at > now:
+                self._members[tuple(key) if isinstance(key, list) else key] = expires_at
+
+class IdempotencyGuard:
+    """
+    Drops updates that were already handled.
+
+    Two kinds of duplicates are detected:
+    - the same update_id delivered again (webhook retries, restarts during polling)
+    - the same button pressed again on the same message by the same user within
+      a few seconds (double taps). Only a repeat of the *last* button pressed on a
+      message counts, so paging back and forth is not affected.
+    """
+
+    def __init__(self, update_ttl: float = 600, callback_ttl: float = 10, path: Optional[str] = None):
+        """
+        Args:
+            update_ttl: Seconds an update_id is remembered
+            callback_ttl: Seconds a button press is remembered
+            path: Optional JSON file the seen update_ids are persisted to across restarts
+        """
+        self.updates = TTLSet(update_ttl)
+        self.callbacks = TTLSet(callback_ttl)
+        self._last_callback: dict = {}
+        self.path = path
+
+    def is_duplicate(self, update: Update) -> bool:
+        """Record the update and tell whether it was seen before."""
+        if not self.updates.add(update.update_id):
+            metrics.inc('idempotency.duplicate_updates')
+            return True
+
+        query = update.callback_query
+        if query and query.message:
+            message_key = (query.from_user.id, query.message.message_id)
+            key = (*message_key, query.data)
+            if key in self.callbacks:
+                metrics.inc('idempotency.duplicate_callbacks')
+                return True
+            # A different button on the same message replaces the remembered one
+            previous = self._last_callback.pop(message_key, None)
+            if previous is not None:
+                self.callbacks.discard(previous)
+            if len(self._last_callback) > self.callbacks.max_size:
+                self._last_callback.clear()
+            self._last_callback[message_key] = key
+            self.callbacks.add(key)
+        return False
+
+    def load(self) -> None:
+        """Load persisted update_ids, if a path is configured."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.updates.load(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load idempotency state from %s: %s", self.path, e)
+
+    def save(self) -> None:
+        """Persist the seen update_ids, if a path is configured."""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.updates.dump(), f)
+        except OSError as e:
+            logger.warning("Could not save idempotency state to %s: %s", self.path, e)
+
+async def drop_duplicate_updates(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for the first handler group: stop duplicate updates before any database work.
+
+    Args:
+        update: The incoming update
+        context: The context object
+    """
+    guard: Optional[IdempotencyGuard] = context.bot_data.get(IDEMPOTENCY_KEY)
+    if guard is None or not isinstance(update, Update):
+        return
+
+    if guard.is_duplicate(update):
+        logger.info("Dropping duplicate update %s", update.update_id)
+        if update.callback_query:
+            # Stop the button's loading spinner
+            await update.callback_query.answer()
+        raise ApplicationHandlerStop
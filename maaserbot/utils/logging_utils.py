@@ -1,40 +1,211 @@
 """Logging utilities for MaaserBot."""
 
+import atexit
+import copy
 import logging
 import os
 import json
-from datetime import datetime
+import queue
+from datetime import datetime, timezone
+from decimal import Decimal
 from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 import traceback
 
-# יצירת תיקיה ללוגים אם לא קיימת
-os.makedirs('logs', exist_ok=True)
+from maaserbot.config import get_settings
 
 # הגדרת לוגר עיקרי
 logger = logging.getLogger('maaserbot')
 
-def setup_logging(log_level=logging.INFO):
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with any `extra` fields included."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Attributes every LogRecord has - anything else came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Argument types that are safe to format later, in the listener thread
+_PLAIN_TYPES = (str, int, float, bool, type(None), Decimal)
+
+def _plain(value):
+    return value if isinstance(value, _PLAIN_TYPES) else str(value)
+
+class LazyQueueHandler(QueueHandler):
     """
-    Setup detailed logging configuration.
-    
+    Puts records on the logging queue without formatting their message.
+
+    The message is formatted by the listener thread. Only arguments that are
+    not plain values are turned into strings here, since their __str__ may
+    touch state (e.g. an ORM object) that must not be used from another thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if isinstance(record.args, dict):
+            record.args = {key: _plain(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(_plain(arg) for arg in record.args)
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a share of the INFO and DEBUG records of chosen loggers.
+
+    Warnings and errors always pass. Sampling is deterministic: with a rate of
+    0.25 the first of every four records of that logger is kept.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        """
+        Args:
+            rates: Logger name to the share of its records kept; applies to its child loggers too
+        """
+        super().__init__()
+        self.rates = rates
+        self._seen: dict[str, int] = {}
+
+    def _rate(self, name: str) -> Optional[float]:
+        while True:
+            if name in self.rates:
+                return self.rates[name]
+            if '.' not in name:
+                return None
+            name = name.rsplit('.', 1)[0]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        seen = self._seen.get(record.name, 0)
+        self._seen[record.name] = seen + 1
+        return seen % round(1 / rate) == 0
+
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    """
+    Parse LOG_SAMPLE, e.g. "httpx=0.05,maaserbot.utils.db=0.2".
+
     Args:
-        log_level: The logging level to use
+        spec: Comma separated logger=rate pairs
+
+    Returns:
+        dict: Logger name to the share of its records kept
     """
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(f'logs/bot_{datetime.now().strftime("%Y%m%d")}.log'),
-            logging.StreamHandler()
-        ]
-    )
-    
+    rates = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[QueueHandler] = None
+
+def setup_logging(level: Optional[str] = None, fmt: Optional[str] = None,
+                  log_file: Optional[str] = None, sample: Optional[str] = None) -> None:
+    """
+    Setup the process-wide logging.
+
+    Loggers only put records on a queue; a background listener formats them and
+    writes them to the log file and stderr, so logging never blocks the event
+    loop on disk or terminal I/O. Arguments left out are taken from the settings.
+
+    Args:
+        level: Root level name (LOG_LEVEL)
+        fmt: 'json' or 'text' (LOG_FORMAT)
+        log_file: File the log is written to, empty for stderr only (LOG_FILE)
+        sample: Per-logger sampling of INFO records (LOG_SAMPLE)
+    """
+    global _listener, _queue_handler
+    settings = get_settings()
+    level = level or settings.log_level
+    fmt = fmt or settings.log_format
+    log_file = settings.log_file if log_file is None else log_file
+    sample = settings.log_sample if sample is None else sample
+
+    shutdown_logging()
+
+    if fmt == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(sample)))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    _queue_handler = queue_handler
+
     # Configure SQLAlchemy logging
     logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
-    
-    logger.info("Logging system initialized")
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    logger.info("Logging system initialized (%s)", fmt)
+
+def shutdown_logging() -> None:
+    """
+    Write out the queued records and stop the logging listener.
+
+    The listener's handlers are then attached to the root logger, so records
+    logged later in the shutdown are written directly instead of being lost.
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    queue_handler, _queue_handler = _queue_handler, None
+    listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    for handler in listener.handlers:
+        handler.flush()
+        for log_filter in queue_handler.filters:
+            handler.addFilter(log_filter)
+        root.addHandler(handler)
+
+atexit.register(shutdown_logging)
 
 def log_action(action_type):
     """
@@ -81,15 +252,16 @@ def log_action(action_type):
                 log_data['duration_ms'] = duration.total_seconds() * 1000
                 
                 # Log to security log file
+                os.makedirs('logs', exist_ok=True)
                 with open(f'logs/security_{datetime.now().strftime("%Y%m%d")}.log', 'a') as f:
                     f.write(json.dumps(log_data) + '\n')
                 
                 # Also log a summary to the main logger
                 action_str = f"{action_type} by user {user.id}"
                 if log_data['success']:
-                    logger.info(f"SUCCESS: {action_str} ({log_data['duration_ms']:.2f}ms)")
+                    logger.info("SUCCESS: %s (%.2fms)", action_str, log_data['duration_ms'])
                 else:
-                    logger.warning(f"FAILED: {action_str} - {log_data.get('error', 'Unknown error')}")
+                    logger.warning("FAILED: %s - %s", action_str, log_data.get('error', 'Unknown error'))
         
         return wrapper
     return decorator
@@ -109,13 +281,13 @@ def log_admin_action(func):
         user = update.effective_user
         
         # Log the admin action with all available context
-        logger.info(f"ADMIN ACTION: {func.__name__} initiated by admin {user.id} ({user.username})")
+        logger.info("ADMIN ACTION: %s initiated by admin %s (%s)", func.__name__, user.id, user.username)
         
         if hasattr(update, 'callback_query') and update.callback_query:
-            logger.info(f"Admin context: callback_data={update.callback_query.data}")
+            logger.info("Admin context: callback_data=%s", update.callback_query.data)
         
         if context.args:
-            logger.info(f"Admin command args: {context.args}")
+            logger.info("Admin command args: %s", context.args)
             
         # Call the original function
         return await func(update, context, *args, **kwargs)
@@ -0,0 +1,84 @@
+"""In-process metrics registry for MaaserBot."""
+
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, Callable[[], float]] = {}
+_collectors: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+def inc(name: str, value: float = 1) -> None:
+    """
+    Increment a counter.
+
+    Args:
+        name: The counter name (e.g. 'send_queue.sent')
+        value: The amount to add
+    """
+    with _lock:
+        _counters[name] += value
+
+def register_gauge(name: str, callback: Callable[[], float]) -> None:
+    """
+    Register a gauge whose value is read when a snapshot is taken.
+
+    Args:
+        name: The gauge name (e.g. 'send_queue.depth.bulk')
+        callback: Function returning the current value
+    """
+    with _lock:
+        _gauges[name] = callback
+
+def unregister_gauge(name: str) -> None:
+    """Remove a previously registered gauge."""
+    with _lock:
+        _gauges.pop(name, None)
+
+def register_collector(name: str, callback: Callable[[], Dict[str, float]]) -> None:
+    """
+    Register a function returning a set of metrics, for metrics whose names aren't known up front.
+
+    Args:
+        name: Identifies the collector (for unregister_collector)
+        callback: Function returning metric names and values
+    """
+    with _lock:
+        _collectors[name] = callback
+
+def unregister_collector(name: str) -> None:
+    """Remove a previously registered collector."""
+    with _lock:
+        _collectors.pop(name, None)
+
+def snapshot() -> Dict[str, float]:
+    """
+    Get the current value of all counters and gauges.
+
+    Returns:
+        dict: Metric name to value
+    """
+    with _lock:
+        values = dict(_counters)
+        gauges = dict(_gauges)
+        collectors = list(_collectors.values())
+
+    for name, callback in gauges.items():
+        try:
+            values[name] = callback()
+        except Exception:
+            values[name] = float('nan')
+    for callback in collectors:
+        try:
+            values.update(callback())
+        except Exception:
+            pass
+    return values
+
+def reset() -> None:
+    """Clear all counters and gauges (used by tests)."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _collectors.clear()
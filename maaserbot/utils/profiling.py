@@ -0,0 +1,209 @@
+"""On-demand profiling of sampled updates.
+
+When enabled (PROFILE_EVERY / PROFILE_USER_ID, or the admin's /profile
+command), one in N updates - or every update of one user - is profiled with
+cProfile. The profiler only runs while that update's own code runs, not
+while other updates interleave with it on the event loop. The slowest
+PROFILE_KEEP profiles are kept and can be dumped as .pstats files (for
+pstats/snakeviz) and .collapsed stack files (for flamegraph.pl/speedscope).
+
+When profiling is off the only cost per update is one comparison.
+"""
+
+import cProfile
+import heapq
+import itertools
+import logging
+import os
+import pstats
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Optional
+
+from maaserbot.utils import metrics
+from maaserbot.utils.slowquery import query_origin
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+@dataclass(order=True)
+class UpdateProfile:
+    """The profile of one handled update."""
+    duration: float
+    update_id: int = field(compare=False)
+    user_id: Optional[int] = field(compare=False)
+    origin: str = field(compare=False)
+    callback_data: Optional[str] = field(compare=False)
+    stats: pstats.Stats = field(compare=False, repr=False)
+
+    @property
+    def name(self) -> str:
+        """File name stem for dumps."""
+        return f"update_{self.update_id}_{self.duration * 1000:.0f}ms"
+
+class _ProfiledCoroutine:
+    """Awaitable that runs a coroutine with the profiler enabled during each of its steps."""
+
+    def __init__(self, coroutine: Awaitable, profile: cProfile.Profile):
+        self._coroutine = coroutine
+        self._profile = profile
+
+    def __await__(self):
+        steps = self._coroutine.__await__()
+        value, error = None, None
+        while True:
+            self._profile.enable()
+            try:
+                future = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self._profile.disable()
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+def collapsed_stacks(stats: pstats.Stats) -> list[str]:
+    """
+    Approximate collapsed stacks ("outer;inner;func microseconds") from a profile.
+
+    cProfile only records caller/callee pairs, so each function's own time is
+    attributed to the path through its most expensive callers.
+
+    Args:
+        stats: The profile
+
+    Returns:
+        list: Lines in the collapsed stack format
+    """
+    entries = stats.stats
+
+    def label(function: tuple) -> str:
+        filename, line, name = function
+        return f"{name} ({os.path.basename(filename)}:{line})".replace(';', ',')
+
+    lines = []
+    for function, (_, _, own_time, _, callers) in entries.items():
+        if own_time <= 0:
+            continue
+        path, seen, current = [label(function)], {function}, callers
+        while current:
+            # The caller that spent the most time calling this function
+            caller = max(current, key=lambda c: current[c][3] if isinstance(current[c], tuple) else 0)
+            if caller in seen or caller not in entries:
+                break
+            seen.add(caller)
+            path.append(label(caller))
+            current = entries[caller][4]
+        lines.append(f"{';'.join(reversed(path))} {int(own_time * 1e6)}")
+    return lines
+
+class UpdateProfiler:
+    """Profiles sampled updates and keeps the slowest ones."""
+
+    def __init__(self, every: int = 0, user_id: Optional[int] = None, keep: int = 10):
+        """
+        Args:
+            every: Profile one in `every` updates, 0 for none
+            user_id: Also profile every update from this Telegram user
+            keep: Number of slowest profiles kept
+        """
+        self.every = every
+        self.user_id = user_id
+        self.keep = keep
+        self._seen = 0
+        self._slowest: list[UpdateProfile] = []
+        self._order = itertools.count()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.every) or self.user_id is not None
+
+    def configure(self, every: int = 0, user_id: Optional[int] = None) -> None:
+        """Change what is profiled; every=0 and user_id=None turn profiling off."""
+        self.every = every
+        self.user_id = user_id
+        self._seen = 0
+        logger.info("Update profiling: every=%s user_id=%s", every, user_id)
+
+    def _selected(self, update: object) -> bool:
+        user = getattr(update, 'effective_user', None)
+        if self.user_id is not None and user is not None and user.id == self.user_id:
+            return True
+        if self.every:
+            self._seen += 1
+            return self._seen % self.every == 0
+        return False
+
+    def wrap(self, update: object, coroutine: Awaitable) -> Awaitable:
+        """
+        Profile the handling of the update if it is sampled.
+
+        Args:
+            update: The update being handled
+            coroutine: Its handling
+
+        Returns:
+            Awaitable: The coroutine itself, or a profiled wrapper
+        """
+        if not self.enabled or not self._selected(update):
+            return coroutine
+        return self._run(update, coroutine)
+
+    async def _run(self, update: object, coroutine: Awaitable) -> None:
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            await _ProfiledCoroutine(coroutine, profile)
+        finally:
+            duration = time.perf_counter() - started
+            metrics.inc('profiling.updates')
+            query = getattr(update, 'callback_query', None)
+            user = getattr(update, 'effective_user', None)
+            self._record(UpdateProfile(
+                duration=duration,
+                update_id=getattr(update, 'update_id', 0),
+                user_id=user.id if user else None,
+                origin=query_origin.get(),
+                callback_data=query.data if query else None,
+                stats=pstats.Stats(profile),
+            ))
+
+    def _record(self, profile: UpdateProfile) -> None:
+        entry = (profile.duration, next(self._order), profile)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        elif profile.duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self) -> list[UpdateProfile]:
+        """The kept profiles, slowest first."""
+        return [profile for _, _, profile in sorted(self._slowest, reverse=True)]
+
+    def dump(self, directory: str) -> list[str]:
+        """
+        Write the kept profiles as .pstats and .collapsed files.
+
+        Args:
+            directory: Where to write them (created if missing)
+
+        Returns:
+            list: The written .pstats paths, slowest first
+        """
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for rank, profile in enumerate(self.slowest(), 1):
+            stem = os.path.join(directory, f"{rank:02d}_{profile.name}")
+            profile.stats.dump_stats(f"{stem}.pstats")
+            with open(f"{stem}.collapsed", 'w') as f:
+                f.write('\n'.join(collapsed_stacks(profile.stats)) + '\n')
+            paths.append(f"{stem}.pstats")
+        return paths
+
+    def clear(self) -> None:
+        """Forget the kept profiles."""
+        self._slowest.clear()
+
+# Profiler of this process, configured by bot.main and /profile
+profiler = UpdateProfiler()
@@ -0,0 +1,101 @@
+"""Counting SQL statements per update, and surfacing hidden lazy loads.
+
+Every statement sent to the database is counted by the QueryCounters active
+in the current context (see count_queries). The update processor counts each
+update: the totals feed the db.queries metric, and updates running more than
+QUERY_WARN_THRESHOLD statements are logged. Tests use the same counters
+through the query_budget fixture (tests/conftest.py).
+
+With DB_RAISELOAD=1 (development) lazy relationship loads on loaded objects
+raise instead of silently running one more query each, so N+1 patterns show
+up right away.
+"""
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, raiseload
+
+from maaserbot.config import get_settings
+from maaserbot.utils import metrics
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+class QueryCounter:
+    """The SQL statements run while the counter was active."""
+
+    def __init__(self, parent: Optional["QueryCounter"] = None):
+        self.parent = parent
+        self.statements: list[str] = []
+
+    @property
+    def count(self) -> int:
+        """Number of statements run."""
+        return len(self.statements)
+
+_current: ContextVar[Optional[QueryCounter]] = ContextVar('query_counter', default=None)
+
+@contextmanager
+def count_queries() -> Iterator[QueryCounter]:
+    """
+    Count the statements run in this context (and tasks started from it) until the block ends.
+
+    Counters nest: statements also count towards the enclosing counters.
+
+    Yields:
+        QueryCounter: The counter
+    """
+    counter = QueryCounter(_current.get())
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(connection, cursor, statement, parameters, context, executemany):
+    counter = _current.get()
+    while counter is not None:
+        counter.statements.append(statement)
+        counter = counter.parent
+
+async def count_update_queries(update: object, coroutine: Awaitable) -> None:
+    """
+    Run the handling of an update, counting its statements.
+
+    Args:
+        update: The update being handled
+        coroutine: Its handling (Application.process_update)
+    """
+    with count_queries() as counter:
+        await coroutine
+    metrics.inc('db.queries', counter.count)
+    threshold = get_settings().query_warn_threshold
+    if threshold and counter.count > threshold:
+        metrics.inc('updates.over_query_threshold')
+        first = '; '.join(statement.split('\n', 1)[0][:80] for statement in counter.statements[:5])
+        logger.warning(
+            "Update %s ran %s SQL statements (threshold %s), first ones: %s",
+            getattr(update, 'update_id', update), counter.count, threshold, first
+        )
+
+def _raise_on_lazy_load(execute_state) -> None:
+    if (not execute_state.is_select or execute_state.is_column_load
+            or execute_state.is_relationship_load or not execute_state.all_mappers):
+        return
+    execute_state.statement = execute_state.statement.options(raiseload('*'))
+
+def enable_raiseload() -> None:
+    """Make lazy relationship loads raise instead of querying (development mode)."""
+    if not event.contains(Session, 'do_orm_execute', _raise_on_lazy_load):
+        event.listen(Session, 'do_orm_execute', _raise_on_lazy_load)
+
+def disable_raiseload() -> None:
+    """Allow lazy relationship loads again."""
+    if event.contains(Session, 'do_orm_execute', _raise_on_lazy_load):
+        event.remove(Session, 'do_orm_execute', _raise_on_lazy_load)
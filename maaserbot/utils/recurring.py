@@ -0,0 +1,45 @@
+"""Background job adding the due occurrences of recurring incomes and payments.
+
+Every run adds everything due for all users in bulk (see
+maaserbot.utils.db.materialize_recurring_entries), so a monthly salary costs
+one batch job instead of an interactive income flow per user.
+"""
+
+import asyncio
+import logging
+
+from telegram.ext import ContextTypes
+
+from maaserbot.models import SessionLocal
+from maaserbot.utils import metrics
+from maaserbot.utils.db import materialize_recurring_entries
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Rules per transaction
+BATCH_SIZE = 1000
+
+def _add_batch() -> int:
+    # Each batch in its own session, so it can run in a worker thread
+    with SessionLocal() as db:
+        return materialize_recurring_entries(db, batch_size=BATCH_SIZE)
+
+async def add_recurring_entries(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job callback: add the due recurring incomes and payments.
+
+    The batches run in a worker thread, so updates are handled meanwhile.
+
+    Args:
+        context: The job context
+    """
+    handled = 0
+    while True:
+        count = await asyncio.to_thread(_add_batch)
+        handled += count
+        if count < BATCH_SIZE:
+            break
+
+    if handled:
+        metrics.inc('recurring.rules', handled)
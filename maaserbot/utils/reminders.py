@@ -0,0 +1,81 @@
+"""Scheduled reminders about outstanding maaser balances."""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from telegram.error import Forbidden
+from telegram.ext import ContextTypes
+
+from maaserbot.config import get_settings
+from maaserbot.models import SessionLocal
+from maaserbot.utils import metrics
+from maaserbot.utils.db import get_users_due_for_reminder, mark_users_reminded
+from maaserbot.utils.send_queue import SEND_QUEUE_KEY, PRIORITY_BULK
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Recipients per batch - each batch is sent concurrently and then marked as reminded
+BATCH_SIZE = 100
+
+# Thresholds offered in the settings screen
+REMINDER_THRESHOLDS = [100, 500, 1000]
+
+def reminder_repeat_after() -> timedelta:
+    """Minimum time between two reminders to the same user."""
+    return timedelta(days=get_settings().reminder_repeat_days)
+
+def reminder_text(outstanding: float) -> str:
+    """Build the reminder message."""
+    return (
+        "🔔 תזכורת מעשרות\n\n"
+        f"📌 יתרה לתשלום: {outstanding:.2f} ₪\n\n"
+        "לסימון תשלום לחץ על /start ובחר 'תשלום מעשרות'."
+    )
+
+async def _send_batch(context: ContextTypes.DEFAULT_TYPE, batch: list) -> list[int]:
+    send_queue = context.bot_data[SEND_QUEUE_KEY]
+    futures = [
+        send_queue.submit(context.bot.send_message, chat_id=row.telegram_id,
+                          text=reminder_text(row.outstanding), priority=PRIORITY_BULK)
+        for row in batch
+    ]
+    handled = []
+    for row, outcome in zip(batch, await asyncio.gather(*futures, return_exceptions=True)):
+        if isinstance(outcome, Forbidden):
+            # Don't retry users who blocked the bot every hour
+            metrics.inc('reminders.blocked')
+            handled.append(row.id)
+        elif isinstance(outcome, Exception):
+            metrics.inc('reminders.failed')
+            logger.error("Failed to send reminder to user %s: %s", row.telegram_id, outcome)
+        else:
+            metrics.inc('reminders.sent')
+            handled.append(row.id)
+    return handled
+
+async def send_balance_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job callback: remind users whose outstanding balance exceeds their threshold.
+
+    Balances come from one aggregated query and are sent in rate-limited
+    batches. Each batch records last_reminded_at so a user is not reminded
+    again before REMINDER_REPEAT_DAYS have passed.
+
+    Args:
+        context: The job context
+    """
+    now = datetime.utcnow()
+    reminded = 0
+
+    # The result is streamed, so updates go through a second session
+    with SessionLocal() as stream_db, SessionLocal() as db:
+        result = get_users_due_for_reminder(stream_db, reminder_repeat_after(), now)
+        for batch in result.partitions(BATCH_SIZE):
+            handled = await _send_batch(context, batch)
+            mark_users_reminded(db, handled, now)
+            reminded += len(handled)
+
+    if reminded:
+        logger.info("Sent balance reminders to %s users", reminded)
@@ -0,0 +1,99 @@
+"""Monthly and yearly reports built from bucketed database totals."""
+
+import logging
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from maaserbot.utils.cache import cache
+from maaserbot.utils.db import get_period_totals, add_data_change_listener
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+def _years_key(user_id: int) -> tuple:
+    return ('report', user_id)
+
+def _months_key(user_id: int, year: int) -> tuple:
+    return ('report', user_id, year)
+
+def _yearly_totals(db: Session, user_id: int) -> dict:
+    totals = cache.get(_years_key(user_id))
+    if totals is None:
+        totals = get_period_totals(db, user_id)
+        cache.set(_years_key(user_id), totals)
+    return totals
+
+def _monthly_totals(db: Session, user_id: int, year: int) -> dict:
+    totals = cache.get(_months_key(user_id, year))
+    if totals is None:
+        totals = get_period_totals(db, user_id, year)
+        cache.set(_months_key(user_id, year), totals)
+    return totals
+
+def _with_carry_over(totals: dict, opening: float) -> list[dict]:
+    rows = []
+    for period in sorted(totals):
+        entry = totals[period]
+        owed = sum(entry['obligation'].values())
+        closing = opening + owed - entry['paid']
+        rows.append({
+            'period': period,
+            'income': entry['income'],
+            'obligation': dict(entry['obligation']),
+            'paid': entry['paid'],
+            'opening': opening,
+            'closing': closing,
+        })
+        opening = closing
+    return rows
+
+def get_years_report(db: Session, user_id: int) -> list[dict]:
+    """
+    Get per-year totals with the balance carried over between years.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+
+    Returns:
+        list: One dict per year with data, oldest first - period, income,
+            obligation (per calc_type), paid, opening and closing balance
+    """
+    return _with_carry_over(_yearly_totals(db, user_id), 0.0)
+
+def get_months_report(db: Session, user_id: int, year: int) -> list[dict]:
+    """
+    Get per-month totals of a year, starting from the balance carried over from earlier years.
+
+    Args:
+        db: The database session
+        user_id: The user's id
+        year: The report year
+
+    Returns:
+        list: One dict per month with data, in the same shape as get_years_report
+    """
+    opening = sum(
+        sum(entry['obligation'].values()) - entry['paid']
+        for period, entry in _yearly_totals(db, user_id).items()
+        if period < year
+    )
+    return _with_carry_over(_monthly_totals(db, user_id, year), opening)
+
+def get_month_report(db: Session, user_id: int, year: int, month: int) -> Optional[dict]:
+    """Get the report row of a single month, or None if the month has no data."""
+    return next((row for row in get_months_report(db, user_id, year) if row['period'] == month), None)
+
+def invalidate_reports(user_id: int, dates: tuple) -> None:
+    """
+    Drop the cached reports affected by changes on the given dates.
+
+    Only the months of the changed years are recomputed - the yearly totals
+    are a single small query and carry-over is derived from them.
+    """
+    years = {date.year for date in dates if isinstance(date, datetime)}
+    cache.delete(_years_key(user_id), *(_months_key(user_id, year) for year in years))
+
+add_data_change_listener(invalidate_reports)
@@ -0,0 +1,371 @@
+"""Rate-limited outbound queue for Bot API calls."""
+
+import asyncio
+import itertools
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter, ContextTypes
+
+from maaserbot.utils import metrics
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Priority lanes - lower values are sent first. Replies to the user's own
+# update take the interactive lane (see SendQueueRateLimiter).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NOTIFICATION = 1
+PRIORITY_BULK = 2
+
+LANE_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_NOTIFICATION: 'notification',
+    PRIORITY_BULK: 'bulk',
+}
+
+# Key under which the queue is stored in application.bot_data
+SEND_QUEUE_KEY = 'send_queue'
+
+# Set while the queue's worker makes a call, so the rate limiter lets it through
+_dispatching: ContextVar[bool] = ContextVar('send_queue_dispatching', default=False)
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate."""
+
+    def __init__(self, rate: float, capacity: float = None, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            rate: Tokens added per second
+            capacity: Maximum number of tokens (defaults to one second worth of tokens)
+            clock: Monotonic clock, replaceable for tests
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, tokens: float = 1) -> float:
+        """
+        Get the number of seconds until `tokens` are available, without consuming them.
+
+        Returns:
+            float: 0 if the tokens are available now
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens: float = 1) -> bool:
+        """
+        Take tokens from the bucket if available.
+
+        Returns:
+            bool: True if the tokens were taken
+        """
+        if self.delay(tokens) > 0:
+            return False
+        self.tokens -= tokens
+        return True
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    func: Callable[..., Awaitable[Any]] = field(compare=False)
+    args: tuple = field(compare=False)
+    kwargs: dict = field(compare=False)
+    chat_id: Optional[int] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+class SendQueue:
+    """
+    Outbound queue applying Telegram's flood limits to Bot API calls.
+
+    Calls are taken in priority order and sent once both the global bucket and
+    the bucket of the target chat have a token. A chat that is out of tokens
+    does not block other chats - its job is put aside until the bucket refills.
+    A RetryAfter (429) reply pauses the whole queue for the requested time and
+    the job is retried.
+    """
+
+    def __init__(self, global_rate: float = 25, per_chat_rate: float = 1, per_chat_burst: float = 3,
+                 max_retries: int = 3, max_in_flight: int = 8, max_idle_chats: int = 10000):
+        """
+        Args:
+            global_rate: Calls per second across all chats
+            per_chat_rate: Calls per second to a single chat
+            per_chat_burst: Number of calls a single chat may receive in a burst
+            max_retries: Retries after a RetryAfter error before giving up
+            max_in_flight: Maximum concurrent requests to the Bot API
+            max_idle_chats: Number of per-chat buckets kept before idle ones are pruned
+        """
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._seq = itertools.count()
+        self._depth = {lane: 0 for lane in LANE_NAMES}
+        self._deferred = 0
+        self._paused_until = 0.0
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+
+    def _register_metrics(self) -> None:
+        for lane, name in LANE_NAMES.items():
+            metrics.register_gauge(f'send_queue.depth.{name}', lambda lane=lane: self._depth[lane])
+        metrics.register_gauge('send_queue.deferred', lambda: self._deferred)
+        metrics.register_gauge('send_queue.in_flight', lambda: len(self._in_flight))
+
+    async def start(self) -> None:
+        """Start the worker task."""
+        if self._worker:
+            return
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._register_metrics()
+        self._worker = asyncio.create_task(self._run(), name='send_queue')
+        logger.info("Send queue started")
+
+    async def stop(self, timeout: float = 10) -> None:
+        """
+        Wait up to `timeout` seconds for queued calls to be sent, then stop the worker.
+
+        Args:
+            timeout: Seconds to wait for the queue to drain
+        """
+        if not self._worker:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Send queue stopped with %s calls still queued", self.depth())
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        for name in LANE_NAMES.values():
+            metrics.unregister_gauge(f'send_queue.depth.{name}')
+        metrics.unregister_gauge('send_queue.deferred')
+        metrics.unregister_gauge('send_queue.in_flight')
+        logger.info("Send queue stopped")
+
+    async def join(self) -> None:
+        """Wait until every queued call has been sent or has failed."""
+        while self.depth() or self._in_flight:
+            await asyncio.sleep(0.05)
+
+    @property
+    def is_running(self) -> bool:
+        return self._worker is not None
+
+    def depth(self) -> int:
+        """Number of calls waiting to be sent (including deferred ones)."""
+        return sum(self._depth.values()) + self._deferred
+
+    def lane_depths(self) -> Dict[str, int]:
+        """Number of waiting calls per priority lane."""
+        return {name: self._depth[lane] for lane, name in LANE_NAMES.items()}
+
+    def submit(self, func: Callable[..., Awaitable[Any]], *args, chat_id: int = None,
+               priority: int = PRIORITY_NOTIFICATION, **kwargs) -> asyncio.Future:
+        """
+        Queue a Bot API call.
+
+        Args:
+            func: The bot method to call (e.g. context.bot.send_message)
+            chat_id: Target chat, used for the per-chat limit. Passed on to `func` as well.
+            priority: One of the PRIORITY_* lanes
+
+        Returns:
+            asyncio.Future: Resolves to the call's result, or raises its error
+        """
+        if chat_id is not None:
+            kwargs['chat_id'] = chat_id
+        return self._submit(func, args, kwargs, chat_id, priority)
+
+    def _submit(self, func: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict,
+                chat_id: Optional[int], priority: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(priority, next(self._seq), func, args, kwargs, chat_id, future)
+        self._put(job)
+        metrics.inc(f'send_queue.submitted.{LANE_NAMES[priority]}')
+        return future
+
+    async def send(self, func: Callable[..., Awaitable[Any]], *args, chat_id: int = None,
+                   priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Any:
+        """Queue a Bot API call and wait for its result."""
+        return await self.submit(func, *args, chat_id=chat_id, priority=priority, **kwargs)
+
+    def _put(self, job: _Job) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._depth[job.priority] += 1
+        self._queue.put_nowait(job)
+
+    def _defer(self, job: _Job, delay: float) -> None:
+        # Put the job aside without blocking the worker; it keeps its place in the lane
+        self._deferred += 1
+        self._depth[job.priority] -= 1
+
+        def requeue():
+            self._deferred -= 1
+            self._put(job)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_idle_chats:
+                self._chat_buckets = {cid: b for cid, b in self._chat_buckets.items() if not b.is_full}
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+
+            if job.chat_id is not None:
+                chat_delay = self._chat_bucket(job.chat_id).delay()
+                if chat_delay > 0:
+                    self._defer(job, chat_delay)
+                    continue
+
+            delay = self.global_bucket.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.global_bucket.delay()
+            self.global_bucket.consume()
+            if job.chat_id is not None:
+                self._chat_bucket(job.chat_id).consume()
+
+            await self._semaphore.acquire()
+            self._depth[job.priority] -= 1
+            task = asyncio.create_task(self._dispatch(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, job: _Job) -> None:
+        # The dispatch task has its own context, so this only marks calls made from here
+        _dispatching.set(True)
+        try:
+            result = await job.func(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            retry_after = _retry_after_seconds(e)
+            metrics.inc('send_queue.retry_after')
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                logger.error("Giving up on call to chat %s after %s flood waits", job.chat_id, job.attempts)
+                metrics.inc('send_queue.failed')
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                logger.warning("Flood limit hit, pausing send queue for %.1fs", retry_after)
+                self._put(job)
+        except Exception as e:
+            metrics.inc('send_queue.failed')
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            metrics.inc('send_queue.sent')
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._semaphore.release()
+
+class SendQueueRateLimiter(BaseRateLimiter):
+    """
+    Passes the bot's own Bot API calls through the send queue.
+
+    Handler replies (context.bot, message.reply_text, ...) are queued in the
+    interactive lane, so they go ahead of notifications and bulk sends, are
+    charged to the same global and per-chat buckets and wait out a RetryAfter
+    pause like everything else. Calls made by the queue's worker, and calls
+    made while the queue isn't running, are sent directly.
+    """
+
+    def __init__(self, queue: SendQueue):
+        """
+        Args:
+            queue: The send queue, started and stopped with the application
+        """
+        self.queue = queue
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if _dispatching.get() or not self.queue.is_running:
+            return await callback(*args, **kwargs)
+        return await self.queue._submit(callback, args, kwargs, data.get('chat_id'), PRIORITY_INTERACTIVE)
+
+def _log_failure(future: asyncio.Future, chat_id: int) -> None:
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error:
+        logger.error("Failed to send message to user %s: %s", chat_id, error)
+
+def notify(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs) -> Optional[asyncio.Future]:
+    """
+    Send a notification message through the send queue without waiting for it.
+
+    Falls back to a direct (background) send when no queue is configured.
+
+    Args:
+        context: The handler context
+        chat_id: The chat to notify
+        text: The message text
+        **kwargs: Extra arguments for send_message
+
+    Returns:
+        asyncio.Future: Resolves when the message was sent
+    """
+    queue: Optional[SendQueue] = context.bot_data.get(SEND_QUEUE_KEY)
+    if queue is None:
+        future = asyncio.ensure_future(context.bot.send_message(chat_id=chat_id, text=text, **kwargs))
+    else:
+        future = queue.submit(context.bot.send_message, chat_id=chat_id, text=text,
+                              priority=PRIORITY_NOTIFICATION, **kwargs)
+    future.add_done_callback(lambda f: _log_failure(f, chat_id))
+    return future
@@ -0,0 +1,187 @@
+"""Timing of SQL statements: the slow-query log and per-statement statistics.
+
+Every statement is timed. Statements are aggregated in normalized form -
+whitespace collapsed, literals and bound parameters replaced by `?` and
+IN lists folded - so the same query with different values counts as one,
+and no user data ends up in the log. Statements slower than SLOW_QUERY_MS
+are logged with the handler they came from (see set_query_origin).
+
+The statistics (count, total time, p95 per statement) are shown to the admin
+by /slow_queries and exported as db.query.<fingerprint>.* metrics, together
+with how often SQLAlchemy found the statement already compiled in the
+engine's compiled cache.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from functools import lru_cache
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+from maaserbot.config import get_settings
+from maaserbot.utils import metrics
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+# Statements exported as metrics, by total time
+METRICS_TOP = 20
+
+_WHITESPACE = re.compile(r'\s+')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PARAMETER = re.compile(r'%\(\w+\)s|%s|\$\d+|(?<![:\w]):\w+|\?')
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+# What the statements of the current context run for, e.g. 'button:status'
+query_origin: ContextVar[str] = ContextVar('query_origin', default='background')
+
+def set_query_origin(origin: str) -> None:
+    """Set what the following statements run for, shown in the slow-query log."""
+    query_origin.set(origin)
+
+@lru_cache(maxsize=2048)
+def normalize_statement(statement: str) -> str:
+    """
+    Reduce a statement to its shape, without any values.
+
+    Args:
+        statement: SQL as sent to the database
+
+    Returns:
+        str: The statement with literals and parameters replaced by `?`
+    """
+    sql = _WHITESPACE.sub(' ', statement).strip()
+    sql = _STRING.sub('?', sql)
+    sql = _PARAMETER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    return _IN_LIST.sub('(...)', sql)
+
+def fingerprint(normalized: str) -> str:
+    """Short stable id of a normalized statement."""
+    return hashlib.sha1(normalized.encode()).hexdigest()[:10]
+
+class StatementStats:
+    """Timings of one normalized statement."""
+
+    def __init__(self, samples: int):
+        self.count = 0
+        self.total = 0.0
+        # Most recent durations, for the percentile
+        self.samples: deque = deque(maxlen=samples)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    @property
+    def p95(self) -> float:
+        """95th percentile of the recent durations, in seconds."""
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+
+class QueryStats:
+    """Statement timings aggregated by normalized statement."""
+
+    def __init__(self, max_statements: int = 500, samples: int = 200):
+        """
+        Args:
+            max_statements: Distinct statements tracked - further ones are only counted as 'other'
+            samples: Durations kept per statement for the percentile
+        """
+        self.max_statements = max_statements
+        self.samples = samples
+        self._statements: dict[str, StatementStats] = {}
+        self._lock = threading.Lock()
+        # Statements found in / added to the engine's compiled cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """Share of cacheable statements that did not need compiling."""
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total else 0.0
+
+    def record(self, normalized: str, seconds: float) -> None:
+        """Add a statement's duration."""
+        with self._lock:
+            stats = self._statements.get(normalized)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    normalized = 'other'
+                    stats = self._statements.get(normalized)
+                if stats is None:
+                    stats = self._statements[normalized] = StatementStats(self.samples)
+            stats.add(seconds)
+
+    def record_compilation(self, cached: bool) -> None:
+        """Count whether a statement was found in the compiled cache."""
+        with self._lock:
+            if cached:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def top(self, limit: int = 10) -> list[tuple[str, StatementStats]]:
+        """The statements with the most total time, slowest first."""
+        with self._lock:
+            items = list(self._statements.items())
+        return sorted(items, key=lambda item: item[1].total, reverse=True)[:limit]
+
+    def reset(self) -> None:
+        """Forget all timings."""
+        with self._lock:
+            self._statements.clear()
+            self.cache_hits = self.cache_misses = 0
+
+# Statistics of this process
+stats = QueryStats()
+
+def _collect_metrics() -> dict:
+    values = {}
+    for normalized, statement in stats.top(METRICS_TOP):
+        prefix = f"db.query.{fingerprint(normalized)}"
+        values[f"{prefix}.count"] = statement.count
+        values[f"{prefix}.total_ms"] = statement.total * 1000
+        values[f"{prefix}.p95_ms"] = statement.p95 * 1000
+    values['db.compiled_cache.hit_ratio'] = stats.cache_hit_ratio
+    return values
+
+metrics.register_collector('slow_queries', _collect_metrics)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info['query_started'].pop()
+    normalized = normalize_statement(statement)
+    stats.record(normalized, elapsed)
+    metrics.inc('db.statements')
+    cache_hit = getattr(context, 'cache_hit', None)
+    if cache_hit is CACHE_HIT or cache_hit is CACHE_MISS:
+        stats.record_compilation(cache_hit is CACHE_HIT)
+
+    threshold = get_settings().slow_query_ms
+    if threshold and elapsed * 1000 >= threshold:
+        metrics.inc('db.slow_queries')
+        logger.warning(
+            "Slow query (%.0f ms, %s) from %s: %s",
+            elapsed * 1000, fingerprint(normalized), query_origin.get(), normalized
+        )
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_timer(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
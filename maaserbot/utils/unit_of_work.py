@@ -0,0 +1,183 @@
+"""One database session per update.
+
+Handlers used to open a SessionLocal() each - a button tap would check the
+user's permission in one session and run the action in another, each
+checking out a pooled connection and looking the user up again. Now the
+update processor (see maaserbot.lifecycle) runs every update in a UnitOfWork:
+
+- the session is opened on first use, so updates that never touch the
+  database cost nothing;
+- it holds one connection for the whole update, so the commits made by
+  maaserbot.utils.db functions do not return it to the pool in between;
+- the user of the update is looked up (or created) once;
+- when the update is done the session is committed, or rolled back if a
+  handler failed (see error_handler in bot.py) or the update was cancelled.
+
+Handlers get both through the context (context.db / context.db_user) or,
+in code that also runs outside updates, through update_session().
+"""
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Iterator, Optional
+
+from sqlalchemy.orm import Session
+from telegram.ext import CallbackContext, ExtBot
+
+from maaserbot.models import SessionLocal, get_engine
+from maaserbot.models.base import ReadSessionLocal
+from maaserbot.models.models import User
+from maaserbot.models.routing import current_user, use_replica
+from maaserbot.utils import metrics
+from maaserbot.utils.db import get_or_create_user
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+class UnitOfWork:
+    """The database session and user of one update."""
+
+    def __init__(self, update: object):
+        self.update = update
+        self.failed = False
+        self.closed = False
+        self._connection = None
+        self._session: Optional[Session] = None
+        self._user: Optional[User] = None
+
+    @property
+    def session(self) -> Session:
+        """The update's session, opened on first use."""
+        if self.closed:
+            raise RuntimeError("The update's unit of work is already finished")
+        if self._session is None:
+            self._connection = get_engine().connect()
+            # Objects stay loaded across the intermediate commits of the update
+            self._session = SessionLocal(bind=self._connection, expire_on_commit=False)
+            metrics.inc('db.update_sessions')
+        return self._session
+
+    @property
+    def user(self) -> Optional[User]:
+        """The User row of whoever sent the update, created if new; None for updates without a user."""
+        telegram_user = getattr(self.update, 'effective_user', None)
+        if telegram_user is None:
+            return None
+        if self._user is None:
+            self._user = get_or_create_user(
+                self.session,
+                telegram_user.id,
+                telegram_user.username,
+                telegram_user.first_name,
+                telegram_user.last_name
+            )
+        return self._user
+
+    def finish(self) -> None:
+        """Commit what the update left uncommitted - or roll it back if it failed - and release the connection."""
+        self.closed = True
+        if self._session is None:
+            return
+        try:
+            if self.failed:
+                self._session.rollback()
+            elif self._session.in_transaction():
+                self._session.commit()
+        except Exception as e:
+            logger.error("Could not finish the unit of work of update %s: %s",
+                         getattr(self.update, 'update_id', None), e)
+            self._session.rollback()
+        finally:
+            self._session.close()
+            self._connection.close()
+
+_current: ContextVar[Optional[UnitOfWork]] = ContextVar('unit_of_work', default=None)
+
+def current_unit() -> Optional[UnitOfWork]:
+    """The unit of work of the update being handled, None outside updates."""
+    unit = _current.get()
+    # Tasks started by a handler inherit the context but may outlive the update
+    return None if unit is None or unit.closed else unit
+
+@contextmanager
+def update_session() -> Iterator[Session]:
+    """
+    Use the current update's session, or a new one outside updates.
+
+    The update's session is not closed when the block ends; a new one is.
+
+    Yields:
+        Session: The database session
+    """
+    unit = current_unit()
+    if unit is None:
+        with SessionLocal() as db:
+            yield db
+    else:
+        yield unit.session
+
+@contextmanager
+def read_session() -> Iterator[Session]:
+    """
+    Use a session for a read-only screen of the current user.
+
+    A replica session when it is safe to read there (see maaserbot.models.routing),
+    closed when the block ends. Otherwise the update's own session, so the
+    screen doesn't check out a second connection. Nothing may be written to it.
+
+    Yields:
+        Session: The database session
+    """
+    if use_replica(current_user.get()):
+        metrics.inc('db.reads.replica')
+        with ReadSessionLocal() as db:
+            yield db
+    else:
+        metrics.inc('db.reads.primary')
+        with update_session() as db:
+            yield db
+
+def discard_update_changes() -> None:
+    """Roll back the current update's session when it is done instead of committing it."""
+    unit = current_unit()
+    if unit is not None:
+        unit.failed = True
+
+async def run_in_unit_of_work(update: object, coroutine: Awaitable) -> None:
+    """
+    Run the handling of an update in its own unit of work.
+
+    Args:
+        update: The update being handled
+        coroutine: Its handling (Application.process_update)
+    """
+    unit = UnitOfWork(update)
+    token = _current.set(unit)
+    try:
+        await coroutine
+    except BaseException:
+        unit.failed = True
+        raise
+    finally:
+        _current.reset(token)
+        unit.finish()
+
+class BotContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """Callback context with the update's database session and user."""
+
+    @property
+    def db(self) -> Session:
+        """The session of the update being handled."""
+        unit = current_unit()
+        if unit is None:
+            raise RuntimeError("context.db is only available while handling an update")
+        return unit.session
+
+    @property
+    def db_user(self) -> Optional[User]:
+        """The User row of whoever sent the update being handled."""
+        unit = current_unit()
+        if unit is None:
+            raise RuntimeError("context.db_user is only available while handling an update")
+        return unit.user
@@ -0,0 +1,116 @@
+"""Webhook server for MaaserBot.
+
+Replaces Application.run_webhook so the same server can also answer the load
+balancer: /healthz (liveness), /readyz (readiness) and /metrics. /metrics
+needs the webhook's secret token in the X-Telegram-Bot-Api-Secret-Token
+header, like the webhook itself.
+"""
+
+import json
+import logging
+from http import HTTPStatus
+
+import tornado.web
+from telegram import Update
+from telegram.ext import Application
+
+from maaserbot.config import Settings
+from maaserbot.lifecycle import ALLOWED_UPDATES, run_application
+from maaserbot.utils import metrics
+from maaserbot.utils.health import HEALTH_KEY, HealthChecker
+
+# הגדרת לוגר
+logger = logging.getLogger(__name__)
+
+class _BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_application: Application):
+        self.bot_application = bot_application
+
+    def write_json(self, status: int, body: dict) -> None:
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-store')
+        self.finish(json.dumps(body, default=str))
+
+class _SecretHandler(_BaseHandler):
+    def initialize(self, bot_application: Application, secret_token: str):
+        super().initialize(bot_application)
+        self.secret_token = secret_token
+
+    def check_secret(self) -> None:
+        if self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            logger.warning("Rejected %s request with a wrong secret token", self.request.path)
+            raise tornado.web.HTTPError(HTTPStatus.FORBIDDEN)
+
+class WebhookHandler(_SecretHandler):
+    """Receives updates from Telegram and puts them on the update queue."""
+
+    async def post(self):
+        self.check_secret()
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.bot_application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error("Invalid update payload: %s", e)
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+        await self.bot_application.update_queue.put(update)
+        self.set_status(HTTPStatus.OK)
+
+class HealthHandler(_BaseHandler):
+    """Liveness: the process is up and its event loop answers."""
+
+    def get(self):
+        self.write_json(HTTPStatus.OK, self.bot_application.bot_data[HEALTH_KEY].liveness())
+
+class ReadyHandler(_BaseHandler):
+    """Readiness: dependencies respond and the instance is not backed up."""
+
+    async def get(self):
+        ready, report = await self.bot_application.bot_data[HEALTH_KEY].readiness()
+        self.write_json(HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE, report)
+
+class MetricsHandler(_SecretHandler):
+    """Current counters and gauges as JSON."""
+
+    def get(self):
+        self.check_secret()
+        self.write_json(HTTPStatus.OK, metrics.snapshot())
+
+def make_app(application: Application, webhook_path: str, secret_token: str) -> tornado.web.Application:
+    """Build the tornado application serving the webhook and health endpoints."""
+    args = {'bot_application': application}
+    secret_args = dict(args, secret_token=secret_token)
+    return tornado.web.Application([
+        (webhook_path, WebhookHandler, secret_args),
+        ('/healthz', HealthHandler, args),
+        ('/readyz', ReadyHandler, args),
+        ('/metrics', MetricsHandler, secret_args),
+    ])
+
+async def serve(application: Application, settings: Settings, webhook_path: str) -> None:
+    """Run the bot behind the webhook server until SIGINT/SIGTERM."""
+    health = HealthChecker(application)
+    application.bot_data[HEALTH_KEY] = health
+    server = None
+
+    async def start_intake():
+        nonlocal server
+        health.start()
+        server = make_app(application, webhook_path, settings.webhook_secret).listen(
+            settings.port, address="0.0.0.0"
+        )
+        await application.bot.set_webhook(
+            url=settings.webhook_url,
+            secret_token=settings.webhook_secret,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=settings.drop_pending_updates
+        )
+        logger.info("Webhook server listening on port %s with path %s", settings.port, webhook_path)
+
+    async def stop_intake():
+        # Telegram retries deliveries that fail while we are down, so closing the server loses nothing
+        if server is not None:
+            server.stop()
+        await health.stop()
+
+    await run_application(application, start_intake, stop_intake, settings.shutdown_timeout)
@@ -0,0 +1,4 @@
+-- incomes_archive and payments_archive are new tables and are created from the
+-- models by `python -m maaserbot.models upgrade`.
+-- PostgreSQL installations can partition incomes and payments by year with
+-- `python -m maaserbot.models partitions convert`.
@@ -0,0 +1,2 @@
+-- Per-user version of income/payment data, used as a cache key
+ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,9 @@
+-- Store the rate and the amount owed with each income instead of deriving them on read
+ALTER TABLE users ADD COLUMN custom_rate FLOAT;
+ALTER TABLE incomes ADD COLUMN rate FLOAT;
+ALTER TABLE incomes ADD COLUMN deductible FLOAT NOT NULL DEFAULT 0;
+ALTER TABLE incomes ADD COLUMN obligation_amount FLOAT;
+
+-- Backfill with the rates that used to be hard-coded: maaser 10%, anything else 20%
+UPDATE incomes SET rate = CASE WHEN calc_type = 'מעשר' THEN 0.1 ELSE 0.2 END;
+UPDATE incomes SET obligation_amount = amount * rate;
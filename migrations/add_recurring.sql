@@ -0,0 +1,2 @@
+-- recurring_entries is a new table and is created from the models by
+-- `python -m maaserbot.models upgrade`.
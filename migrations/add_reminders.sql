@@ -0,0 +1,3 @@
+-- Outstanding-balance reminders
+ALTER TABLE users ADD COLUMN reminder_threshold FLOAT;
+ALTER TABLE users ADD COLUMN last_reminded_at TIMESTAMP;
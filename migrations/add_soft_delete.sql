@@ -0,0 +1,9 @@
+-- Tombstones for undoable deletes, purged by the compaction job
+ALTER TABLE incomes ADD COLUMN deleted_at TIMESTAMP;
+ALTER TABLE payments ADD COLUMN deleted_at TIMESTAMP;
+
+-- Reads only touch live rows; compaction only touches tombstones
+CREATE INDEX ix_incomes_live ON incomes (user_id, created_at) WHERE deleted_at IS NULL;
+CREATE INDEX ix_incomes_tombstones ON incomes (deleted_at) WHERE deleted_at IS NOT NULL;
+CREATE INDEX ix_payments_live ON payments (user_id, created_at) WHERE deleted_at IS NULL;
+CREATE INDEX ix_payments_tombstones ON payments (deleted_at) WHERE deleted_at IS NOT NULL;
@@ -0,0 +1,67 @@
+"""Shared fixtures."""
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from maaserbot.models.base import Base
+from maaserbot.utils.cache import cache
+from maaserbot.utils.db import get_or_create_user, add_income, add_payment
+from maaserbot.utils.querycount import count_queries, enable_raiseload, disable_raiseload
+
+@pytest.fixture
+def session_factory():
+    """Sessions on a new in-memory database, with an empty cache."""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    cache.clear()
+    try:
+        yield sessionmaker(autoflush=False, bind=engine)
+    finally:
+        cache.clear()
+        engine.dispose()
+
+@pytest.fixture
+def db_session(session_factory):
+    """Create a test database session."""
+    with session_factory() as db:
+        yield db
+
+@pytest.fixture
+def seeded_session(session_factory):
+    """A test database session with one user (telegram id 555) who has some history."""
+    with session_factory() as db:
+        user = get_or_create_user(db, 555)
+        for amount in (1000.0, 2000.0, 3000.0):
+            add_income(db, user.id, amount)
+        add_payment(db, user.id, 100.0)
+    with session_factory() as db:
+        yield db
+
+@pytest.fixture
+def query_budget():
+    """
+    Assert that a block runs at most a given number of SQL statements.
+
+        with query_budget(3):
+            get_user_balance(db, user.id)
+    """
+    @contextmanager
+    def budget(limit: int):
+        with count_queries() as counter:
+            yield counter
+        assert counter.count <= limit, (
+            f"{counter.count} SQL statements, budget is {limit}:\n" + "\n".join(counter.statements)
+        )
+    return budget
+
+@pytest.fixture
+def raiseload():
+    """Make lazy relationship loads raise during the test, as with DB_RAISELOAD=1."""
+    enable_raiseload()
+    try:
+        yield
+    finally:
+        disable_raiseload()
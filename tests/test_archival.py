@@ -0,0 +1,47 @@
+"""Tests for the history storage job."""
+
+import asyncio
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from maaserbot.config import Settings
+from maaserbot.models import Base, User, Income
+from maaserbot.models.models import IncomeArchive
+from maaserbot.utils import archival
+
+def test_archive_batches_run_off_the_event_loop(monkeypatch, tmp_path):
+    """Test that the job archives closed years in worker threads, each batch in its own session."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'archive.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        users = [User(telegram_id=n) for n in range(1, 4)]
+        db.add_all(users)
+        db.flush()
+        db.add_all([Income(user_id=user.id, amount=100.0, created_at=datetime(2020, 1, 1)) for user in users])
+        db.commit()
+
+    threads = []
+    archive = archival.archive_closed_entries
+
+    def archive_closed_entries(db, user_ids, before):
+        threads.append(threading.current_thread())
+        return archive(db, user_ids, before)
+
+    monkeypatch.setattr(archival, 'SessionLocal', factory)
+    monkeypatch.setattr(archival, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(archival, 'archive_closed_entries', archive_closed_entries)
+    monkeypatch.setattr(archival, 'ensure_partitions', lambda engine, years: None)
+    monkeypatch.setattr(archival, 'get_engine', lambda: engine)
+    monkeypatch.setattr(archival, 'get_settings', lambda: Settings(archive_keep_years=1))
+
+    asyncio.run(archival.maintain_history_storage(None))
+
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    with factory() as db:
+        assert db.query(Income).count() == 0
+        assert db.query(IncomeArchive).count() == 3
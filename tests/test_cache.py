@@ -0,0 +1,113 @@
+"""Tests for the cache backends and what is cached."""
+
+import os
+import socket
+import time
+
+import pytest
+from sqlalchemy.orm import Session
+from maaserbot.config import get_settings
+from maaserbot.models.models import User
+from maaserbot.utils.cache import LocalCache, RedisCache, SharedCache, cache
+from maaserbot.utils.db import add_income, approve_user, get_cached_balance, get_user_permissions
+
+# Local server used by the Redis tests (skipped when unreachable)
+TEST_REDIS_URL = os.environ.get("TEST_REDIS_URL", "redis://localhost:6379/15")
+
+@pytest.fixture
+def redis_url():
+    """URL of a running Redis server, emptied before the test."""
+    redis = pytest.importorskip("redis")
+    client = redis.Redis.from_url(TEST_REDIS_URL)
+    try:
+        client.flushdb()
+    except redis.ConnectionError:
+        pytest.skip(f"No Redis server at {TEST_REDIS_URL}")
+    finally:
+        client.close()
+    return TEST_REDIS_URL
+
+def test_local_cache_ttl_and_delete():
+    """Test that entries expire after their TTL and can be deleted."""
+    local = LocalCache()
+    local.set('a', 1, ttl=0.01)
+    local.set('b', 2)
+    time.sleep(0.02)
+
+    assert local.get('a') is None
+    assert local.get('b') == 2
+    local.delete('b')
+    assert local.get('b', 'missing') == 'missing'
+
+def test_permissions_cached_until_approval(db_session: Session):
+    """Test that the permission record is served from the cache and dropped on approval."""
+    db_session.add_all([User(telegram_id=1, is_admin=True, is_approved=True), User(telegram_id=2)])
+    db_session.commit()
+
+    assert get_user_permissions(db_session, 2) == {'is_approved': False, 'is_admin': False}
+    db_session.query(User).filter(User.telegram_id == 2).update({'is_approved': True})
+    db_session.commit()
+    # Changed behind the cache's back - still the cached record
+    assert get_user_permissions(db_session, 2)['is_approved'] is False
+
+    assert approve_user(db_session, 1, 2) is True
+    assert get_user_permissions(db_session, 2)['is_approved'] is True
+
+def test_balance_recomputed_after_change(db_session: Session):
+    """Test that a cached balance is replaced once the user's data changes."""
+    user = User(telegram_id=3)
+    db_session.add(user)
+    db_session.commit()
+    add_income(db_session, user.id, 1000.0)
+
+    assert get_cached_balance(db_session, user)['total_income'] == 1000.0
+    add_income(db_session, user.id, 500.0)
+    assert get_cached_balance(db_session, user)['total_income'] == 1500.0
+
+def test_redis_cache_shared_between_processes(redis_url):
+    """Test that one process sees another's entries and drops its local copy when they are deleted."""
+    first, second = RedisCache(redis_url), RedisCache(redis_url)
+    try:
+        first.set(('balance', 1, 0), {'remaining': 10.0})
+        assert second.get(('balance', 1, 0)) == {'remaining': 10.0}
+
+        first.delete(('balance', 1, 0))
+        deadline = time.monotonic() + 3
+        while second.get(('balance', 1, 0)) is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert second.get(('balance', 1, 0)) is None
+    finally:
+        first.close()
+        second.close()
+
+def test_redis_cache_ttl(redis_url):
+    """Test that entries expire in Redis and in the local copy."""
+    shared = RedisCache(redis_url, local_ttl=0.05)
+    try:
+        shared.set('short', 'value', ttl=0.1)
+        assert shared.get('short') == 'value'
+        time.sleep(0.2)
+        assert shared.get('short') is None
+    finally:
+        shared.close()
+
+def test_redis_unreachable_is_a_miss(monkeypatch):
+    """Test that without a reachable Redis server the cache misses instead of failing."""
+    pytest.importorskip("redis")
+    # A port nothing listens on
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setenv("CACHE_URL", f"redis://127.0.0.1:{port}/0")
+    get_settings.cache_clear()
+    shared = SharedCache()
+    try:
+        assert isinstance(shared.backend, RedisCache)
+        assert shared.get(('balance', 1, 0), 'missing') == 'missing'
+        shared.set(('balance', 1, 0), {'remaining': 10.0})
+        shared.delete(('balance', 1, 0))
+        shared.clear()
+        assert shared.get(('balance', 1, 0)) is None
+    finally:
+        shared.close()
+        get_settings.cache_clear()
@@ -0,0 +1,42 @@
+"""Tests for the purge of deleted entries."""
+
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from maaserbot.models import Base, User, Income
+from maaserbot.utils import compaction
+
+def test_purge_batches_run_off_the_event_loop(monkeypatch, tmp_path):
+    """Test that expired tombstones are purged in worker threads, one batch per session."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'compaction.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    expired = datetime.utcnow() - timedelta(days=1)
+    with factory() as db:
+        user = User(telegram_id=1)
+        db.add(user)
+        db.flush()
+        db.add_all([Income(user_id=user.id, amount=100.0, deleted_at=expired) for _ in range(3)])
+        db.add(Income(user_id=user.id, amount=100.0))
+        db.commit()
+
+    threads = []
+    purge = compaction.purge_deleted
+
+    def purge_deleted(db, model, before, batch_size):
+        threads.append(threading.current_thread())
+        return purge(db, model, before, batch_size)
+
+    monkeypatch.setattr(compaction, 'SessionLocal', factory)
+    monkeypatch.setattr(compaction, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(compaction, 'purge_deleted', purge_deleted)
+
+    asyncio.run(compaction.compact_deleted_rows(None))
+
+    assert threading.main_thread() not in threads
+    with factory() as db:
+        assert db.query(Income).execution_options(include_deleted=True).count() == 1
@@ -2,30 +2,18 @@
 
 import pytest
 from unittest.mock import MagicMock, patch
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from maaserbot.models.base import Base
-from maaserbot.models.models import User, Income, Payment, AccessRequest, CalculationType
+from sqlalchemy.orm import Session
+from maaserbot.models.models import User, Income, Payment, AccessRequest, CalculationType, IncomeArchive
 from maaserbot.utils.db import (
     get_or_create_user, add_income, add_payment, get_user_balance,
     get_user_history, create_access_request, approve_access_request,
-    reject_access_request
+    reject_access_request, create_broadcast, iter_broadcast_recipients,
+    update_broadcast_progress, get_users_due_for_reminder, mark_users_reminded,
+    get_daily_totals, delete_payment, update_user_settings, edit_income,
+    delete_income, delete_all_user_data, restore_deleted, purge_deleted, UNDO_WINDOW,
+    get_period_totals, get_users_with_closed_entries, archive_closed_entries
 )
-
-# Create test database
-TEST_DATABASE_URL = "sqlite:///:memory:"
-
-@pytest.fixture
-def db_session():
-    """Create a test database session."""
-    engine = create_engine(TEST_DATABASE_URL)
-    Base.metadata.create_all(engine)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+from datetime import datetime, timedelta
 
 @pytest.fixture
 def mock_admin_id():
@@ -262,4 +250,180 @@ def test_reject_access_request(db_session: Session, mock_admin_id):
     
     # Check request status
     updated_request = db_session.query(AccessRequest).filter_by(id=request.id).first()
-    assert updated_request.status == "rejected" 
\ No newline at end of file
+    assert updated_request.status == "rejected"
+
+def test_broadcast_resumes_from_checkpoint(db_session: Session, mock_admin_id):
+    """Test that broadcast recipients are read in batches after the checkpoint."""
+    admin = get_or_create_user(db_session, mock_admin_id)
+    users = [User(telegram_id=1000 + i, is_approved=True) for i in range(5)]
+    users.append(User(telegram_id=2000, is_approved=False))
+    db_session.add_all(users)
+    db_session.commit()
+    
+    broadcast = create_broadcast(db_session, mock_admin_id, "Hello")
+    assert broadcast.status == "running"
+    
+    # Only approved users, in batches of two
+    batches = list(iter_broadcast_recipients(db_session, 0, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 2]
+    assert 2000 not in [row.telegram_id for batch in batches for row in batch]
+    
+    # Checkpoint after the first batch and resume from there
+    update_broadcast_progress(db_session, broadcast.id, batches[0][-1][0], delivered=1, blocked=1)
+    resumed = [row for batch in iter_broadcast_recipients(db_session, broadcast.last_user_id) for row in batch]
+    assert len(resumed) == 4
+    
+    # Checkpoints are committed in the session that reads the batches
+    for batch in iter_broadcast_recipients(db_session, broadcast.last_user_id, batch_size=2):
+        broadcast = update_broadcast_progress(db_session, broadcast.id, batch[-1][0], delivered=len(batch))
+    broadcast = update_broadcast_progress(db_session, broadcast.id, broadcast.last_user_id, finished=True)
+    assert broadcast.status == "done"
+    assert broadcast.last_user_id == resumed[-1][0]
+    assert broadcast.delivered == 5
+    assert broadcast.blocked == 1
+
+def test_create_broadcast_requires_admin(db_session: Session, mock_admin_id):
+    """Test that non-admin users cannot broadcast."""
+    get_or_create_user(db_session, 98765)
+    assert create_broadcast(db_session, 98765, "Hello") is None
+
+def test_users_due_for_reminder(db_session: Session):
+    """Test that only users above their threshold who were not reminded recently are due."""
+    over = User(telegram_id=1, is_approved=True, reminder_threshold=50.0)
+    under = User(telegram_id=2, is_approved=True, reminder_threshold=500.0)
+    off = User(telegram_id=3, is_approved=True)
+    db_session.add_all([over, under, off])
+    db_session.commit()
+    
+    for user in (over, under, off):
+        add_income(db_session, user.id, 2000.0, CalculationType.MAASER)  # 200 owed
+    add_payment(db_session, over.id, 100.0)
+    
+    due = get_users_due_for_reminder(db_session, timedelta(days=7)).all()
+    assert [(row.telegram_id, row.outstanding) for row in due] == [(1, 100.0)]
+    
+    # Once reminded, the user is not due again until the repeat interval passes
+    now = datetime.utcnow()
+    mark_users_reminded(db_session, [over.id], now)
+    assert get_users_due_for_reminder(db_session, timedelta(days=7), now).all() == []
+    assert len(get_users_due_for_reminder(db_session, timedelta(days=7), now + timedelta(days=8)).all()) == 1
+
+def test_writes_bump_data_version(db_session: Session):
+    """Test that every income/payment change bumps the user's data version."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    assert user.data_version == 0
+    
+    add_income(db_session, user.id, 1000.0, CalculationType.MAASER)
+    payment = add_payment(db_session, user.id, 50.0)
+    delete_payment(db_session, payment.id, user.id)
+    
+    db_session.refresh(user)
+    assert user.data_version == 3
+
+def test_get_daily_totals(db_session: Session):
+    """Test the per-day series used for charts."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    db_session.add_all([
+        Income(user_id=user.id, amount=1000.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2024, 1, 1, 9)),
+        Income(user_id=user.id, amount=500.0, calc_type=CalculationType.CHOMESH.value, created_at=datetime(2024, 1, 1, 18)),
+        Payment(user_id=user.id, amount=80.0, created_at=datetime(2024, 1, 3)),
+    ])
+    db_session.commit()
+    
+    assert get_daily_totals(db_session, user.id) == [
+        ('2024-01-01', 1500.0, 200.0, 0.0),
+        ('2024-01-03', 0.0, 0.0, 80.0),
+    ]
+
+def test_custom_rate_and_deductible_are_stored(db_session: Session):
+    """Test that the obligation is computed once at write time from the rate and deductible expenses."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    update_user_settings(db_session, user.id, default_calc_type=CalculationType.CUSTOM, custom_rate=0.15)
+    
+    income = add_income(db_session, user.id, 5000.0, deductible=1000.0)
+    assert (income.calc_type, income.rate, income.obligation_amount) == (CalculationType.CUSTOM.value, 0.15, 600.0)
+    
+    # Changing the settings later doesn't rewrite existing incomes
+    update_user_settings(db_session, user.id, default_calc_type=CalculationType.MAASER)
+    add_income(db_session, user.id, 1000.0)
+    assert get_user_balance(db_session, user.id)['total_maaser'] == 700.0
+    
+    # Editing recalculates
+    edit_income(db_session, income.id, user.id, amount=3000.0)
+    assert income.obligation_amount == 300.0
+    edit_income(db_session, income.id, user.id, calc_type=CalculationType.CHOMESH)
+    assert (income.rate, income.obligation_amount) == (0.2, 400.0)
+
+def test_soft_delete_undo_and_purge(db_session: Session):
+    """Test that deleted entries are hidden, can be restored within the undo window and are purged after it."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    income = add_income(db_session, user.id, 1000.0, CalculationType.MAASER)
+    add_payment(db_session, user.id, 50.0)
+    
+    deleted_at = delete_income(db_session, income.id, user.id)
+    assert get_user_balance(db_session, user.id)['total_income'] == 0.0
+    assert get_user_history(db_session, user.id)['total_incomes'] == 0
+    assert delete_income(db_session, income.id, user.id) is None
+    
+    assert restore_deleted(db_session, user.id, deleted_at) == 1
+    assert get_user_balance(db_session, user.id)['total_income'] == 1000.0
+    
+    deleted_at = delete_all_user_data(db_session, user.id)
+    assert get_user_balance(db_session, user.id)['total_paid'] == 0.0
+    assert restore_deleted(db_session, user.id, deleted_at, now=deleted_at + UNDO_WINDOW * 2) == 0
+    
+    # Tombstones are kept until the undo window has passed
+    assert purge_deleted(db_session, Income, deleted_at, 100) == 0
+    purge_after = deleted_at + UNDO_WINDOW
+    assert purge_deleted(db_session, Income, purge_after, 100) == 1
+    assert purge_deleted(db_session, Payment, purge_after, 100) == 1
+    assert db_session.query(Income).execution_options(include_deleted=True).count() == 0
+
+def test_archive_closed_years(db_session: Session):
+    """Test that archiving moves closed years out of the live tables without changing balances or reports."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    db_session.add_all([
+        Income(user_id=user.id, amount=1000.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2022, 3, 1)),
+        Income(user_id=user.id, amount=1000.0, calc_type=CalculationType.CHOMESH.value, created_at=datetime(2023, 3, 1)),
+        Payment(user_id=user.id, amount=250.0, created_at=datetime(2023, 4, 1)),
+        Income(user_id=user.id, amount=500.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2024, 2, 1)),
+        Income(user_id=user.id, amount=999.0, created_at=datetime(2022, 6, 1), deleted_at=datetime(2022, 6, 2)),
+    ])
+    db_session.commit()
+    balance = get_user_balance(db_session, user.id)
+    years = get_period_totals(db_session, user.id)
+    
+    before = datetime(2024, 1, 1)
+    assert get_users_with_closed_entries(db_session, before) == [user.id]
+    assert archive_closed_entries(db_session, [user.id], before) == 1
+    
+    assert get_users_with_closed_entries(db_session, before) == []
+    assert db_session.query(Income).count() == 1
+    assert db_session.query(IncomeArchive).count() == 2
+    assert get_user_balance(db_session, user.id) == balance
+    assert get_period_totals(db_session, user.id) == years
+    # Tombstones are left for the compaction job
+    assert db_session.query(Income).execution_options(include_deleted=True).count() == 2
+    
+    # Deleting everything covers the archive too, and can be undone
+    deleted_at = delete_all_user_data(db_session, user.id)
+    assert get_user_balance(db_session, user.id)['total_income'] == 0.0
+    restore_deleted(db_session, user.id, deleted_at)
+    assert get_user_balance(db_session, user.id) == balance
+    
+    # Archiving again after deleting everything only counts the new entries
+    delete_all_user_data(db_session, user.id)
+    db_session.add(Income(user_id=user.id, amount=700.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2024, 5, 1)))
+    db_session.commit()
+    assert archive_closed_entries(db_session, [user.id], datetime(2025, 1, 1)) == 1
+    assert get_user_balance(db_session, user.id)['total_income'] == 700.0
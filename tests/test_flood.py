@@ -0,0 +1,62 @@
+"""Tests for per-user flood protection."""
+
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update, Message, Chat, User as TelegramUser
+from telegram.ext import ApplicationHandlerStop
+
+from maaserbot.utils.flood import FloodGuard, FLOOD_GUARD_KEY, throttle_floods
+
+class FakeClock:
+    """Clock advanced by hand."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def make_message_update(update_id: int, user_id: int = 1) -> Update:
+    """Build a text message update."""
+    user = TelegramUser(id=user_id, first_name="Test", is_bot=False)
+    message = Message(message_id=update_id, date=datetime.now(), chat=Chat(id=user_id, type='private'),
+                      from_user=user, text='100')
+    return Update(update_id=update_id, message=message)
+
+def test_burst_then_rate_per_user():
+    """Test that a user gets a burst, then the refill rate, without affecting others."""
+    clock = FakeClock()
+    guard = FloodGuard(rate=2, burst=3, clock=clock)
+
+    assert [guard.allow(1) for _ in range(4)] == [True, True, True, False]
+    assert guard.allow(2) is True
+    assert guard.throttled == {1: 1}
+
+    clock.now += 0.5
+    assert guard.allow(1) is True
+    assert guard.throttled == {}
+
+def test_idle_users_are_pruned():
+    """Test that a throttled user who went quiet is forgotten together with their bucket."""
+    guard = FloodGuard(rate=1, burst=1, max_users=2, clock=FakeClock())
+
+    assert [guard.allow(1) for _ in range(2)] == [True, False]
+    assert guard.allow(2) is True
+    assert guard.allow(3) is True
+    assert guard.throttled == {}
+    assert list(guard._buckets) == [2, 3]
+
+def test_handler_stops_throttled_updates():
+    """Test that excess updates never reach the other handler groups."""
+    context = SimpleNamespace(bot_data={FLOOD_GUARD_KEY: FloodGuard(rate=1, burst=1, clock=FakeClock())})
+
+    async def run():
+        await throttle_floods(make_message_update(1), context)
+        with pytest.raises(ApplicationHandlerStop):
+            await throttle_floods(make_message_update(2), context)
+        # Other users are not affected
+        await throttle_floods(make_message_update(3, user_id=2), context)
+
+    asyncio.run(run())
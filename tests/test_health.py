@@ -0,0 +1,103 @@
+"""Tests for health and readiness probes."""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from maaserbot.utils import metrics
+from maaserbot.utils.health import HealthChecker, LoopLagMonitor, ReadinessLimits, pool_status
+from maaserbot.webhook import make_app
+
+class FakeBot:
+    """Bot whose get_me takes a configurable time."""
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+
+    async def get_me(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+
+def make_application(bot: FakeBot) -> SimpleNamespace:
+    return SimpleNamespace(bot=bot, bot_data={}, update_queue=asyncio.Queue())
+
+def test_readiness_ok_and_probes_cached(tmp_path):
+    """Test that a healthy instance is ready and Bot API probes are reused."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'health.db'}", pool_size=2, max_overflow=0)
+    bot = FakeBot()
+
+    async def run():
+        checker = HealthChecker(make_application(bot), engine=engine)
+        first = await checker.readiness()
+        second = await checker.readiness()
+        return first, second
+
+    (ready, report), _ = asyncio.run(run())
+    assert ready is True
+    assert report['db']['ok'] is True
+    assert report['pool'] == {'checked_out': 0, 'capacity': 2, 'saturation': 0.0}
+    assert bot.calls == 1
+
+def test_readiness_reports_backlog_and_slow_bot_api(tmp_path):
+    """Test that a backed up update queue and a slow Bot API mark the instance unavailable."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'health.db'}")
+    limits = ReadinessLimits(bot_api_latency=0.01, update_queue_depth=1)
+
+    async def run():
+        application = make_application(FakeBot(delay=0.05))
+        for i in range(3):
+            application.update_queue.put_nowait(i)
+        return await HealthChecker(application, limits=limits, engine=engine).readiness()
+
+    ready, report = asyncio.run(run())
+    assert ready is False
+    assert report['reasons'] == ['bot api slow', 'update queue backlog']
+    assert report['update_queue_depth'] == 3
+
+def test_loop_lag_monitor_sees_blocking_code():
+    """Test that blocking the event loop shows up as lag."""
+    async def run():
+        monitor = LoopLagMonitor(interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)  # Block the loop
+        await asyncio.sleep(0.02)
+        lag = monitor.lag
+        await monitor.stop()
+        return lag
+
+    assert asyncio.run(run()) >= 0.05
+
+def test_pool_status_counts_checked_out_connections(tmp_path):
+    """Test pool saturation while a connection is held."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=1)
+    with engine.connect():
+        assert pool_status(engine)['saturation'] == 0.5
+
+def test_metrics_need_the_secret_token():
+    """Test that /metrics is refused without the webhook's secret token."""
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(make_app(make_application(FakeBot()), '/hook', 'secret'))
+        server.add_sockets([sock])
+        client = AsyncHTTPClient()
+        url = f'http://127.0.0.1:{port}/metrics'
+        try:
+            responses = [
+                await client.fetch(url, headers=headers, raise_error=False)
+                for headers in ({}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'},
+                                {'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            ]
+        finally:
+            server.stop()
+        return responses
+
+    metrics.inc('webhook.test')
+    missing, wrong, right = asyncio.run(run())
+    assert missing.code == wrong.code == 403
+    assert right.code == 200
+    assert b'webhook.test' in right.body
@@ -0,0 +1,48 @@
+"""Tests for duplicate update detection."""
+
+from datetime import datetime
+from telegram import Update, CallbackQuery, Message, Chat, User as TelegramUser
+from maaserbot.utils.idempotency import IdempotencyGuard, TTLSet
+
+def make_callback_update(update_id: int, data: str, message_id: int = 5, user_id: int = 1) -> Update:
+    """Build a callback query update."""
+    user = TelegramUser(id=user_id, first_name="Test", is_bot=False)
+    message = Message(message_id=message_id, date=datetime.now(), chat=Chat(id=user_id, type='private'))
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance='test', data=data, message=message)
+    return Update(update_id=update_id, callback_query=query)
+
+def test_redelivered_update_is_duplicate():
+    """Test that the same update_id is only handled once."""
+    guard = IdempotencyGuard()
+    update = make_callback_update(1, 'status')
+    
+    assert guard.is_duplicate(update) is False
+    assert guard.is_duplicate(update) is True
+
+def test_double_tap_is_duplicate():
+    """Test that pressing the same button twice on the same message is dropped."""
+    guard = IdempotencyGuard()
+    
+    assert guard.is_duplicate(make_callback_update(1, 'pay_full_100.0')) is False
+    assert guard.is_duplicate(make_callback_update(2, 'pay_full_100.0')) is True
+    # Same button on another message is a new action
+    assert guard.is_duplicate(make_callback_update(3, 'pay_full_100.0', message_id=6)) is False
+
+def test_paging_back_and_forth_is_not_duplicate():
+    """Test that only a repeat of the last button pressed on a message is dropped."""
+    guard = IdempotencyGuard()
+    
+    assert guard.is_duplicate(make_callback_update(1, 'history_page_2')) is False
+    assert guard.is_duplicate(make_callback_update(2, 'history_page_1')) is False
+    assert guard.is_duplicate(make_callback_update(3, 'history_page_2')) is False
+
+def test_ttl_set_expiry_and_persistence():
+    """Test that expired members are dropped and live ones survive dump/load."""
+    members = TTLSet(ttl=60)
+    assert members.add(1)
+    assert not members.add(1)
+    
+    restored = TTLSet(ttl=60)
+    restored.load(members.dump() + [[2, 0]])
+    assert 1 in restored
+    assert 2 not in restored
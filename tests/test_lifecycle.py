@@ -0,0 +1,59 @@
+"""Tests for graceful shutdown."""
+
+import asyncio
+from types import SimpleNamespace
+
+from maaserbot.lifecycle import DrainingUpdateProcessor, drain_updates
+
+def test_drain_waits_for_in_flight_update():
+    """Test that draining lets a running handler finish."""
+    finished = []
+
+    async def handler():
+        await asyncio.sleep(0.05)
+        finished.append(True)
+
+    async def run():
+        processor = DrainingUpdateProcessor()
+        application = SimpleNamespace(update_queue=asyncio.Queue(), update_processor=processor)
+        await application.update_queue.put('update')
+        await application.update_queue.get()
+
+        async def process():
+            await processor.process_update('update', handler())
+            application.update_queue.task_done()
+
+        task = asyncio.create_task(process())
+        await asyncio.sleep(0)
+        assert processor.in_flight == 1
+        drained = await drain_updates(application, timeout=1)
+        await task
+        return drained
+
+    assert asyncio.run(run()) is True
+    assert finished == [True]
+
+def test_drain_deadline_cancels_and_drops():
+    """Test that updates still pending at the deadline are cancelled or dropped."""
+    async def stuck_handler():
+        await asyncio.sleep(60)
+
+    async def run():
+        processor = DrainingUpdateProcessor()
+        application = SimpleNamespace(update_queue=asyncio.Queue(), update_processor=processor)
+        for update in ('in flight', 'queued'):
+            await application.update_queue.put(update)
+        await application.update_queue.get()
+
+        async def process():
+            # Like the update fetcher - must survive the handler being aborted
+            await processor.process_update('in flight', stuck_handler())
+            application.update_queue.task_done()
+
+        task = asyncio.create_task(process())
+        await asyncio.sleep(0)
+        drained = await drain_updates(application, timeout=0.05)
+        await task
+        return drained, application.update_queue.qsize(), processor.in_flight
+
+    assert asyncio.run(run()) == (False, 0, 0)
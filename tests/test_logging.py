@@ -0,0 +1,70 @@
+import json
+import logging
+
+from maaserbot.utils.logging_utils import (
+    JsonFormatter, LazyQueueHandler, SamplingFilter, parse_sample_rates, setup_logging, shutdown_logging
+)
+
+def _record(name='maaserbot.test', level=logging.INFO, msg='Added income %s for user %s', args=(100, 7)):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+def test_json_formatter():
+    """Test that records are written as JSON lines with their extra fields"""
+    record = _record()
+    record.update_id = 42
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['message'] == 'Added income 100 for user 7'
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'maaserbot.test'
+    assert entry['update_id'] == 42
+
+def test_queue_handler_keeps_arguments_lazy():
+    """Test that queued records keep the message unformatted, stringifying only non-plain args"""
+    class Row:
+        def __str__(self):
+            return 'Row(1)'
+
+    prepared = LazyQueueHandler(None).prepare(_record(args=(100, Row())))
+
+    assert prepared.msg == 'Added income %s for user %s'
+    assert prepared.args == (100, 'Row(1)')
+    assert prepared.getMessage() == 'Added income 100 for user Row(1)'
+
+def test_sampling_filter():
+    """Test that info lines of sampled loggers are thinned out and warnings always pass"""
+    sampler = SamplingFilter(parse_sample_rates('httpx=0.25, maaserbot.utils.db=0.5'))
+
+    kept = sum(sampler.filter(_record(name='httpx')) for _ in range(100))
+    assert kept == 25
+    assert sum(sampler.filter(_record(name='maaserbot.utils.db.child')) for _ in range(10)) == 5
+    assert all(sampler.filter(_record(name='httpx', level=logging.WARNING)) for _ in range(10))
+    assert all(sampler.filter(_record(name='maaserbot.bot')) for _ in range(10))
+
+def test_setup_logging_writes_through_queue(tmp_path):
+    """Test that the configured pipeline writes JSON lines to the log file"""
+    log_file = tmp_path / 'bot.log'
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    try:
+        setup_logging(level='INFO', fmt='json', log_file=str(log_file), sample='')
+        logging.getLogger('maaserbot.test').info("Payment %s saved", 5)
+        shutdown_logging()
+        # Records logged after the listener stopped are written directly
+        logging.getLogger('maaserbot.test').info("Shutdown complete")
+        for handler in root.handlers:
+            handler.flush()
+
+        messages = [json.loads(line)['message'] for line in log_file.read_text().splitlines()]
+        assert 'Payment 5 saved' in messages
+        assert 'Shutdown complete' in messages
+        assert not any(isinstance(handler, LazyQueueHandler) for handler in root.handlers)
+    finally:
+        shutdown_logging()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            if handler not in saved_handlers:
+                handler.close()
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
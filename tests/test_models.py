@@ -2,27 +2,10 @@
 
 import pytest
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from maaserbot.models.base import Base
+from sqlalchemy.orm import Session
 from maaserbot.models.models import User, Income, Payment, AccessRequest, CalculationType
 from datetime import datetime, timedelta
 
-# Create test database
-TEST_DATABASE_URL = "sqlite:///:memory:"
-
-@pytest.fixture
-def db_session():
-    """Create a test database session."""
-    engine = create_engine(TEST_DATABASE_URL)
-    Base.metadata.create_all(engine)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def test_user_creation(db_session: Session):
     """Test that a user can be created and retrieved."""
     # Create a test user
@@ -0,0 +1,74 @@
+"""Tests for update profiling."""
+
+import asyncio
+import pstats
+from types import SimpleNamespace
+
+from maaserbot.utils.profiling import UpdateProfiler
+from maaserbot.utils.slowquery import set_query_origin
+
+def profiled_work():
+    return sum(range(1000))
+
+def other_work():
+    return sum(range(1000))
+
+def make_update(update_id: int, user_id: int = 1, data: str = 'status') -> SimpleNamespace:
+    return SimpleNamespace(update_id=update_id, effective_user=SimpleNamespace(id=user_id),
+                           callback_query=SimpleNamespace(data=data))
+
+def test_off_returns_the_coroutine_itself():
+    """Test that nothing is wrapped while profiling is off."""
+    profiler = UpdateProfiler()
+
+    async def handle():
+        pass
+
+    coroutine = handle()
+    assert profiler.wrap(make_update(1), coroutine) is coroutine
+    coroutine.close()
+
+def test_profiles_only_the_sampled_update_and_keeps_the_slowest():
+    """Test sampling, isolation from interleaved updates and the slowest-K buffer."""
+    profiler = UpdateProfiler(every=2, keep=2)
+
+    async def handle(delay: float):
+        set_query_origin('button:status')
+        await asyncio.sleep(delay)
+        profiled_work()
+
+    async def interleaved():
+        await asyncio.sleep(0)
+        other_work()
+
+    async def run():
+        for update_id, delay in enumerate((0, 0.01, 0, 0.03, 0, 0.02, 0, 0)):
+            await asyncio.gather(profiler.wrap(make_update(update_id), handle(delay)), interleaved())
+
+    asyncio.run(run())
+
+    slowest = profiler.slowest()
+    assert [profile.update_id for profile in slowest] == [3, 5]
+    assert (slowest[0].origin, slowest[0].callback_data) == ('button:status', 'status')
+    functions = {name for _, _, name in slowest[0].stats.stats}
+    assert 'profiled_work' in functions
+    assert 'other_work' not in functions
+
+def test_user_profiling_and_dump(tmp_path):
+    """Test that one user's updates are profiled and dumped as pstats and collapsed stacks."""
+    profiler = UpdateProfiler(user_id=7)
+
+    async def handle():
+        profiled_work()
+
+    async def run():
+        await profiler.wrap(make_update(1, user_id=8), handle())
+        await profiler.wrap(make_update(2, user_id=7), handle())
+
+    asyncio.run(run())
+    paths = profiler.dump(str(tmp_path))
+
+    assert len(paths) == 1
+    assert any(name == 'profiled_work' for _, _, name in pstats.Stats(paths[0]).stats)
+    collapsed = (tmp_path / paths[0].replace('.pstats', '.collapsed')).read_text()
+    assert any(line.split(';')[-1].startswith('profiled_work') for line in collapsed.splitlines())
@@ -0,0 +1,65 @@
+"""Query budgets of the main flows, and lazy load detection."""
+
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import Session
+from maaserbot.bot import render_history_page, inline_results
+from maaserbot.models.models import CalculationType
+from maaserbot.utils.db import get_or_create_user, add_income, get_cached_balance, edit_income
+from maaserbot.utils.querycount import count_queries
+
+def test_counter_nesting(seeded_session: Session):
+    """Test that statements count towards every enclosing counter."""
+    with count_queries() as outer:
+        get_or_create_user(seeded_session, 555)
+        with count_queries() as inner:
+            get_or_create_user(seeded_session, 556)
+    assert inner.count >= 1
+    assert outer.count == inner.count + 1
+
+def test_status_flow_budget(seeded_session: Session, query_budget):
+    """Test the balance screen: a few aggregate queries, then only the user row once cached."""
+    with query_budget(4):
+        user = get_or_create_user(seeded_session, 555)
+        assert get_cached_balance(seeded_session, user)['total_income'] == 6000.0
+    seeded_session.expire_all()
+    with query_budget(1):
+        user = get_or_create_user(seeded_session, 555)
+        get_cached_balance(seeded_session, user)
+
+def test_add_income_flow_budget(seeded_session: Session, query_budget):
+    """Test that adding an income doesn't grow with the user's history."""
+    # User, data version, the income and its month in the rollup
+    with query_budget(4):
+        user = get_or_create_user(seeded_session, 555)
+        add_income(seeded_session, user.id, 500.0)
+
+def test_history_page_budget(seeded_session: Session, query_budget, raiseload):
+    """Test that rendering a history page loads entries in bulk, without lazy loads."""
+    user = get_or_create_user(seeded_session, 555)
+    with query_budget(2):
+        message, keyboard = render_history_page(seeded_session, user, 2)
+    assert "2 מתוך 4" in message
+
+def test_inline_results_budget(seeded_session: Session, query_budget):
+    """Test that inline results are built from the cached balance, which an entry brings up to date."""
+    # Update sessions keep loaded objects across commits
+    seeded_session.expire_on_commit = False
+    user = get_or_create_user(seeded_session, 555)
+    get_cached_balance(seeded_session, user)
+    with query_budget(0):
+        results = inline_results(user, get_cached_balance(seeded_session, user), '300 בונוס')
+    assert [result.id for result in results] == ['income_maaser', 'income_chomesh', 'payment', 'balance']
+    assert [result.id for result in inline_results(user, get_cached_balance(seeded_session, user), 'שלום')] == ['balance']
+
+    add_income(seeded_session, user.id, 300.0, CalculationType.MAASER, 'בונוס')
+    assert get_cached_balance(seeded_session, user)['remaining'] == 530.0
+
+def test_raiseload_surfaces_lazy_loads(seeded_session: Session, raiseload):
+    """Test that dev mode turns a hidden lazy load into an error, and that edits don't rely on one."""
+    user = get_or_create_user(seeded_session, 555)
+    with pytest.raises(InvalidRequestError):
+        user.incomes
+
+    income = edit_income(seeded_session, 1, user.id, calc_type=CalculationType.CHOMESH)
+    assert income.rate == 0.2
@@ -0,0 +1,105 @@
+"""Tests for recurring incomes and payments."""
+
+import asyncio
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session, sessionmaker
+
+from maaserbot.models import Base, User, Income, Payment
+from maaserbot.models.models import CalculationType, RecurringEntry
+from maaserbot.models.rollup import rebuild_users
+from maaserbot.utils import recurring
+from maaserbot.utils.db import (
+    add_recurring_entry, delete_all_user_data, delete_recurring_entry, get_period_totals, get_recurring_entries,
+    materialize_recurring_entries, next_occurrence, restore_deleted, search_incomes
+)
+
+def test_next_occurrence():
+    """Test that occurrences fall on the day of the following months."""
+    assert next_occurrence(datetime(2024, 3, 5, 12), 10) == datetime(2024, 3, 10)
+    assert next_occurrence(datetime(2024, 3, 10), 10) == datetime(2024, 4, 10)
+    assert next_occurrence(datetime(2024, 12, 20), 10) == datetime(2025, 1, 10)
+
+def test_due_entries_added_in_bulk(db_session: Session, query_budget):
+    """Test that one run adds every due occurrence of every user, with their totals, in a fixed number of statements."""
+    users = [User(telegram_id=n, default_calc_type=CalculationType.MAASER.value) for n in range(1, 4)]
+    db_session.add_all(users)
+    db_session.commit()
+    start = datetime(2024, 1, 1)
+    for user in users:
+        add_recurring_entry(db_session, user.id, 'income', 10000.0, 10, 'משכורת', now=start)
+        add_recurring_entry(db_session, user.id, 'payment', 500.0, 15, now=start)
+    stopped = add_recurring_entry(db_session, users[0].id, 'payment', 99.0, 1, now=start)
+    assert delete_recurring_entry(db_session, stopped.id, users[0].id)
+
+    # Select, two inserts, search index, monthly totals, data versions, next dates
+    with query_budget(7):
+        assert materialize_recurring_entries(db_session, now=datetime(2024, 3, 12)) == 6
+    assert materialize_recurring_entries(db_session, now=datetime(2024, 3, 12)) == 0
+
+    user_id = users[0].id
+    incomes = db_session.execute(select(Income).where(Income.user_id == user_id)).scalars().all()
+    assert [income.created_at for income in incomes] == [datetime(2024, m, 10) for m in (1, 2, 3)]
+    assert all(income.obligation_amount == 1000.0 for income in incomes)
+    payments = db_session.execute(select(Payment).where(Payment.user_id == user_id)).scalars().all()
+    assert [payment.created_at for payment in payments] == [datetime(2024, 1, 15), datetime(2024, 2, 15)]
+    assert db_session.get(User, user_id).data_version == 1
+    assert [entry.next_run_at.month for entry in db_session.execute(
+        select(RecurringEntry).where(RecurringEntry.user_id == user_id, RecurringEntry.active == True)
+    ).scalars()] == [4, 3]
+
+    assert get_period_totals(db_session, user_id, 2024)[3] == {
+        'income': 10000.0, 'obligation': {CalculationType.MAASER.value: 1000.0}, 'paid': 0.0
+    }
+    assert search_incomes(db_session, user_id, 'משכורת')['total'] == 3
+    # The totals match a rebuild from the entries
+    totals = db_session.execute(text("SELECT * FROM user_monthly_totals ORDER BY user_id, month")).all()
+    rebuild_users(db_session, [user.id for user in users])
+    assert db_session.execute(text("SELECT * FROM user_monthly_totals ORDER BY user_id, month")).all() == totals
+
+def test_delete_all_data_stops_recurring_entries(db_session: Session):
+    """Test that deleting all of a user's data also stops their recurring entries, even after an undo."""
+    user, other = User(telegram_id=1), User(telegram_id=2)
+    db_session.add_all([user, other])
+    db_session.commit()
+    start = datetime(2024, 1, 1)
+    add_recurring_entry(db_session, user.id, 'income', 10000.0, 10, 'משכורת', now=start)
+    add_recurring_entry(db_session, other.id, 'payment', 500.0, 15, now=start)
+
+    deleted_at = delete_all_user_data(db_session, user.id)
+    restore_deleted(db_session, user.id, deleted_at)
+    assert get_recurring_entries(db_session, user.id) == []
+    assert materialize_recurring_entries(db_session, now=datetime(2024, 1, 20)) == 1
+    assert db_session.execute(select(Income).where(Income.user_id == user.id)).scalars().all() == []
+
+def test_job_runs_off_the_event_loop(monkeypatch, tmp_path):
+    """Test that the job adds the due entries in worker threads, one batch per session."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'recurring.db'}")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine)
+    with factory() as db:
+        users = [User(telegram_id=n) for n in range(1, 4)]
+        db.add_all(users)
+        db.commit()
+        for user in users:
+            add_recurring_entry(db, user.id, 'payment', 50.0, 1, now=datetime(2024, 1, 1))
+
+    threads = []
+    materialize = recurring.materialize_recurring_entries
+
+    def materialize_recurring_entries(db, batch_size):
+        threads.append(threading.current_thread())
+        return materialize(db, batch_size=batch_size, now=datetime(2024, 2, 2))
+
+    monkeypatch.setattr(recurring, 'SessionLocal', factory)
+    monkeypatch.setattr(recurring, 'BATCH_SIZE', 2)
+    monkeypatch.setattr(recurring, 'materialize_recurring_entries', materialize_recurring_entries)
+
+    asyncio.run(recurring.add_recurring_entries(None))
+
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+    with factory() as db:
+        assert db.query(Payment).count() == 3
@@ -0,0 +1,58 @@
+"""Tests for monthly and yearly reports."""
+
+import pytest
+from datetime import datetime
+from sqlalchemy.orm import Session
+from maaserbot.models.models import User, Income, Payment, CalculationType
+from maaserbot.utils.db import add_income, edit_payment
+from maaserbot.utils.reports import get_years_report, get_months_report
+
+@pytest.fixture
+def user(db_session: Session):
+    """Create a user with two years of data."""
+    user = User(telegram_id=98765, username="test_user")
+    db_session.add(user)
+    db_session.commit()
+    
+    db_session.add_all([
+        Income(user_id=user.id, amount=1000.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2023, 1, 5)),
+        Income(user_id=user.id, amount=1000.0, calc_type=CalculationType.CHOMESH.value, created_at=datetime(2023, 3, 5)),
+        Payment(user_id=user.id, amount=100.0, created_at=datetime(2023, 3, 10)),
+        Income(user_id=user.id, amount=500.0, calc_type=CalculationType.MAASER.value, created_at=datetime(2024, 2, 1)),
+        Payment(user_id=user.id, amount=50.0, created_at=datetime(2024, 2, 2)),
+    ])
+    db_session.commit()
+    return user
+
+def test_years_report_carries_balance(db_session: Session, user):
+    """Test that yearly totals carry the closing balance into the next year."""
+    rows = get_years_report(db_session, user.id)
+    
+    assert [row['period'] for row in rows] == [2023, 2024]
+    assert rows[0]['income'] == 2000.0
+    assert rows[0]['obligation'] == {CalculationType.MAASER.value: 100.0, CalculationType.CHOMESH.value: 200.0}
+    assert rows[0]['closing'] == pytest.approx(200.0)
+    assert rows[1]['opening'] == pytest.approx(200.0)
+    assert rows[1]['closing'] == pytest.approx(200.0)
+
+def test_months_report_starts_from_previous_years(db_session: Session, user):
+    """Test that monthly rows start from the balance of earlier years."""
+    rows = get_months_report(db_session, user.id, 2024)
+    
+    assert len(rows) == 1
+    assert rows[0]['period'] == 2
+    assert rows[0]['opening'] == pytest.approx(200.0)
+    assert rows[0]['paid'] == 50.0
+
+def test_reports_invalidated_on_write(db_session: Session, user):
+    """Test that writes drop the cached report of their period."""
+    assert get_months_report(db_session, user.id, 2023)[-1]['paid'] == 100.0
+    
+    payment = db_session.query(Payment).filter(Payment.created_at == datetime(2023, 3, 10)).first()
+    edit_payment(db_session, payment.id, user.id, 150.0)
+    
+    assert get_months_report(db_session, user.id, 2023)[-1]['paid'] == 150.0
+    assert get_years_report(db_session, user.id)[1]['opening'] == pytest.approx(150.0)
+    
+    add_income(db_session, user.id, 100.0, CalculationType.MAASER)
+    assert get_years_report(db_session, user.id)[-1]['period'] == datetime.utcnow().year
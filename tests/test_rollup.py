@@ -0,0 +1,84 @@
+"""Tests for the monthly totals rollup."""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker, Session
+
+from maaserbot.models.base import Base, SessionLocal
+from maaserbot.models.models import User, Income, Payment, CalculationType, UserMonthlyTotal
+from maaserbot.models.rollup import rebuild, rebuild_users
+from maaserbot.utils.cache import cache
+from maaserbot.utils.db import add_income, add_payment, delete_income, restore_deleted, get_period_totals
+
+@pytest.fixture
+def engine(tmp_path):
+    """A file database, so parallel rebuild workers share it."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'rollup.db'}")
+    Base.metadata.create_all(engine)
+    cache.clear()
+    yield engine
+    cache.clear()
+    engine.dispose()
+
+def _rollup(db: Session) -> dict:
+    rows = db.execute(select(UserMonthlyTotal.__table__).order_by('user_id', 'month')).all()
+    return {(row.user_id, row.month): tuple(round(value, 6) for value in row[2:]) for row in rows}
+
+def test_rollup_follows_writes(engine):
+    """Test that adds, edits moving months, deletes and restores keep the rollup equal to a rebuild."""
+    db = sessionmaker(bind=engine)()
+    user = User(telegram_id=1, default_calc_type=CalculationType.MAASER.value)
+    db.add(user)
+    db.commit()
+
+    add_income(db, user.id, 1000.0)
+    add_payment(db, user.id, 30.0)
+    income = Income(user_id=user.id, amount=500.0, calc_type=CalculationType.CHOMESH.value,
+                    created_at=datetime(2023, 5, 1))
+    db.add_all([income, Payment(user_id=user.id, amount=20.0, created_at=datetime(2023, 5, 2))])
+    db.commit()
+
+    # Moving an income to another month and type (its rate stays the one it was written with)
+    income.created_at = datetime(2023, 7, 1)
+    income.calc_type = CalculationType.MAASER.value
+    income.amount = 600.0
+    db.commit()
+    assert get_period_totals(db, user.id, 2023) == {
+        5: {'income': 0.0, 'obligation': {}, 'paid': 20.0},
+        7: {'income': 600.0, 'obligation': {CalculationType.MAASER.value: 120.0}, 'paid': 0.0},
+    }
+
+    deleted_at = delete_income(db, income.id, user.id)
+    assert 7 not in get_period_totals(db, user.id, 2023)
+    restore_deleted(db, user.id, deleted_at)
+
+    incremental = _rollup(db)
+    rebuild_users(db, [user.id])
+    db.commit()
+    assert _rollup(db) == incremental
+    assert len(incremental) == 3
+    db.close()
+
+def test_parallel_rebuild(engine, monkeypatch):
+    """Test that the parallel rebuild restores the rollup of every user."""
+    monkeypatch.setitem(SessionLocal.kw, 'bind', engine)
+    db = sessionmaker(bind=engine)()
+    users = [User(telegram_id=telegram_id) for telegram_id in range(1, 6)]
+    db.add_all(users)
+    db.commit()
+    for n, user in enumerate(users, 1):
+        db.add_all([
+            Income(user_id=user.id, amount=100.0 * n, calc_type=CalculationType.MAASER.value,
+                   created_at=datetime(2024, n, 1)),
+            Payment(user_id=user.id, amount=5.0 * n, created_at=datetime(2024, n, 3)),
+        ])
+    db.commit()
+    expected = _rollup(db)
+    db.execute(UserMonthlyTotal.__table__.delete())
+    db.commit()
+
+    assert rebuild(workers=3, batch_size=2) == 5
+    assert _rollup(db) == expected
+    db.close()
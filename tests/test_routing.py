@@ -0,0 +1,67 @@
+"""Tests for read replica routing."""
+
+import contextvars
+
+import pytest
+from sqlalchemy import create_engine, update
+
+from maaserbot.config import Settings
+from maaserbot.models import Base, SessionLocal, User
+from maaserbot.models import base, routing
+from maaserbot.models.base import ReadSessionLocal
+
+@pytest.fixture
+def replica(monkeypatch, tmp_path):
+    """Settings with a read replica configured, and fresh routing state."""
+    settings = Settings(database_url=f"sqlite:///{tmp_path / 'primary.db'}",
+                        database_read_url=f"sqlite:///{tmp_path / 'replica.db'}", replica_max_lag=5)
+    monkeypatch.setattr(base, 'get_settings', lambda: settings)
+    monkeypatch.setattr(routing, 'get_settings', lambda: settings)
+    monkeypatch.setattr(base, '_read_engine', None)
+    monkeypatch.setattr(routing, '_last_write', {})
+    monkeypatch.setattr(routing, '_lag_checked_at', None)
+    return settings
+
+def test_reads_follow_own_writes(replica):
+    """Test that a user reads from the primary right after committing, and from the replica otherwise."""
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+
+    def handle_update():
+        routing.set_current_user(42)
+        before = routing.use_replica(42)
+        with SessionLocal(bind=engine) as db:
+            db.add(User(telegram_id=42))
+            db.commit()
+        return before
+
+    assert contextvars.copy_context().run(handle_update) is True
+    assert routing.use_replica(42) is False
+    assert routing.use_replica(7) is True
+    assert routing.use_replica(None) is False
+
+    # Once the write is older than the allowed lag the replica has it
+    routing._last_write[42] -= replica.replica_max_lag + routing.LAG_CHECK_INTERVAL + 1
+    assert routing.use_replica(42) is True
+
+def test_lagging_replica_falls_back_to_primary(replica, monkeypatch):
+    """Test that reads go to the primary while the replica lags too much or can't be reached."""
+    for lag, expected in ((1.0, True), (30.0, False), (None, False)):
+        monkeypatch.setattr(routing, 'measure_replica_lag', lambda engine, lag=lag: lag)
+        monkeypatch.setattr(routing, '_lag_checked_at', None)
+        assert routing.use_replica(7) is expected
+
+def test_no_replica_uses_primary(monkeypatch):
+    """Test that without DATABASE_READ_URL every read uses the primary."""
+    monkeypatch.setattr(base, 'get_settings', lambda: Settings())
+    assert routing.use_replica(7) is False
+
+def test_replica_sessions_do_not_write(replica):
+    """Test that writing through a replica session fails before anything reaches the replica."""
+    with ReadSessionLocal() as db:
+        db.add(User(telegram_id=42))
+        with pytest.raises(routing.ReplicaWriteError):
+            db.flush()
+        db.rollback()
+        with pytest.raises(routing.ReplicaWriteError):
+            db.execute(update(User).values(username='x'))
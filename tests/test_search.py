@@ -0,0 +1,60 @@
+"""Tests for the income description search."""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from maaserbot.models import User, Income
+from maaserbot.models.search import search_terms, query_words
+from maaserbot.utils.db import add_income, edit_income, delete_income, purge_deleted, search_incomes
+
+def _found(db: Session, user_id: int, query: str) -> list[str]:
+    return [income.description for income in search_incomes(db, user_id, query, items_per_page=10)['incomes']]
+
+def test_hebrew_terms():
+    """Test that niqqud, final letters and prefix letters don't get in the way of a match."""
+    terms = search_terms('וְהַבּוֹנוּס של מרץ').split()
+    assert {'והבונוס', 'הבונוס', 'בונוס', 'של', 'מרצ'} <= set(terms)
+    assert 'צהל' in search_terms('החזר מצה"ל').split()
+    assert query_words('מרץ מרץ') == ['מרצ']
+
+def test_search_follows_incomes(db_session: Session):
+    """Test that added, edited, deleted and purged incomes are found or not."""
+    user, other = User(telegram_id=1), User(telegram_id=2)
+    db_session.add_all([user, other])
+    db_session.commit()
+    bonus = add_income(db_session, user.id, 1000.0, description='והבונוס של מרץ')
+    salary = add_income(db_session, user.id, 5000.0, description='משכורת')
+    add_income(db_session, other.id, 700.0, description='בונוס')
+
+    assert _found(db_session, user.id, 'בונוס') == ['והבונוס של מרץ']
+    assert _found(db_session, user.id, 'בונ מר') == ['והבונוס של מרץ']
+    assert _found(db_session, user.id, 'בונוס משכורת') == []
+    assert search_incomes(db_session, user.id, '  ')['total'] == 0
+
+    edit_income(db_session, salary.id, user.id, description='בונוס שנתי')
+    assert sorted(_found(db_session, user.id, 'בונוס')) == ['בונוס שנתי', 'והבונוס של מרץ']
+
+    bonus_id, salary_id = bonus.id, salary.id
+    delete_income(db_session, bonus_id, user.id)
+    assert _found(db_session, user.id, 'בונוס') == ['בונוס שנתי']
+    purge_deleted(db_session, Income, datetime.utcnow() + timedelta(minutes=1), 100)
+    indexed = db_session.execute(text("SELECT rowid FROM income_search ORDER BY rowid")).scalars().all()
+    assert bonus_id not in indexed and salary_id in indexed
+
+def test_purge_batch_drops_only_its_index_rows(db_session: Session):
+    """Test that each purge batch removes the index entries of the incomes it deletes, and no others."""
+    user = User(telegram_id=1)
+    db_session.add(user)
+    db_session.commit()
+    ids = [add_income(db_session, user.id, 100.0, description=f'בונוס {n}').id for n in range(3)]
+    for income_id in ids:
+        delete_income(db_session, income_id, user.id)
+
+    purge_after = datetime.utcnow() + timedelta(minutes=1)
+    assert purge_deleted(db_session, Income, purge_after, 2) == 2
+    indexed = db_session.execute(text("SELECT rowid FROM income_search ORDER BY rowid")).scalars().all()
+    assert indexed == ids[2:]
+    assert purge_deleted(db_session, Income, purge_after, 2) == 1
+    assert db_session.execute(text("SELECT count(*) FROM income_search")).scalar() == 0
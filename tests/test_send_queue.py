@@ -0,0 +1,156 @@
+"""Tests for the outbound send queue."""
+
+import asyncio
+from datetime import timedelta
+from telegram.error import RetryAfter
+from maaserbot.utils import metrics
+from maaserbot.utils.send_queue import (
+    TokenBucket, SendQueue, SendQueueRateLimiter, PRIORITY_INTERACTIVE, PRIORITY_NOTIFICATION, PRIORITY_BULK
+)
+
+class FakeClock:
+    """Manually advanced clock."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_refill():
+    """Test that the bucket empties and refills at its rate."""
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    
+    assert bucket.consume()
+    assert bucket.consume()
+    assert not bucket.consume()
+    assert bucket.delay() == 0.5
+    
+    clock.now = 0.5
+    assert bucket.consume()
+
+def test_lanes_sent_in_priority_order():
+    """Test that replies overtake queued notifications, and notifications overtake bulk calls."""
+    sent = []
+    
+    async def send_message(chat_id, text):
+        sent.append(text)
+    
+    async def run():
+        queue = SendQueue(global_rate=1000, per_chat_rate=1000, per_chat_burst=1000)
+        # Queue everything before the worker starts so ordering is decided by priority only
+        for i in range(3):
+            queue.submit(send_message, chat_id=i, text=f'bulk {i}', priority=PRIORITY_BULK)
+        queue.submit(send_message, chat_id=9, text='approved', priority=PRIORITY_NOTIFICATION)
+        queue.submit(send_message, chat_id=8, text='reply', priority=PRIORITY_INTERACTIVE)
+        await queue.start()
+        await queue.stop()
+    
+    asyncio.run(run())
+    assert sent[:2] == ['reply', 'approved']
+    assert sorted(sent[2:]) == ['bulk 0', 'bulk 1', 'bulk 2']
+
+def test_retry_after_is_retried():
+    """Test that a flood-limit error is retried instead of failing the call."""
+    calls = []
+    
+    async def send_message(chat_id, text):
+        calls.append(text)
+        if len(calls) == 1:
+            raise RetryAfter(timedelta(seconds=0.01))
+        return 'ok'
+    
+    async def run():
+        queue = SendQueue()
+        await queue.start()
+        result = await queue.send(send_message, chat_id=1, text='hi')
+        await queue.stop()
+        return result
+    
+    assert asyncio.run(run()) == 'ok'
+    assert len(calls) == 2
+
+def test_per_chat_limit_does_not_block_other_chats():
+    """Test that a throttled chat is deferred while other chats are sent."""
+    sent = []
+    
+    async def send_message(chat_id, text):
+        sent.append(chat_id)
+    
+    async def run():
+        queue = SendQueue(global_rate=1000, per_chat_rate=5, per_chat_burst=1)
+        await queue.start()
+        futures = [
+            queue.submit(send_message, chat_id=1, text='a'),
+            queue.submit(send_message, chat_id=1, text='b'),
+            queue.submit(send_message, chat_id=2, text='c'),
+        ]
+        await asyncio.gather(*futures)
+        await queue.stop()
+    
+    asyncio.run(run())
+    assert sent == [1, 2, 1]
+
+def test_cancelled_call_is_not_resolved(caplog):
+    """Test that a call whose caller gave up is sent without failing the queue's task."""
+    sent = []
+
+    async def send_message(chat_id, text):
+        sent.append(text)
+        raise RetryAfter(timedelta(seconds=0.01))
+
+    async def run():
+        queue = SendQueue(global_rate=1000, per_chat_rate=1000, per_chat_burst=1000, max_retries=0)
+        queue.submit(send_message, chat_id=1, text='gave up').cancel()
+        await queue.start()
+        await queue.stop()
+
+    asyncio.run(run())
+    assert sent == ['gave up']
+    assert not [record for record in caplog.records if record.name == 'asyncio']
+
+def test_rate_limiter_sends_replies_through_the_queue():
+    """Test that the bot's own calls take the interactive lane and wait out a flood pause."""
+    calls = []
+
+    async def do_post(endpoint, data):
+        calls.append(endpoint)
+        if len(calls) == 1:
+            raise RetryAfter(timedelta(seconds=0.01))
+        return True
+
+    async def run():
+        queue = SendQueue(global_rate=1000, per_chat_rate=1000, per_chat_burst=1000)
+        limiter = SendQueueRateLimiter(queue)
+        await queue.start()
+        result = await limiter.process_request(do_post, ('sendMessage', {'chat_id': 1}), {},
+                                               'sendMessage', {'chat_id': 1}, None)
+        await queue.stop()
+        return result
+
+    metrics.reset()
+    assert asyncio.run(run()) is True
+    assert calls == ['sendMessage', 'sendMessage']
+    assert metrics.snapshot()['send_queue.submitted.interactive'] == 1
+
+def test_rate_limiter_lets_queued_calls_through():
+    """Test that calls made by the queue's worker are not queued a second time."""
+    async def run():
+        queue = SendQueue(global_rate=1000, per_chat_rate=1000, per_chat_burst=1000)
+        limiter = SendQueueRateLimiter(queue)
+
+        async def do_post(endpoint, data):
+            return queue.depth()
+
+        async def send_message(chat_id, text):
+            # What ExtBot does for a queued notification
+            return await limiter.process_request(do_post, ('sendMessage', {'chat_id': chat_id}), {},
+                                                 'sendMessage', {'chat_id': chat_id}, None)
+
+        await queue.start()
+        result = await asyncio.wait_for(queue.send(send_message, chat_id=1, text='approved',
+                                                   priority=PRIORITY_NOTIFICATION), 1)
+        await queue.stop()
+        return result
+
+    assert asyncio.run(run()) == 0
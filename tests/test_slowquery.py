@@ -0,0 +1,68 @@
+"""Tests for the slow-query log and statement statistics."""
+
+import logging
+
+from sqlalchemy import create_engine, text
+
+from maaserbot.config import Settings
+from maaserbot.utils import slowquery
+from maaserbot.utils.slowquery import QueryStats, normalize_statement, set_query_origin
+
+def test_normalize_statement_hides_values():
+    """Test that literals, parameters and IN lists are folded into one shape."""
+    first = normalize_statement("SELECT * FROM users\n WHERE telegram_id = 12345 AND username = 'dana' AND id IN (?, ?, ?)")
+    second = normalize_statement("SELECT * FROM users WHERE telegram_id = 99 AND username = 'o''hara' AND id IN (?, ?)")
+
+    assert first == second == "SELECT * FROM users WHERE telegram_id = ? AND username = ? AND id IN (...)"
+    assert normalize_statement("SELECT 1 FROM incomes_y2024 WHERE x = %(x_1)s::text") == \
+        "SELECT ? FROM incomes_y2024 WHERE x = ?::text"
+
+def test_stats_count_total_and_p95():
+    """Test the aggregation per statement and the ordering by total time."""
+    stats = QueryStats(max_statements=2)
+    for ms in range(1, 101):
+        stats.record('SELECT a', ms / 1000)
+    stats.record('SELECT b', 1.0)
+    stats.record('SELECT c', 0.5)
+
+    (first, a), (second, b), (third, _) = stats.top()
+    assert (first, a.count, round(a.total, 3), round(a.p95, 3)) == ('SELECT a', 100, 5.05, 0.096)
+    assert (second, b.count) == ('SELECT b', 1)
+    # Over max_statements new statements are lumped together
+    assert third == 'other'
+
+def test_slow_statement_logged_with_origin(monkeypatch, caplog):
+    """Test that slow statements are logged normalized, with the handler they came from."""
+    monkeypatch.setattr(slowquery, 'get_settings', lambda: Settings(slow_query_ms=0.000001))
+    monkeypatch.setattr(slowquery, 'stats', QueryStats())
+    engine = create_engine('sqlite://')
+    set_query_origin('button:status')
+
+    with caplog.at_level(logging.WARNING, logger='maaserbot.utils.slowquery'):
+        with engine.connect() as connection:
+            connection.execute(text("SELECT :amount + 4200"), {'amount': 1234})
+
+    assert "from button:status: SELECT ? + ?" in caplog.text
+    assert "1234" not in caplog.text and "4200" not in caplog.text
+    assert slowquery.stats.top(1)[0][0] == "SELECT ? + ?"
+
+def test_hot_lookups_hit_compiled_cache(monkeypatch):
+    """Test that repeated hot lookups are served from the engine's compiled cache."""
+    from sqlalchemy.orm import Session
+    from maaserbot.models import Base
+    from maaserbot.utils.db import get_or_create_user, get_user_balance, get_user_history
+
+    monkeypatch.setattr(slowquery, 'stats', QueryStats())
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        user = get_or_create_user(db, 42)
+        for page in (1, 2):
+            if page == 2:
+                slowquery.stats.reset()
+            get_user_history(db, user.id, page=page)
+            get_user_balance(db, user.id)
+            get_or_create_user(db, 40 + page)
+
+    assert slowquery.stats.cache_misses == 0
+    assert slowquery.stats.cache_hits >= 6
@@ -0,0 +1,90 @@
+"""Tests for startup cost and schema versioning."""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect, text
+
+from maaserbot.models.schema import SCHEMA_VERSION, check_schema, get_schema_version, init_schema, upgrade_schema, _stamp
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# Generous for slow CI machines - importing used to create tables and connect
+IMPORT_BUDGET_SECONDS = 3.0
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import maaserbot.bot
+elapsed = time.perf_counter() - start
+import maaserbot.models.base as base
+print(json.dumps({
+    'elapsed': elapsed,
+    'engine_created': base._engine is not None,
+    'heavy_modules': [m for m in ('matplotlib', 'aiohttp') if m in sys.modules],
+}))
+"""
+
+def test_import_has_no_side_effects(tmp_path):
+    """Test that importing the bot is fast and touches neither the database nor the disk."""
+    env = dict(os.environ,
+               PYTHONPATH=str(REPO_ROOT),
+               DATABASE_URL=f"sqlite:///{tmp_path / 'maaser.db'}")
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert report['elapsed'] < IMPORT_BUDGET_SECONDS
+    assert report['engine_created'] is False
+    assert report['heavy_modules'] == []
+    assert list(tmp_path.iterdir()) == []
+
+def test_schema_command(tmp_path):
+    """Test that the schema command line creates the database and reports its version."""
+    env = dict(os.environ,
+               PYTHONPATH=str(REPO_ROOT),
+               DATABASE_URL=f"sqlite:///{tmp_path / 'maaser.db'}")
+    for command in ('init', 'upgrade', 'rebuild', 'version'):
+        result = subprocess.run([sys.executable, '-m', 'maaserbot.models', command], cwd=tmp_path, env=env,
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+    assert f"database: {SCHEMA_VERSION}, code: {SCHEMA_VERSION}" in result.stdout
+
+def test_check_schema_initializes_empty_database():
+    """Test that the startup check creates a fresh database at the current version."""
+    engine = create_engine('sqlite:///:memory:')
+
+    assert get_schema_version(engine) == 0
+    check_schema(engine)
+    assert get_schema_version(engine) == SCHEMA_VERSION
+
+def test_upgrade_from_version_3(tmp_path):
+    """Test that upgrading a version 3 database backfills obligation_amount and keeps existing incomes live."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    init_schema(engine)
+    with engine.begin() as connection:
+        # Recreate the version 3 tables
+        for table in ('incomes', 'payments'):
+            connection.execute(text(f"DROP INDEX ix_{table}_live"))
+            connection.execute(text(f"DROP INDEX ix_{table}_tombstones"))
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN deleted_at"))
+        for column in ('rate', 'deductible', 'obligation_amount'):
+            connection.execute(text(f"ALTER TABLE incomes DROP COLUMN {column}"))
+        connection.execute(text("ALTER TABLE users DROP COLUMN custom_rate"))
+        connection.execute(text("INSERT INTO users (id, telegram_id, data_version) VALUES (1, 1, 0)"))
+        connection.execute(text(
+            "INSERT INTO incomes (user_id, amount, calc_type) VALUES (1, 1000, 'מעשר'), (1, 1000, 'חומש')"
+        ))
+        _stamp(connection, 3)
+
+    upgrade_schema(engine)
+
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT rate, deductible, obligation_amount FROM incomes ORDER BY id")).all()
+    assert [tuple(row) for row in rows] == [(0.1, 0.0, 100.0), (0.2, 0.0, 200.0)]
+    assert {index['name'] for index in inspect(engine).get_indexes('incomes')} >= {'ix_incomes_live', 'ix_incomes_tombstones'}
+    assert get_schema_version(engine) == SCHEMA_VERSION
@@ -0,0 +1,96 @@
+"""Tests for the per-update unit of work."""
+
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from maaserbot.bot import show_history, show_report
+from maaserbot.models import Base, SessionLocal, User
+from maaserbot.utils import unit_of_work
+from maaserbot.utils.querycount import count_queries
+from maaserbot.utils.db import add_income
+from maaserbot.utils.unit_of_work import current_unit, discard_update_changes, run_in_unit_of_work, update_session
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    """A file database the units of work connect to, counting connection checkouts."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'uow.db'}")
+    Base.metadata.create_all(engine)
+    engine.checkouts = 0
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(*args):
+        engine.checkouts += 1
+
+    monkeypatch.setattr(unit_of_work, 'get_engine', lambda: engine)
+    return engine
+
+def _update(telegram_id=42):
+    user = SimpleNamespace(id=telegram_id, username='user', first_name=None, last_name=None)
+    return SimpleNamespace(update_id=1, effective_user=user)
+
+def test_one_session_and_user_lookup_per_update(engine):
+    """Test that all handlers of an update share one connection, session and user lookup."""
+    counters = []
+
+    async def handlers():
+        with count_queries() as counter:
+            with update_session() as permission_db:
+                assert current_unit().user.is_approved is False
+            with update_session() as action_db:
+                user = current_unit().user
+                user.custom_rate = 0.15
+                action_db.commit()
+        assert permission_db is action_db
+        assert user.custom_rate == 0.15
+        counters.append(counter)
+
+    asyncio.run(run_in_unit_of_work(_update(), handlers()))
+    assert engine.checkouts == 1
+    assert sum('FROM users' in statement for statement in counters[0].statements) == 1
+    with SessionLocal(bind=engine) as db:
+        assert db.query(User).filter(User.telegram_id == 42).one().custom_rate == 0.15
+
+def test_update_changes_committed_or_discarded(engine):
+    """Test that what an update leaves uncommitted is committed at the end, unless it failed."""
+    async def handler(telegram_id, fail):
+        with update_session() as db:
+            db.add(User(telegram_id=telegram_id))
+            db.flush()
+        if fail:
+            discard_update_changes()
+
+    asyncio.run(run_in_unit_of_work(_update(1), handler(1, fail=False)))
+    asyncio.run(run_in_unit_of_work(_update(2), handler(2, fail=True)))
+    with SessionLocal(bind=engine) as db:
+        assert [user.telegram_id for user in db.query(User)] == [1]
+    assert current_unit() is None
+
+class _Context:
+    """The parts of BotContext the read screens use."""
+    user_data = {}
+
+    @property
+    def db_user(self):
+        return current_unit().user
+
+@pytest.mark.parametrize('screen, data', [(show_history, 'history'), (show_report, 'reports')])
+def test_read_screen_uses_the_update_connection(engine, query_budget, screen, data):
+    """Test that without a replica a read screen reads in the update's session, on its one connection."""
+    with SessionLocal(bind=engine) as db:
+        user = User(telegram_id=42, is_approved=True)
+        db.add(user)
+        db.commit()
+        add_income(db, user.id, 1000.0, description='משכורת')
+    engine.checkouts = 0
+
+    update = _update()
+    update.callback_query = SimpleNamespace(data=data, from_user=update.effective_user,
+                                            answer=AsyncMock(), edit_message_text=AsyncMock())
+    with query_budget(4):
+        asyncio.run(run_in_unit_of_work(update, screen(update, _Context())))
+    assert engine.checkouts == 1
+    update.callback_query.edit_message_text.assert_awaited_once()